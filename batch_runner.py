@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+__author__       = "Sebastian 'topo' Muniz"
+__copyright__   = "Copyright 2017"
+__credits__     = []
+__license__     = "GPL"
+__version__     = "0.1"
+__maintainer__  = "Sebastian Muniz"
+__email__       = "sebastianmuniz@gmail.com"
+__description__ = "Pimped out multi-architecture CPU emulator"
+
+from multiprocessing import Pool, cpu_count
+import os
+from time import time
+
+from pimp_my_ride import PimpMyRide, PimpMyRideException, LOG_LEVELS
+from elf_loader import ElfImage, ELF_MAGIC
+
+__all__ = ["BatchJob", "BatchResult", "BatchRunner"]
+
+# Default stack used by the workers' emulators.
+BATCH_STACK = 0x7FF00000
+BATCH_STACK_SIZE = 0x100 # Pages
+
+# Settings shared by all the jobs of a worker process and its emulators, one
+# per image, ready to be restored to their initial state.
+_worker_settings = None
+_worker_emulators = dict()
+
+
+class BatchJob(object):
+    """A function call to emulate.
+
+    `image` is the path to an ELF file or to a raw image. Raw images also need
+    the architecture details and the base address they are loaded at.
+    `max_insns` limits the number of instructions emulated (0 = no limit).
+    """
+
+    def __init__(self, image, entry, args=(), max_insns=0, architecture=None,
+            bits=None, is_little_endian=True, base_address=0):
+        self.image = image
+        self.entry = entry
+        self.args = tuple(args)
+        self.max_insns = max_insns
+        self.architecture = architecture
+        self.bits = bits
+        self.is_little_endian = is_little_endian
+        self.base_address = base_address
+
+    def image_key(self):
+        """Return the key identifying the emulator able to run this job."""
+        return (self.image, self.architecture, self.bits,
+                self.is_little_endian, self.base_address)
+
+
+class BatchResult(object):
+    """Outcome of a BatchJob: the returned value or the error raised."""
+
+    def __init__(self, index, job, value=None, error=None, elapsed=0.0):
+        self.index = index      # Position of the job in the submitted jobs.
+        self.job = job
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed  # Seconds spent emulating the job.
+
+    @property
+    def ok(self):
+        """Return True if the job ran to completion."""
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return "<BatchResult #%d 0x%X (%.6fs)>" % (
+                self.index, self.value, self.elapsed)
+        return "<BatchResult #%d error: %s>" % (self.index, self.error)
+
+
+def _create_emulator(job):
+    """Create and initialize an emulator for the job's image and return it
+    along with a snapshot of its initial state.
+    """
+    stack, stack_size, log_level = _worker_settings
+
+    with open(job.image, 'rb') as f:
+        is_elf = f.read(len(ELF_MAGIC)) == ELF_MAGIC
+
+    if is_elf:
+        # Lazy pages would be unmapped by every restore and faulted in again
+        # by the next job, the whole image is mapped up front instead.
+        emu = ElfImage(job.image).create_emulator(lazy=False, stack=stack,
+                stack_size=stack_size, log_level=log_level)
+
+    else:
+        if job.architecture is None:
+            raise PimpMyRideException(
+                "Architecture required for raw image %s" % job.image)
+
+        emu = PimpMyRide(job.architecture, job.bits, job.is_little_endian,
+                stack=stack, stack_size=stack_size, log_level=log_level)
+        emu.add_memory_area(job.base_address, os.path.getsize(job.image))
+        emu.add_memory_file(job.base_address, job.image)
+
+    emu.start_address = job.entry
+    emu.init()
+
+    return emu, emu.snapshot()
+
+
+def _init_worker(settings):
+    """Store the settings of the current worker process."""
+    global _worker_settings
+    _worker_settings = settings
+    _worker_emulators.clear()
+
+
+def _run_job(indexed_job):
+    """Run a single job in the worker process."""
+    index, job = indexed_job
+    result = BatchResult(index, job)
+
+    try:
+        key = job.image_key()
+        if key not in _worker_emulators:
+            _worker_emulators[key] = _create_emulator(job)
+
+        emu, snapshot = _worker_emulators[key]
+        emu.restore(snapshot)
+
+        start = time()
+        try:
+            result.value = emu.call(job.entry, *job.args, count=job.max_insns)
+        finally:
+            result.elapsed = time() - start
+
+    except Exception, err:
+        result.error = "%s: %s" % (type(err).__name__, err)
+
+    return result
+
+
+class BatchRunner(object):
+    """Run many BatchJob on a pool of worker processes.
+
+    Every worker keeps an initialized emulator per image and restores it to
+    its initial state before each job, so jobs only pay for the emulation
+    itself.
+    """
+
+    def __init__(self, processes=None, chunksize=16, stack=BATCH_STACK,
+            stack_size=BATCH_STACK_SIZE, log_level=LOG_LEVELS['error']):
+        self.processes = processes or cpu_count()
+        self.chunksize = chunksize
+
+        self.__pool = Pool(self.processes, _init_worker,
+                           ((stack, stack_size, log_level),))
+
+    def run(self, jobs, ordered=False):
+        """Run the jobs and return an iterator over their BatchResult.
+
+        Results are yielded as soon as they are available unless `ordered`
+        is set, in which case they follow the order of the jobs.
+        """
+        if ordered:
+            imap = self.__pool.imap
+        else:
+            imap = self.__pool.imap_unordered
+
+        return imap(_run_job, enumerate(jobs), self.chunksize)
+
+    def close(self):
+        """Wait for the pending jobs and stop the worker processes."""
+        self.__pool.close()
+        self.__pool.join()
+
+    def terminate(self):
+        """Stop the worker processes right away."""
+        self.__pool.terminate()
+        self.__pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+__author__       = "Sebastian 'topo' Muniz"
+__copyright__   = "Copyright 2017"
+__credits__     = []
+__license__     = "GPL"
+__version__     = "0.1"
+__maintainer__  = "Sebastian Muniz"
+__email__       = "sebastianmuniz@gmail.com"
+__description__ = "Pimped out multi-architecture CPU emulator"
+
+from binascii import hexlify, unhexlify
+import struct
+
+import unicorn as uc
+
+from pimp_my_ride import PimpMyRideException
+
+__all__ = ["BlockCoverage", "CoverageModule"]
+
+# drcov files (DynamoRIO's format, loaded in IDA by Lighthouse).
+_DRCOV_HEADER = "DRCOV VERSION: 2\nDRCOV FLAVOR: pimp_my_ride\n"
+_DRCOV_COLUMNS = "Columns: id, base, end, entry, checksum, timestamp, path\n"
+_DRCOV_BLOCK_TABLE = "BB Table: "
+
+# Block entry: start (offset from the module base), size and module id.
+_DRCOV_BLOCK = struct.Struct('<IHH')
+
+# Alignment (log2) of the instructions of every architecture, blocks can only
+# start at multiples of it. ARM allows for Thumb code.
+_ALIGNMENT = {
+    uc.UC_ARCH_X86 : 0,
+    uc.UC_ARCH_ARM : 1,
+    uc.UC_ARCH_ARM64 : 2,
+    uc.UC_ARCH_MIPS : 2,
+}
+
+
+class CoverageModule(object):
+    """Address range whose blocks are covered, with one byte per address a
+    block can start at.
+    """
+
+    def __init__(self, path, base, end, shift=0):
+        if end <= base:
+            raise PimpMyRideException(
+                "Invalid module range 0x%X-0x%X" % (base, end))
+
+        self.path = path
+        self.base = base
+        self.end = end
+        self.shift = shift
+
+        self.bitmap = bytearray((end - base + (1 << shift) - 1) >> shift)
+        self.sizes = dict()         # Covered block to its size.
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __repr__(self):
+        return "<CoverageModule %s 0x%08X-0x%08X (%d blocks)>" % (
+                self.path, self.base, self.end, len(self))
+
+    def __contains__(self, address):
+        return self.base <= address < self.end and \
+                bool(self.bitmap[(address - self.base) >> self.shift])
+
+    def add(self, address, size):
+        """Mark the block at the given address as covered."""
+        if not self.base <= address < self.end:
+            return
+
+        slot = (address - self.base) >> self.shift
+        if not self.bitmap[slot]:
+            self.bitmap[slot] = 1
+            self.sizes[address] = size
+
+    def merge(self, other):
+        """Add the blocks covered in another module of the same range."""
+        if (other.base, other.end, other.shift) != \
+                (self.base, self.end, self.shift):
+            raise PimpMyRideException("Cannot merge the coverage of "
+                                      "different modules")
+
+        if not other.sizes:
+            return
+
+        # Or the bitmaps as big numbers, byte by byte would be way slower.
+        merged = long(hexlify(self.bitmap), 16) | long(hexlify(other.bitmap), 16)
+        self.bitmap[:] = unhexlify("%0*x" % (len(self.bitmap) * 2, merged))
+
+        for address, size in other.sizes.iteritems():
+            self.sizes.setdefault(address, size)
+
+    def clear(self):
+        """Forget every covered block."""
+        self.bitmap[:] = bytearray(len(self.bitmap))
+        self.sizes.clear()
+
+    def callback(self):
+        """Return the block hook, it only touches local names."""
+        bitmap = self.bitmap
+        sizes = self.sizes
+        base = self.base
+        shift = self.shift
+
+        def callback(_uc, address, size, user_data):
+            slot = (address - base) >> shift
+            if not bitmap[slot]:
+                bitmap[slot] = 1
+                sizes[address] = size
+
+        return callback
+
+
+class BlockCoverage(object):
+    """Basic block coverage of the modules (address ranges) of a PimpMyRide
+    emulator.
+
+    Every module gets a bitmap allocated upfront with one byte per address a
+    block can start at, and a block hook bound to its range: the hook is a
+    bitmap lookup, only a new block is recorded (with its size, as needed by
+    drcov). Coverage is collected across every emulation until stop() and
+    the coverage of many runs can be merged, here or through drcov files.
+
+    A block Unicorn reports twice at the start of an emulation (see
+    add_block_hook()) is only recorded once. It was never executed if the
+    emulation stopped before its first instruction.
+    """
+
+    def __init__(self, emu, modules):
+        """Cover an emulator `modules`, (path, base, end) tuples."""
+        self.emu = emu
+
+        shift = _ALIGNMENT.get(emu.architecture, 0)
+        self.modules = [CoverageModule(path, base, end, shift)
+                        for path, base, end in modules]
+        self._hooks = None
+
+    @classmethod
+    def for_image(cls, emu, image):
+        """Cover an ElfImage loaded in an emulator as a single module."""
+        areas = image.areas()
+        return cls(emu, [(image.filename, areas[0][0], areas[-1][1])])
+
+    def __len__(self):
+        """Return the number of covered blocks."""
+        return sum([len(module) for module in self.modules])
+
+    def __repr__(self):
+        return "<BlockCoverage (%d blocks)>" % len(self)
+
+    def __contains__(self, address):
+        return any([address in module for module in self.modules])
+
+    def start(self):
+        """Start collecting coverage."""
+        if self._hooks is not None:
+            raise PimpMyRideException("Coverage already being collected")
+
+        self._hooks = [self.emu.add_block_hook(module.callback(),
+                                               module.base, module.end - 1)
+                       for module in self.modules]
+
+    def stop(self):
+        """Stop collecting coverage (what's covered is kept)."""
+        if self._hooks is None:
+            return
+
+        for hook in self._hooks:
+            self.emu.remove_hook(hook)
+        self._hooks = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def blocks(self):
+        """Return the (address, size) of the covered blocks, sorted."""
+        return sorted([block for module in self.modules
+                       for block in module.sizes.iteritems()])
+
+    def clear(self):
+        """Forget every covered block."""
+        for module in self.modules:
+            module.clear()
+
+    def merge(self, other):
+        """Add the blocks covered by another BlockCoverage of the same
+        modules.
+        """
+        if len(other.modules) != len(self.modules):
+            raise PimpMyRideException("Cannot merge the coverage of "
+                                      "different modules")
+
+        for module, other_module in zip(self.modules, other.modules):
+            module.merge(other_module)
+
+    def write_drcov(self, filename):
+        """Write the covered blocks as a drcov file (version 2)."""
+        with open(filename, 'wb') as f:
+            f.write(_DRCOV_HEADER)
+            f.write("Module Table: version 2, count %d\n" % len(self.modules))
+            f.write(_DRCOV_COLUMNS)
+            for idx, module in enumerate(self.modules):
+                f.write("%d, 0x%x, 0x%x, 0x0, 0x0, 0x0, %s\n" % (
+                        idx, module.base, module.end, module.path))
+
+            f.write("%s%d bbs\n" % (_DRCOV_BLOCK_TABLE, len(self)))
+            for idx, module in enumerate(self.modules):
+                f.write("".join([_DRCOV_BLOCK.pack(address - module.base,
+                                                   min(size, 0xFFFF), idx)
+                                 for address, size in
+                                 sorted(module.sizes.iteritems())]))
+
+    def read_drcov(self, filename):
+        """Add the blocks of a drcov file (version 2, written by
+        write_drcov() or DynamoRIO) in the modules with the same path.
+        """
+        with open(filename, 'rb') as f:
+            paths = dict()
+            count = None
+            for line in iter(f.readline, ''):
+                if line.startswith(_DRCOV_BLOCK_TABLE):
+                    count = int(line[len(_DRCOV_BLOCK_TABLE):].split()[0])
+                    break
+
+                fields = [field.strip() for field in line.split(",")]
+                if len(fields) == 7 and fields[0].isdigit():
+                    paths[int(fields[0])] = fields[6]
+
+            if count is None:
+                raise PimpMyRideException("Invalid drcov file %s" % filename)
+
+            data = f.read(count * _DRCOV_BLOCK.size)
+            if len(data) != count * _DRCOV_BLOCK.size:
+                raise PimpMyRideException("Truncated drcov file %s" % filename)
+
+        modules = dict()
+        for idx, path in paths.iteritems():
+            for module in self.modules:
+                if module.path == path:
+                    modules[idx] = module
+
+        for pos in xrange(0, len(data), _DRCOV_BLOCK.size):
+            start, size, idx = _DRCOV_BLOCK.unpack_from(data, pos)
+            if idx in modules:
+                modules[idx].add(modules[idx].base + start, size)
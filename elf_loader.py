@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+__author__       = "Sebastian 'topo' Muniz"
+__copyright__   = "Copyright 2017"
+__credits__     = []
+__license__     = "GPL"
+__version__     = "0.1"
+__maintainer__  = "Sebastian Muniz"
+__email__       = "sebastianmuniz@gmail.com"
+__description__ = "Pimped out multi-architecture CPU emulator"
+
+import unicorn as uc
+
+from pimp_my_ride import PimpMyRide, PimpMyRideException, PAGE_SIZE
+from elf_symbols import SymbolIndex
+
+__all__ = ["ElfImage", "ELF_MAGIC"]
+
+ELF_MAGIC = "\x7fELF"
+
+# Segment flags (p_flags).
+PF_X = 0x1
+PF_W = 0x2
+PF_R = 0x4
+
+
+def segment_permissions(flags):
+    """Return the Unicorn permissions matching the flags of a segment."""
+    perm = uc.UC_PROT_NONE
+    if flags & PF_R:
+        perm |= uc.UC_PROT_READ
+    if flags & PF_W:
+        perm |= uc.UC_PROT_WRITE
+    if flags & PF_X:
+        perm |= uc.UC_PROT_EXEC
+    return perm
+
+
+class Segment(object):
+    """Loadable (PT_LOAD) segment of an ELF image."""
+
+    def __init__(self, address, memory_size, offset, file_size, perm):
+        self.address = address
+        self.memory_size = memory_size
+        self.offset = offset
+        self.file_size = file_size
+        self.perm = perm
+
+    @property
+    def pages(self):
+        """Return the page-aligned (start, end) range holding the segment."""
+        start = self.address // PAGE_SIZE * PAGE_SIZE
+        end = (self.address + self.memory_size + PAGE_SIZE - 1) // \
+                PAGE_SIZE * PAGE_SIZE
+        return start, end
+
+    def __repr__(self):
+        return "<Segment 0x%08X-0x%08X>" % (self.address,
+                                            self.address + self.memory_size)
+
+
+class ElfImage(object):
+    """Loadable segments of an ELF file and how to map them.
+
+    The segments are turned into memory areas with the permissions of their
+    flags: adjacent pages with the same permissions are coalesced into a
+    single area, and pages shared by segments get the union of theirs.
+    Areas are lazy, pages (.bss included) are only mapped when first touched
+    and their contents come straight from the file, so loading a binary only
+    costs the pages it actually uses.
+    """
+
+    def __init__(self, filename):
+        try:
+            from elftools.elf.elffile import ELFFile
+        except ImportError:
+            raise PimpMyRideException("Missing 'pyelftools' module.")
+
+        self.filename = filename
+        self._symbols = None
+
+        with open(filename, 'rb') as f:
+            if f.read(len(ELF_MAGIC)) != ELF_MAGIC:
+                raise PimpMyRideException("%s is not an ELF file" % filename)
+            f.seek(0)
+
+            image = ELFFile(f)
+            self.architecture = image.get_machine_arch()
+            self.bits = image.elfclass
+            self.little_endian = image.little_endian
+            self.entry = image.header.e_entry
+
+            self.segments = list()
+            for segment in image.iter_segments():
+                if segment['p_type'] != 'PT_LOAD' or not segment['p_memsz']:
+                    continue
+
+                self.segments.append(Segment(
+                    segment['p_vaddr'], segment['p_memsz'],
+                    segment['p_offset'], segment['p_filesz'],
+                    segment_permissions(segment['p_flags'])))
+
+        if not self.segments:
+            raise PimpMyRideException("No loadable segments in %s" % filename)
+
+    @property
+    def symbols(self):
+        """Return the SymbolIndex of the image (built or read from the cache
+        on first use).
+        """
+        if self._symbols is None:
+            self._symbols = SymbolIndex.load(self.filename)
+        return self._symbols
+
+    def resolve(self, location):
+        """Return the address of a symbol name or of a (decimal or hex)
+        address string.
+        """
+        try:
+            return int(location, 0)
+        except ValueError:
+            pass
+
+        address = self.symbols.address(location)
+        if address is None:
+            raise PimpMyRideException("Unknown symbol '%s'" % location)
+        return address
+
+    def areas(self):
+        """Return the (start, end, perm) page ranges to map, sorted by
+        address.
+        """
+        bounds = sorted(set([bound for segment in self.segments
+                             for bound in segment.pages]))
+
+        areas = []
+        for start, end in zip(bounds, bounds[1:]):
+            covering = [segment.perm for segment in self.segments
+                        if segment.pages[0] <= start < segment.pages[1]]
+            if not covering:
+                continue
+
+            perm = reduce(lambda a, b: a | b, covering)
+            if areas and areas[-1][1] == start and areas[-1][2] == perm:
+                areas[-1][1] = end
+            else:
+                areas.append([start, end, perm])
+
+        return [tuple(area) for area in areas]
+
+    def load(self, emu, lazy=True):
+        """Add the memory areas and contents of the image to an emulator."""
+        for start, end, perm in self.areas():
+            emu.add_memory_area(start, end - start, perm, lazy)
+
+        for segment in self.segments:
+            if segment.file_size:
+                emu.add_memory_file(segment.address, self.filename,
+                                    segment.offset, segment.file_size)
+
+    def create_emulator(self, lazy=True, **kwargs):
+        """Return a new PimpMyRide emulator (created with the given keyword
+        arguments) for the image, with the image loaded.
+        """
+        emu = PimpMyRide(self.architecture, self.bits, self.little_endian,
+                         **kwargs)
+        self.load(emu, lazy)
+        return emu
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+__author__       = "Sebastian 'topo' Muniz"
+__copyright__   = "Copyright 2017"
+__credits__     = []
+__license__     = "GPL"
+__version__     = "0.1"
+__maintainer__  = "Sebastian Muniz"
+__email__       = "sebastianmuniz@gmail.com"
+__description__ = "Pimped out multi-architecture CPU emulator"
+
+from array import array
+from bisect import bisect_right
+import hashlib
+import logging
+import os
+import struct
+
+from pimp_my_ride import PimpMyRideException
+from utility.conversion import uint64_array
+
+__all__ = ["SymbolIndex", "SYMBOL_CACHE_DIR"]
+
+# Where the symbol indexes are cached (one file per image contents).
+SYMBOL_CACHE_DIR = os.environ.get("PIMP_MY_RIDE_CACHE",
+        os.path.join(os.path.expanduser("~"), ".cache", "pimp_my_ride"))
+
+# Cache file header: magic, version and number of symbols and bytes of
+# names. The header is followed by the little-endian starts and sizes (64-bit)
+# and name offsets (32-bit) of the symbols, so any host can read the cache.
+_CACHE_MAGIC = "PMRSYM"
+_CACHE_VERSION = 2
+_CACHE_HEADER = struct.Struct('<6sHII')
+_CACHE_ARRAYS = ('Q', 'Q', 'I')
+
+# Symbol types worth resolving addresses to.
+_SYMBOL_TYPES = ('STT_FUNC', 'STT_OBJECT', 'STT_NOTYPE')
+
+logger = logging.getLogger("SymbolIndex")
+
+
+def file_hash(filename):
+    """Return the SHA-1 hex digest of a file contents."""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(0x100000), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SymbolIndex(object):
+    """Address to symbol index of an ELF image (.symtab and .dynsym).
+
+    Symbols are kept in parallel arrays sorted by address (start, size and
+    offset of the name in a single string holding all of them), so a lookup
+    is a bisect and the whole index is written to (and read from) disk as
+    is. A symbol without size covers everything up to the next one.
+    """
+
+    def __init__(self, symbols=()):
+        self._starts = uint64_array()
+        self._sizes = uint64_array()
+        self._names = array('I')       # Offsets in _strings.
+        self._strings = ""
+        self._by_name = None
+
+        strings = []
+        length = 0
+        for start, size, name in sorted(set(symbols)):
+            self._starts.append(start)
+            self._sizes.append(size)
+            self._names.append(length)
+            strings.append(name + "\x00")
+            length += len(name) + 1
+
+        self._strings = "".join(strings)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __repr__(self):
+        return "<SymbolIndex (%d symbols)>" % len(self)
+
+    def name(self, idx):
+        """Return the name of the symbol at the given position."""
+        offset = self._names[idx]
+        return self._strings[offset:self._strings.index("\x00", offset)]
+
+    def lookup(self, address):
+        """Return the (name, offset) of the symbol holding the address, None
+        if there's none.
+        """
+        idx = bisect_right(self._starts, address) - 1
+        if idx < 0:
+            return None
+
+        size = self._sizes[idx]
+        offset = address - self._starts[idx]
+        if size and offset >= size:
+            return None
+
+        return self.name(idx), offset
+
+    def describe(self, address):
+        """Return the address as 'symbol+offset' (or in hex if unknown)."""
+        symbol = self.lookup(address)
+        if symbol is None:
+            return "0x%X" % address
+
+        name, offset = symbol
+        return "%s+0x%X" % (name, offset) if offset else name
+
+    def address(self, name):
+        """Return the address of a symbol (None if unknown)."""
+        if self._by_name is None:
+            self._by_name = dict()
+            for idx in xrange(len(self) - 1, -1, -1):
+                self._by_name[self.name(idx)] = self._starts[idx]
+
+        return self._by_name.get(name)
+
+    @classmethod
+    def from_elf(cls, filename):
+        """Build the index of an ELF file symbol tables."""
+        try:
+            from elftools.elf.elffile import ELFFile
+            from elftools.elf.sections import SymbolTableSection
+        except ImportError:
+            raise PimpMyRideException("Missing 'pyelftools' module.")
+
+        symbols = []
+        with open(filename, 'rb') as f:
+            for section in ELFFile(f).iter_sections():
+                if not isinstance(section, SymbolTableSection):
+                    continue
+
+                for symbol in section.iter_symbols():
+                    # Skip the ARM/AArch64 mapping symbols ($a, $t, $x,
+                    # $d...) which mark code and data, like GDB and objdump.
+                    if not symbol.name or symbol.name.startswith('$') or \
+                            not symbol['st_value'] or \
+                            symbol['st_shndx'] == 'SHN_UNDEF' or \
+                            symbol['st_info']['type'] not in _SYMBOL_TYPES:
+                        continue
+
+                    name = symbol.name
+                    if isinstance(name, unicode):
+                        name = name.encode('utf-8')
+
+                    symbols.append((symbol['st_value'], symbol['st_size'],
+                                    name))
+
+        return cls(symbols)
+
+    @classmethod
+    def load(cls, filename, cache_dir=SYMBOL_CACHE_DIR):
+        """Return the index of an ELF file, from the cache if it was built
+        before for the same contents (None as `cache_dir` disables it).
+        """
+        if cache_dir is None:
+            return cls.from_elf(filename)
+
+        path = os.path.join(cache_dir, file_hash(filename) + ".sym")
+
+        try:
+            return cls.read(path)
+        except (IOError, EOFError, ValueError):
+            pass
+
+        index = cls.from_elf(filename)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            index.write(path)
+        except (IOError, OSError), err:
+            logger.warning("Cannot cache the symbols of %s: %s",
+                           filename, err)
+
+        return index
+
+    @classmethod
+    def read(cls, path):
+        """Read an index written by write()."""
+        index = cls()
+        with open(path, 'rb') as f:
+            header = f.read(_CACHE_HEADER.size)
+            if len(header) != _CACHE_HEADER.size:
+                raise ValueError("Truncated symbol cache %s" % path)
+
+            magic, version, count, length = _CACHE_HEADER.unpack(header)
+            if magic != _CACHE_MAGIC or version != _CACHE_VERSION:
+                raise ValueError("Invalid symbol cache %s" % path)
+
+            for values, typecode in zip((index._starts, index._sizes,
+                                         index._names), _CACHE_ARRAYS):
+                layout = struct.Struct('<%d%s' % (count, typecode))
+                data = f.read(layout.size)
+                if len(data) != layout.size:
+                    raise ValueError("Truncated symbol cache %s" % path)
+                values.extend(layout.unpack(data))
+
+            index._strings = f.read(length)
+            if len(index._strings) != length:
+                raise ValueError("Truncated symbol cache %s" % path)
+
+        return index
+
+    def write(self, path):
+        """Write the index to a file (atomically)."""
+        temp = "%s.%d" % (path, os.getpid())
+        with open(temp, 'wb') as f:
+            f.write(_CACHE_HEADER.pack(_CACHE_MAGIC, _CACHE_VERSION,
+                                       len(self), len(self._strings)))
+            for values, typecode in zip((self._starts, self._sizes,
+                                         self._names), _CACHE_ARRAYS):
+                f.write(struct.pack('<%d%s' % (len(values), typecode),
+                                    *values))
+            f.write(self._strings)
+
+        os.rename(temp, path)
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+__author__       = "Sebastian 'topo' Muniz"
+__copyright__   = "Copyright 2017"
+__credits__     = []
+__license__     = "GPL"
+__version__     = "0.1"
+__maintainer__  = "Sebastian Muniz"
+__email__       = "sebastianmuniz@gmail.com"
+__description__ = "Pimped out multi-architecture CPU emulator"
+
+import struct
+
+from utility import hexDecode
+
+__all__ = ["AgentExpression", "AgentExpressionError", "BreakpointCondition",
+        "parse_condition_list"]
+
+# Agent expressions work on 64bits values.
+VALUE_BITS = 64
+VALUE_MASK = (1 << VALUE_BITS) - 1
+SIGN_BIT = 1 << (VALUE_BITS - 1)
+
+# Bound on the number of bytecodes executed by an evaluation (expressions can
+# loop with backward gotos).
+MAX_STEPS = 0x10000
+
+
+class AgentExpressionError(ValueError):
+    """Invalid agent expression or failed evaluation."""
+    pass
+
+
+def _signed(value):
+    """Return the signed interpretation of a 64bits value."""
+    return value - (1 << VALUE_BITS) if value & SIGN_BIT else value
+
+
+class _Context(object):
+    """State of an agent expression evaluation."""
+
+    def __init__(self, emu, variables, collect):
+        self.emu = emu
+        self.variables = variables
+        self.collect = collect
+
+
+#
+# Bytecode handlers. Every one of them works on the stack in place and
+# returns the index of the next instruction when it jumps.
+#
+def _binary(func):
+    """Return the handler of a binary operation: a b => func(a, b)."""
+    def handler(ctx, stack, arg):
+        b = stack.pop()
+        stack[-1] = func(stack[-1], b) & VALUE_MASK
+    return handler
+
+
+def _div_signed(a, b):
+    a, b = _signed(a), _signed(b)
+    if not b:
+        raise AgentExpressionError("Division by zero")
+    # Truncate toward zero like C does.
+    quotient = abs(a) // abs(b)
+    return -quotient if (a < 0) != (b < 0) else quotient
+
+
+def _div_unsigned(a, b):
+    if not b:
+        raise AgentExpressionError("Division by zero")
+    return a // b
+
+
+def _rem_signed(a, b):
+    return _signed(a) - _div_signed(a, b) * _signed(b)
+
+
+def _rem_unsigned(a, b):
+    if not b:
+        raise AgentExpressionError("Division by zero")
+    return a % b
+
+
+def _log_not(ctx, stack, arg):
+    stack[-1] = int(not stack[-1])
+
+
+def _bit_not(ctx, stack, arg):
+    stack[-1] = ~stack[-1] & VALUE_MASK
+
+
+def _ext(ctx, stack, bits):
+    value = stack[-1] & ((1 << bits) - 1)
+    if value & (1 << (bits - 1)):
+        value -= 1 << bits
+    stack[-1] = value & VALUE_MASK
+
+
+def _zero_ext(ctx, stack, bits):
+    stack[-1] &= (1 << bits) - 1
+
+
+def _ref(size, fmt):
+    """Return the handler of a memory dereference: addr => value."""
+    def handler(ctx, stack, arg):
+        data = ctx.emu.read_memory(stack[-1], size)
+        if len(data) != size:
+            raise AgentExpressionError(
+                "Cannot read %d bytes at 0x%X" % (size, stack[-1]))
+        stack[-1] = struct.unpack(ctx.emu.pack_endian + fmt, data)[0]
+    return handler
+
+
+def _if_goto(ctx, stack, target):
+    if stack.pop():
+        return target
+
+
+def _goto(ctx, stack, target):
+    return target
+
+
+def _const(ctx, stack, value):
+    stack.append(value)
+
+
+def _reg(ctx, stack, number):
+    registers = ctx.emu.registers.registers
+    if number >= len(registers):
+        raise AgentExpressionError("Invalid register %d" % number)
+    stack.append(ctx.emu.read_register(registers[number].name) & VALUE_MASK)
+
+
+def _dup(ctx, stack, arg):
+    stack.append(stack[-1])
+
+
+def _pop(ctx, stack, arg):
+    stack.pop()
+
+
+def _swap(ctx, stack, arg):
+    stack[-1], stack[-2] = stack[-2], stack[-1]
+
+
+def _pick(ctx, stack, depth):
+    stack.append(stack[-1 - depth])
+
+
+def _rot(ctx, stack, arg):
+    # a b c => c a b
+    stack[-3], stack[-2], stack[-1] = stack[-1], stack[-3], stack[-2]
+
+
+def _getv(ctx, stack, number):
+    stack.append(ctx.variables.get(number, 0) & VALUE_MASK)
+
+
+def _setv(ctx, stack, number):
+    ctx.variables[number] = stack[-1]
+
+
+def _trace(ctx, stack, arg):
+    size = stack.pop()
+    addr = stack.pop()
+    if ctx.collect is not None:
+        ctx.collect('memory', addr, size)
+
+
+def _trace_quick(ctx, stack, size):
+    if ctx.collect is not None:
+        ctx.collect('memory', stack[-1], size)
+
+
+def _tracenz(ctx, stack, arg):
+    size = stack.pop()
+    addr = stack.pop()
+    if ctx.collect is not None:
+        # Collect up to (and including) the string terminator.
+        data = ctx.emu.read_memory(addr, size)
+        end = data.find('\x00')
+        ctx.collect('memory', addr, size if end == -1 else end + 1)
+
+
+def _tracev(ctx, stack, number):
+    if ctx.collect is not None:
+        ctx.collect('variable', number, ctx.variables.get(number, 0))
+
+
+# Opcode: (name, handler, operand size in bytes). Operands are big-endian.
+_OPCODES = {
+    0x02: ('add', _binary(lambda a, b: a + b), 0),
+    0x03: ('sub', _binary(lambda a, b: a - b), 0),
+    0x04: ('mul', _binary(lambda a, b: a * b), 0),
+    0x05: ('div_signed', _binary(_div_signed), 0),
+    0x06: ('div_unsigned', _binary(_div_unsigned), 0),
+    0x07: ('rem_signed', _binary(_rem_signed), 0),
+    0x08: ('rem_unsigned', _binary(_rem_unsigned), 0),
+    0x09: ('lsh', _binary(lambda a, b: a << b if b < VALUE_BITS else 0), 0),
+    0x0a: ('rsh_signed', _binary(
+            lambda a, b: _signed(a) >> min(b, VALUE_BITS - 1)), 0),
+    0x0b: ('rsh_unsigned', _binary(lambda a, b: a >> b), 0),
+    0x0c: ('trace', _trace, 0),
+    0x0d: ('trace_quick', _trace_quick, 1),
+    0x0e: ('log_not', _log_not, 0),
+    0x0f: ('bit_and', _binary(lambda a, b: a & b), 0),
+    0x10: ('bit_or', _binary(lambda a, b: a | b), 0),
+    0x11: ('bit_xor', _binary(lambda a, b: a ^ b), 0),
+    0x12: ('bit_not', _bit_not, 0),
+    0x13: ('equal', _binary(lambda a, b: int(a == b)), 0),
+    0x14: ('less_signed', _binary(lambda a, b: int(_signed(a) < _signed(b))), 0),
+    0x15: ('less_unsigned', _binary(lambda a, b: int(a < b)), 0),
+    0x16: ('ext', _ext, 1),
+    0x17: ('ref8', _ref(1, 'B'), 0),
+    0x18: ('ref16', _ref(2, 'H'), 0),
+    0x19: ('ref32', _ref(4, 'I'), 0),
+    0x1a: ('ref64', _ref(8, 'Q'), 0),
+    0x20: ('if_goto', _if_goto, 2),
+    0x21: ('goto', _goto, 2),
+    0x22: ('const8', _const, 1),
+    0x23: ('const16', _const, 2),
+    0x24: ('const32', _const, 4),
+    0x25: ('const64', _const, 8),
+    0x26: ('reg', _reg, 2),
+    0x27: ('end', None, 0),
+    0x28: ('dup', _dup, 0),
+    0x29: ('pop', _pop, 0),
+    0x2a: ('zero_ext', _zero_ext, 1),
+    0x2b: ('swap', _swap, 0),
+    0x2c: ('getv', _getv, 2),
+    0x2d: ('setv', _setv, 2),
+    0x2e: ('tracev', _tracev, 2),
+    0x2f: ('tracenz', _tracenz, 0),
+    0x30: ('trace16', _trace_quick, 2),
+    0x32: ('pick', _pick, 1),
+    0x33: ('rot', _rot, 0),
+}
+
+# Operand formats by size.
+_OPERAND_FORMATS = {1: '>B', 2: '>H', 4: '>I', 8: '>Q'}
+
+
+class AgentExpression(object):
+    """GDB agent expression.
+
+    The bytecode is decoded once into a list of (handler, operand) tuples,
+    with jump offsets turned into indexes of that list, so evaluating it is
+    a tight loop over Python callables. Floating point bytecodes and printf
+    are not supported.
+    """
+
+    def __init__(self, bytecode):
+        self.bytecode = bytecode
+        self._code = self._compile(bytecode)
+
+    def __repr__(self):
+        return "<AgentExpression %s>" % self.bytecode.encode('hex')
+
+    @staticmethod
+    def _compile(bytecode):
+        """Decode the bytecode and return its list of instructions."""
+        code = []
+        offsets = dict()    # Bytecode offset to instruction index.
+        pos = 0
+
+        while pos < len(bytecode):
+            opcode = ord(bytecode[pos])
+            if opcode not in _OPCODES:
+                raise AgentExpressionError(
+                    "Unsupported bytecode 0x%02x at offset %d" % (opcode, pos))
+
+            name, handler, size = _OPCODES[opcode]
+            if pos + 1 + size > len(bytecode):
+                raise AgentExpressionError("Truncated '%s' operand" % name)
+
+            operand = None
+            if size:
+                operand = struct.unpack(_OPERAND_FORMATS[size],
+                                        bytecode[pos + 1:pos + 1 + size])[0]
+
+            offsets[pos] = len(code)
+            code.append((handler, operand))
+            pos += 1 + size
+
+        if not code or code[-1][0] is not None:
+            raise AgentExpressionError("Missing 'end' bytecode")
+
+        # Jumps must land on an instruction.
+        for idx, (handler, operand) in enumerate(code):
+            if handler in (_if_goto, _goto):
+                if operand not in offsets:
+                    raise AgentExpressionError(
+                        "Invalid jump to offset %d" % operand)
+                code[idx] = (handler, offsets[operand])
+
+        return code
+
+    def evaluate(self, emu, variables=None, collect=None):
+        """Evaluate the expression on the current state of a PimpMyRide
+        emulator and return the (64bits) value on top of the stack.
+
+        `variables` holds the trace state variables and `collect` is called
+        with the data the tracing bytecodes ask for.
+        """
+        ctx = _Context(emu, variables if variables is not None else {},
+                       collect)
+        code = self._code
+        stack = []
+        pc = 0
+
+        try:
+            for _ in xrange(MAX_STEPS):
+                handler, operand = code[pc]
+                if handler is None:
+                    return stack[-1] if stack else 0
+
+                target = handler(ctx, stack, operand)
+                pc = pc + 1 if target is None else target
+
+        except IndexError:
+            raise AgentExpressionError("Stack underflow")
+
+        raise AgentExpressionError("Too many steps")
+
+
+def parse_condition_list(params):
+    """Return the AgentExpression list of the 'X len,expr' parameters of a
+    Z packet (other parameters are ignored).
+    """
+    conditions = []
+    for param in params:
+        if not param.startswith('X'):
+            continue
+
+        length, expr = param[1:].split(',', 1)
+        bytecode = hexDecode(expr)
+        if len(bytecode) != int(length, 16):
+            raise AgentExpressionError("Condition length mismatch")
+
+        conditions.append(AgentExpression(bytecode))
+
+    return conditions
+
+
+class BreakpointCondition(object):
+    """Breakpoint condition made of a list of agent expressions.
+
+    It holds when any of its expressions is true. An expression failing to
+    evaluate counts as true, so the breakpoint stops and GDB reports it.
+    """
+
+    def __init__(self, expressions):
+        self.expressions = expressions
+
+    def __call__(self, emu):
+        for expression in self.expressions:
+            try:
+                if expression.evaluate(emu):
+                    return True
+            except AgentExpressionError:
+                return True
+
+        return False
@@ -15,14 +15,16 @@
  limitations under the License.
 """
 
-import logging, threading, socket
+import logging, threading, socket, os, re
 import colorlog
 
-from struct import unpack
-from time import sleep, time
+from select import select
+from time import time
 from sys import stdout
 
 from protocol import Socket, WebSocket
+from rsp_framer import RSPFramer, RSP_PACKET, RSP_BAD_PACKET, RSP_NACK, \
+        RSP_INTERRUPT, rsp_escape
 
 #from pyOCD.target.target import TARGET_HALTED, WATCHPOINT_READ, WATCHPOINT_WRITE, WATCHPOINT_READ_WRITE
 #TODO FIXME remove this duplicated definitions.
@@ -33,7 +35,10 @@ WATCHPOINT_READ = 1
 WATCHPOINT_WRITE = 2
 WATCHPOINT_READ_WRITE = 3
 
-from utility import hexStringToIntList, hexEncode, hexDecode
+from utility import hexEncode, hexDecode
+from agent_expr import AgentExpression, AgentExpressionError, \
+        BreakpointCondition, parse_condition_list
+from target.tracepoints import Tracepoint
 
 
 
@@ -42,6 +47,15 @@ LOG_MEM = True # Log memory accesses.
 LOG_ACK = False # Log ack or nak.
 
 
+# Tracepoint actions of QTDP packets: registers, memory and expressions.
+TRACE_ACTION = re.compile(r'R([0-9a-fA-F]+)|'
+                          r'M(-?[0-9a-fA-F]+),([0-9a-fA-F]+),([0-9a-fA-F]+)|'
+                          r'X([0-9a-fA-F]+),')
+
+# Trace queries handled by handleTraceQuery.
+TRACE_QUERIES = ('TStatus', 'TfP', 'TsP', 'TfV', 'TsV', 'TP', 'TV')
+
+
 class TransferError(ValueError):
     pass
 
@@ -97,10 +111,19 @@ class GDBServer(threading.Thread):
         self.hide_programming_progress = options.get('hide_programming_progress', False)
         self.fast_program = options.get('fast_program', False)
 
-        self.packet_size = 2048
+        self.packet_size = 0x4000
         self.send_acks = True
         self.clear_send_acks = False
         self.gdb_features = []
+        self.last_response = None
+        self.out_buffer = []
+
+        # Trace frame selected by QTFrame (None = live target).
+        self.trace_frame = None
+
+        # Packets received while the target was running, handled afterwards.
+        self.framer = RSPFramer(self.packet_size)
+        self.pending_events = []
 
         self.flashBuilder = None # XXX delete
         self.conn = None
@@ -113,18 +136,29 @@ class GDBServer(threading.Thread):
             self.abstract_socket = Socket(self.port, self.packet_size)
         else:
             self.abstract_socket = WebSocket(self.wss_server)
+
+        # Self-pipe used to wake up the server loop from other threads (target
+        # halted, shutdown or restart requested) while it waits on the socket.
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        self.target.add_halt_listener(self.wakeup)
+
         self.setDaemon(True)
         self.start()
 
+    def wakeup(self):
+        """Wake up the server loop if it's waiting for data."""
+        os.write(self.wakeup_write, "!")
+
     def restart(self):
         if self.isAlive():
             self.detach_event.set()
+            self.wakeup()
 
     def stop(self):
         if self.isAlive():
             self.shutdown_event.set()
-            while self.isAlive():
-                pass
+            self.wakeup()
+            self.join()
             self.logger.info("GDB server thread killed")
         #self.board.uninit()
 
@@ -132,31 +166,48 @@ class GDBServer(threading.Thread):
         self.lock.acquire()
         if stop:
             self.restart()
+        self.target.remove_halt_listener(self.wakeup)
         self.board = board
         self.target = board.target
         self.flash = board.flash
+        self.target.add_halt_listener(self.wakeup)
         self.lock.release()
         return
 
-    def run(self):
-        self.timeOfLastPacket = time()
-        while True:
-            new_command = False
-            data = ""
-            self.logger.info('GDB server started at port:%d',self.port)
+    def waitReadable(self, timeout=None):
+        """Wait until the client sends something or the loop is woken up.
 
-            self.shutdown_event.clear()
-            self.detach_event.clear()
+        Return True if there is data (or a new connection) to be read.
+        """
+        fileno = self.abstract_socket.fileno()
+        if fileno is None:
+            # Transports without a descriptor are polled.
+            self.shutdown_event.wait(0.5 if timeout is None else timeout)
+            return True
 
-            while not self.shutdown_event.isSet() and not self.detach_event.isSet():
-                connected = self.abstract_socket.connect()
-                if connected != None:
-                    break
+        readable, _, _ = select([fileno, self.wakeup_read], [], [], timeout)
 
-            if self.shutdown_event.isSet():
-                return
+        if self.wakeup_read in readable:
+            os.read(self.wakeup_read, 4096)
+
+        return fileno in readable
 
-            if self.detach_event.isSet():
+    def waitConnection(self):
+        """Wait for a GDB client to connect. Return True when connected."""
+        while not self.shutdown_event.isSet() and not self.detach_event.isSet():
+            if not self.waitReadable():
+                continue
+            if self.abstract_socket.connect(0) != None:
+                return True
+        return False
+
+    def run(self):
+        self.logger.info('GDB server started at port:%d',self.port)
+
+        while not self.shutdown_event.isSet():
+            self.detach_event.clear()
+
+            if not self.waitConnection():
                 continue
 
             self.logger.info("One client connected!")
@@ -164,103 +215,109 @@ class GDBServer(threading.Thread):
             self.logger.debug("Configuring emulator...")
             self.target.init()
 
-            while True:
+            detach = self.serve()
 
-                if self.shutdown_event.isSet():
-                    return
+            self.abstract_socket.close()
 
-                if self.detach_event.isSet():
-                    continue
-
-                # read command
-                while True:
-                    if (new_command == True):
-                        new_command = False
-                        break
-
-                    # Reduce CPU usage by sleep()ing once we know that the
-                    # debugger doesn't have a queue of commands that we should
-                    # execute as quickly as possible.
-                    if time() - self.timeOfLastPacket > 0.5:
-                        sleep(0.1)
-                    try:
-                        if self.shutdown_event.isSet() or self.detach_event.isSet():
-                            break
-                        self.abstract_socket.setBlocking(0)
-                        data += self.abstract_socket.read()
-                        if data.index("$") >= 0 and data.index("#") >= 0:
-                            break
-                    except (ValueError, socket.error):
-                        pass
-
-                if self.shutdown_event.isSet():
-                    return
-
-                if self.detach_event.isSet():
-                    continue
+            if detach and not self.persist:
+                break
 
-                self.abstract_socket.setBlocking(1)
+        self.abstract_socket.shutdown()
 
-                data = data[data.index("$"):]
+    def serve(self):
+        """Serve the connected client until it detaches or disconnects.
 
-                self.lock.acquire()
+        Return True if the client detached (or killed the session).
+        """
+        self.framer.reset()
+        self.framer.verify_checksums = True
+        self.pending_events = []
+        self.last_response = None
+        self.out_buffer = []
+        self.trace_frame = None
+        self.send_acks = True
+        self.clear_send_acks = False
+        self.timeOfLastPacket = time()
 
-                if len(data) != 0:
-                    # decode and prepare resp
-                    [resp, ack, detach] = self.handleMsg(data)
+        while not self.shutdown_event.isSet() and not self.detach_event.isSet():
 
-                    # Clear out data
+            if not self.pending_events:
+                # Everything queued is answered, send the responses at once.
+                self.flush()
+                if not self.waitReadable():
+                    continue
+                try:
+                    data = self.abstract_socket.read()
+                except socket.error:
                     data = ""
+                if not data:
+                    self.logger.info("Client disconnected")
+                    return False
+                self.pending_events = self.framer.feed(data)
+                continue
+
+            event, payload = self.pending_events.pop(0)
+
+            if event == RSP_BAD_PACKET:
+                self.logger.warning("Corrupted RSP packet received")
+                if self.send_acks:
+                    self.send("-")
+                continue
+
+            if event == RSP_NACK:
+                # The client didn't get our last response right, resend it.
+                if self.send_acks and self.last_response is not None:
+                    self.send(self.last_response)
+                continue
 
-                    if resp is not None:
-                        # ack
-                        if ack and self.send_acks:
-                            resp = "+" + resp
-                        # send resp
-                        self.abstract_socket.write(resp)
-                        if self.send_acks:
-                            # wait a '+' from the client
-                            try:
-                                data = self.abstract_socket.read()
-                                if LOG_ACK:
-                                    if data[0] != '+':
-                                        self.logger.debug('gdb client has not ack!')
-                                    else:
-                                        self.logger.debug('gdb client has ack!')
-                                if self.clear_send_acks:
-                                    self.send_acks = False
-                                if data.index("$") >= 0 and data.index("#") >= 0:
-                                    new_command = True
-                            except:
-                                pass
-
-                    if detach:
-                        self.abstract_socket.close()
-                        self.lock.release()
-                        if self.persist:
-                            break
-                        else:
-                            return
-
-                    self.timeOfLastPacket = time()
+            if event != RSP_PACKET:
+                # Acks and interrupts while the target is halted.
+                continue
 
+            self.lock.acquire()
+            try:
+                # decode and prepare resp
+                [resp, ack, detach] = self.handleMsg(payload)
+
+                if resp is not None:
+                    self.last_response = resp
+                    # ack
+                    if ack:
+                        self.ack()
+                    # send resp
+                    self.send(resp)
+
+                    # The client's ack for this response is still expected.
+                    if self.clear_send_acks:
+                        self.send_acks = False
+                        self.clear_send_acks = False
+                        self.framer.verify_checksums = False
+
+                self.timeOfLastPacket = time()
+            finally:
                 self.lock.release()
 
-    def handleMsg(self, msg):
+            if detach:
+                self.flush()
+                return True
 
-        if msg[0] != '$':
-            self.logger.debug('msg ignored: first char != $')
-            return None, 0, 0
+        return False
 
-        self.logger.warning('GDB RSP packet: %s', msg)
+    def handleMsg(self, msg):
+        """Handle the (already decoded) payload of a packet."""
+        if not msg:
+            self.logger.debug('msg ignored: empty packet')
+            return self.createRSPPacket(""), 1, 0
+
+        self.logger.debug('GDB RSP packet: %s', msg)
 
         # query command
-        if msg[1] == '?':
+        if msg[0] == '?':
             return self.createRSPPacket(self.target.getTResponse()), 1, 0
             #return self.createRSPPacket("S05"), 1, 0
 
         # TODO make this right
-        if msg[1] == '!':
+        if msg[0] == '!':
         #    # Enable extended mode. In extended mode, the remote server is made
         #    # persistent. The 'R' packet is used to restart the program being
         #    # debugged.
@@ -271,57 +328,60 @@ class GDBServer(threading.Thread):
         #    #    pass
             return self.enableExtendedMode(), 1, 0
 
-        #elif msg[1] == 'B':
+        #elif msg[0] == 'B':
         #    return BLA
 
         # we don't send immediately the response for C and S commands
-        elif msg[1] == 'C' or msg[1] == 'c':
+        elif msg[0] == 'C' or msg[0] == 'c':
             return self.resume()
 
-        elif msg[1] == 'D':
-            return self.detach(msg[1:]), 1, 1
+        elif msg[0] == 'D':
+            return self.detach(msg), 1, 1
 
-        elif msg[1] == 'g':
+        elif msg[0] == 'g':
             return self.getRegisters(), 1, 0
 
-        elif msg[1] == 'G':
-            return self.setRegisters(msg[2:]), 1, 0
+        elif msg[0] == 'G':
+            return self.setRegisters(msg[1:]), 1, 0
 
-        elif msg[1] == 'H':
-            return self.handleSetThreadForSubsequentOps(msg[2:]), 1, 0
+        elif msg[0] == 'H':
+            return self.handleSetThreadForSubsequentOps(msg[1:]), 1, 0
 
-        elif msg[1] == 'k':
+        elif msg[0] == 'k':
             return self.kill(), 1, 1
 
-        elif msg[1] == 'm':
-            return self.getMemory(msg[2:]), 1, 0
+        elif msg[0] == 'm':
+            return self.getMemory(msg[1:]), 1, 0
 
-        elif msg[1] == 'M': # write memory with hex data
-            return self.writeMemoryHex(msg[2:]), 1, 0
+        elif msg[0] == 'M': # write memory with hex data
+            return self.writeMemoryHex(msg[1:]), 1, 0
 
-        elif msg[1] == 'p':
-            return self.readRegister(msg[2:]), 1, 0
+        elif msg[0] == 'p':
+            return self.readRegister(msg[1:]), 1, 0
 
-        elif msg[1] == 'P':
-            return self.writeRegister(msg[2:]), 1, 0
+        elif msg[0] == 'P':
+            return self.writeRegister(msg[1:]), 1, 0
 
-        elif msg[1] == 'q':
-            return self.handleQuery(msg[2:]), 1, 0
+        elif msg[0] == 'q':
+            return self.handleQuery(msg[1:]), 1, 0
 
-        elif msg[1] == 'Q':
-            return self.handleGeneralSet(msg[2:]), 1, 0
+        elif msg[0] == 'Q':
+            return self.handleGeneralSet(msg[1:]), 1, 0
 
-        elif msg[1] == 'S' or msg[1] == 's':
+        elif msg[0] == 'S' or msg[0] == 's':
             return self.single_step()
 
-        elif msg[1] == 'v':
-            return self.flashOp(msg[2:]), 1, 0
+        elif msg[0] == 'v':
+            return self.flashOp(msg[1:]), 1, 0
+
+        elif msg[0] == 'x': # read memory as binary data
+            return self.getMemoryBinary(msg[1:]), 1, 0
 
-        elif msg[1] == 'X': # write memory with binary data
-            return self.writeMemory(msg[2:]), 1, 0
+        elif msg[0] == 'X': # write memory with binary data
+            return self.writeMemory(msg[1:]), 1, 0
 
-        elif msg[1] == 'Z' or msg[1] == 'z':
-            return self.breakpoint(msg[1:]), 1, 0
+        elif msg[0] == 'Z' or msg[0] == 'z':
+            return self.breakpoint(msg), 1, 0
 
         else:
             self.logger.error("Unknown RSP packet: %s", msg)
@@ -359,10 +419,23 @@ class GDBServer(threading.Thread):
     def breakpoint(self, data):
         """Set or clear a breakpoint."""
         # handle breakpoint/watchpoint commands
-        split = data.split('#')[0].split(',')
+        params = data.split(';')
+        split = params[0].split(',')
         addr = int(split[1], 16)
         self.logger.info("GDB breakpoint %d @ %x" % (int(data[1]), addr))
 
+        # Conditions are evaluated by the target, the emulation only stops
+        # when one of them holds.
+        condition = None
+        if data[0] == 'Z' and data[1] in ('0', '1'):
+            try:
+                expressions = parse_condition_list(params[1:])
+            except (AgentExpressionError, TypeError, ValueError), err:
+                self.logger.error("Invalid breakpoint condition: %s", err)
+                return self.createRSPPacket('E01')
+            if expressions:
+                condition = BreakpointCondition(expressions)
+
         #self.logger.error(data)
         #self.logger.error(self.soft_bkpt_as_hard)
 
@@ -372,7 +445,7 @@ class GDBServer(threading.Thread):
                     # Empty response indicating no support for software breakpoints
                     return self.createRSPPacket("")
                 else:
-                    self.target.setBreakpoint(addr)
+                    self.target.setBreakpoint(addr, condition)
                     #self.target.resume(0)
                     return self.createRSPPacket("OK")
             else:
@@ -383,7 +456,7 @@ class GDBServer(threading.Thread):
         # and software breakpoint Z0/z0
         if data[1] == '1' or (self.soft_bkpt_as_hard and data[1] == '0'):
             if data[0] == 'Z':
-                if self.target.setBreakpoint(addr) == False:
+                if self.target.setBreakpoint(addr, condition) == False:
                     return self.createRSPPacket('E01') #EPERM
             else:
                 self.target.removeBreakpoint(addr)
@@ -411,51 +484,81 @@ class GDBServer(threading.Thread):
 
     def resume(self, count=0):
         """Resume the execution of the debugged binary."""
+        # The client must get the ack before the target stops.
         self.ack()
-        self.abstract_socket.setBlocking(0)
+        self.flush()
 
         self.logger.debug("Resuming target (count=%d)", count)
         self.target.resume(count)
 
+        return self.waitForHalt()
+
+    def waitForHalt(self):
+        """Wait until the running target halts (or the client interrupts
+        it) and return its stop reply.
+
+        The target runs on its own thread, so the client is served (Ctrl-C
+        included) while it runs.
+        """
         val = ''
 
-        self.timeOfLastPacket = time()
         while True:
             if self.shutdown_event.isSet():
                 return self.createRSPPacket(val), 0, 0
 
-            # Introduce a delay between non-blocking socket reads once we know
-            # that the CPU isn't going to halt quickly.
-            if time() - self.timeOfLastPacket > 0.5:
-                sleep(0.1)
+            if self.target.state == TARGET_HALTED:
+                self.logger.debug("State halted")
+                val = self.target.getTResponse()
+                break
+
+            # Sleep until the target halts or the client interrupts it.
+            if not self.waitReadable():
+                continue
+
             try:
                 data = self.abstract_socket.read()
-                if (data[0] == '\x03'):
-                    self.target.halt()
-                    val = self.target.getTResponse(True)
-                    self.logger.debug("Received CTRL-C")
-                    break
-            except:
-                pass
+            except socket.error:
+                data = ""
 
-            try:
-                if self.target.state == TARGET_HALTED:
-                    self.logger.error("State halted")
-                    val = self.target.getTResponse()
-                    val = "S05"
-                    break
-            except:
-                self.logger.debug('Target is temporary unavailable.')
-
-        self.abstract_socket.setBlocking(1)
-        print "--------->", val
+            if not data:
+                self.logger.info("Client disconnected")
+                self.detach_event.set()
+                self.target.halt()
+                break
+
+            # Anything but an interrupt is handled once the target stops.
+            interrupted = False
+            for event in self.framer.feed(data):
+                if event[0] == RSP_INTERRUPT:
+                    interrupted = True
+                else:
+                    self.pending_events.append(event)
+
+            if interrupted:
+                self.target.halt()
+                val = self.target.getTResponse(True)
+                self.logger.debug("Received CTRL-C")
+                break
+
+        self.logger.debug("Stop reply: %s", val)
         return self.createRSPPacket(val), 0, 0
 
     def single_step(self):
         self.ack()
+        self.flush()
         self.logger.debug("GDB step")
         self.target.single_step(not self.step_into_interrupt)
-        return self.createRSPPacket(self.target.getTResponse()), 0, 0
+        return self.waitForHalt()
+
+    def range_step(self, start, end):
+        """Step while the PC stays in [start, end), the whole range is
+        stepped in a single round trip.
+        """
+        self.ack()
+        self.flush()
+        self.logger.debug("GDB range step 0x%x-0x%x", start, end)
+        self.target.step_range(start, end)
+        return self.waitForHalt()
 
     def halt(self):
         self.ack()
@@ -528,16 +631,22 @@ class GDBServer(threading.Thread):
             ops = ops[4:]
             if '?' in ops:
                 # IDA-GDBServer sniff : $vCont;c;C;t;s;S;r
-                return self.createRSPPacket("vCont;c;s;t")
-            elif ';s' in ops:
-                self.target.resume(1)
-                return self.createRSPPacket(self.target.getTResponse())
-            elif ';c' in ops:
-                #self.ack()
+                return self.createRSPPacket("vCont;c;C;s;S;t;r")
+
+            # There's a single thread, only its (first) action matters.
+            action = ops.split(';')[1].split(':')[0] if ';' in ops else ''
+            if action[:1] in ('s', 'S'):
+                [resp, ack, detach] = self.single_step()
+                self.send(resp)
+                return None
+            elif action[:1] == 'r':
+                start, end = [int(x, 16) for x in action[1:].split(',')]
+                [resp, ack, detach] = self.range_step(start, end)
+                self.send(resp)
+                return None
+            elif action[:1] in ('c', 'C'):
                 [resp, ack, detach] = self.resume(0)
-                #return self.resume(0)
-                #return self.createRSPPacket("OK")#self.target.getTResponse())
-                self.abstract_socket.write(resp)
+                self.send(resp)
                 return None
 
         elif "MustReplyEmpty" in ops:
@@ -545,89 +654,117 @@ class GDBServer(threading.Thread):
 
         return self.createRSPPacket("")
 
-    def unescape(self, data):
-        data_idx = 0
-
-        # unpack the data into binary array
-        str_unpack = str(len(data)) + 'B'
-        data = unpack(str_unpack, data)
-        data = list(data)
+    def readMemory(self, addr, length):
+        """Read the target memory (or the memory collected by the selected
+        trace frame).
+        """
+        if self.trace_frame is not None:
+            return self.trace_frame.read_memory(addr, length)
 
-        # check for escaped characters
-        while data_idx < len(data):
-            if data[data_idx] == 0x7d:
-                data.pop(data_idx)
-                data[data_idx] = data[data_idx] ^ 0x20
-            data_idx += 1
-
-        return data
+        mem = self.target.readMemory(addr, length)
+        # Flush so an exception is thrown now if invalid memory was accesses
+        self.target.flush()
+        return mem
 
     def getMemory(self, data):
         split = data.split(',')
         addr = int(split[0], 16)
-        length = split[1].split('#')[0]
-        length = int(length,16)
+        # Every byte takes two hex digits.
+        length = min(int(split[1], 16), (self.packet_size - 4) / 2)
 
         if LOG_MEM:
             self.logger.debug("GDB getMemory: addr=%x len=%x", addr, length)
 
         try:
             val = ''
-            mem = self.target.readMemory(addr, length)
-            # Flush so an exception is thrown now if invalid memory was accesses
-            self.target.flush()
-            val = "".join([x.encode("hex") for x in mem])
+            mem = self.readMemory(addr, length)
+            if length and not mem:
+                raise TransferError()
+            val = hexEncode(mem)
         except TransferError:
             self.logger.debug("getMemory failed at 0x%x" % addr)
             val = 'E01' #EPERM
         return self.createRSPPacket(val)
 
-    def writeMemoryHex(self, data):
+    def getMemoryBinary(self, data):
+        """Read memory and send it as (escaped) binary data."""
         split = data.split(',')
         addr = int(split[0], 16)
+        # Room left for the data once framed (and prefixed).
+        limit = self.packet_size - 5
+        length = min(int(split[1], 16), limit)
 
-        split = split[1].split(':')
-        length = int(split[0], 16)
+        if LOG_MEM:
+            self.logger.debug("GDB getMemoryBinary: addr=%x len=%x", addr,
+                              length)
+
+        # GDB expects a 'b' prefix (it asks for 'binary-upload'), LLDB gets
+        # the data as it is and probes the support with an empty read.
+        if 'binary-upload+' in self.gdb_features:
+            prefix = 'b'
+        elif length == 0:
+            return self.createRSPPacket("OK")
+        else:
+            prefix = ''
+
+        try:
+            mem = self.readMemory(addr, length)
+            if length and not mem:
+                raise TransferError()
+        except TransferError:
+            self.logger.debug("getMemoryBinary failed at 0x%x" % addr)
+            return self.createRSPPacket('E01') #EPERM
+
+        # Escaping can make the reply too large, send less data if so.
+        val = rsp_escape(mem)
+        while len(val) > limit:
+            mem = mem[:len(mem) - (len(val) - limit)]
+            val = rsp_escape(mem)
 
-        split = split[1].split('#')
-        data = hexStringToIntList(split[0])
+        return self.createRSPPacket(prefix + val)
+
+    def writeMemoryHex(self, data):
+        colon = data.index(':')
+        split = data[:colon].split(',')
+        addr = int(split[0], 16)
+        length = int(split[1], 16)
 
         if LOG_MEM:
             self.logger.debug("GDB writeMemHex: addr=%x len=%x", addr, length)
 
         try:
-            if length > 0:
-                self.target.writeMemory(addr, str(data))
-                # Flush so an exception is thrown now if invalid memory was accessed
-                self.target.flush()
-            resp = "OK"
-        except TransferError:
-            self.logger.debug("writeMemory failed at 0x%x" % addr)
-            resp = 'E01' #EPERM
+            data = hexDecode(data[colon + 1:])
+        except TypeError:
+            self.logger.debug("writeMemory got invalid hex data")
+            return self.createRSPPacket('E01')
 
-        return self.createRSPPacket(resp)
+        return self.createRSPPacket(self.writeMemoryData(addr, length, data))
 
     def writeMemory(self, data):
-        split = data.split(',')
+        colon = data.index(':')
+        split = data[:colon].split(',')
         addr = int(split[0], 16)
-        length = int(split[1].split(':')[0], 16)
+        length = int(split[1], 16)
 
         if LOG_MEM:
             self.logger.debug("GDB writeMem: addr=%x len=%x", addr, length)
 
-        idx_begin = 0
-        for i in range(len(data)):
-            if data[i] == ':':
-                idx_begin += 1
-                break
-            idx_begin += 1
+        # The framer already unescaped the binary data.
+        data = data[colon + 1:]
 
-        data = data[idx_begin:len(data) - 3]
-        data = self.unescape(data)
+        return self.createRSPPacket(self.writeMemoryData(addr, length, data))
+
+    def writeMemoryData(self, addr, length, data):
+        """Write the decoded data of a M/X packet and return the reply."""
+        if len(data) != length:
+            self.logger.debug("writeMemory got %d bytes instead of %d",
+                              len(data), length)
+            return 'E01'
 
         try:
             if length > 0:
-                self.target.writeMemory(addr, data)
+                if not self.target.writeMemory(addr, data):
+                    raise TransferError()
                 # Flush so an exception is thrown now if invalid memory was accessed
                 self.target.flush()
             resp = "OK"
@@ -635,30 +772,38 @@ class GDBServer(threading.Thread):
             self.logger.debug("writeMemory failed at 0x%x" % addr)
             resp = 'E01' #EPERM
 
-        return self.createRSPPacket(resp)
+        return resp
 
     def readRegister(self, which):
-        return self.createRSPPacket(self.target.gdbGetRegister(which))
+        reg = int(which, 16)
+        if self.trace_frame is not None:
+            values = self.getTraceFrameRegisters()
+            return self.createRSPPacket(values[reg] if reg < len(values)
+                                        else 'E01')
+        return self.createRSPPacket(self.target.gdbGetRegister(reg))
 
     def writeRegister(self, data):
         reg = int(data.split('=')[0], 16)
-        val = data.split('=')[1].split('#')[0]
-        self.target.setRegister(reg, val)
+        val = data.split('=')[1]
+        if self.target.setRegister(reg, val) == False:
+            return self.createRSPPacket('E01')
         return self.createRSPPacket("OK")
 
     def getRegisters(self):
         """Return the complete list of registers."""
+        if self.trace_frame is not None:
+            return self.createRSPPacket("".join(self.getTraceFrameRegisters()))
         return self.createRSPPacket(self.target.getRegisterContext())
 
     def setRegisters(self, data):
         """Store the value of a list of registers."""
-        self.target.setRegisterContext(data[:-3])
+        self.target.setRegisterContext(data)
         return self.createRSPPacket("OK")
 
     def handleQuery(self, msg):
         """Handle query message from RSP client."""
 
-        query = msg[:-3].split(':')
+        query = msg.split(':')
         self.logger.debug('GDB received query: %s', query)
 
         if query is None:
@@ -667,17 +812,24 @@ class GDBServer(threading.Thread):
 
         if query[0] == 'Supported':
             # Save features sent by gdb.
-            #self.gdb_features = query[1].split(';') # WTF is this for?
+            self.gdb_features = query[1].split(';') if len(query) > 1 else []
 
             # Build our list of features.
             features = []
-            #features.append('qXfer:features:read+')
-            #features.append('QStartNoAckMode+') # TODO check this
+            if self.target.getTargetXML():
+                features.append('qXfer:features:read+')
+            features.append('QStartNoAckMode+')
+            features.append('binary-upload+')
+            features.append('ConditionalBreakpoints+')
+            if self.target.tracepoints is not None:
+                features.append('ConditionalTracepoints+')
+                features.append('EnableDisableTracepoints+')
+                features.append('QTBuffer:size+')
+                features.append('tracenz+')
             features.append('PacketSize=' + hex(self.packet_size)[2:])
             #if hasattr(self.target, 'memoryMapXML'):
             #    features.append('qXfer:memory-map:read+')
             resp = ';'.join(features)
-            print "========>", resp
             return self.createRSPPacket(resp)
 
         elif query[0] == 'fThreadInfo':
@@ -688,13 +840,13 @@ class GDBServer(threading.Thread):
             # Indicate there is no more information.
             return self.createRSPPacket("l")
 
-        #elif query[0] == 'Xfer':
+        elif query[0] == 'Xfer':
 
-        #    if query[1] == 'features' and query[2] == 'read' and \
-        #       query[3] == 'target.xml':
-        #        data = query[4].split(',')
-        #        resp = self.handleQueryXML('read_feature', int(data[0], 16), int(data[1].split('#')[0], 16))
-        #        return self.createRSPPacket(resp)
+            if query[1] == 'features' and query[2] == 'read' and \
+               query[3] == 'target.xml':
+                data = query[4].split(',')
+                resp = self.handleQueryXML('read_feature', int(data[0], 16), int(data[1], 16))
+                return self.createRSPPacket(resp)
 
         #    elif query[1] == 'memory-map' and query[2] == 'read':
         #        data = query[4].split(',')
@@ -704,7 +856,7 @@ class GDBServer(threading.Thread):
         #    else:
         #        return None
 
-        elif query[0] == 'C#b4':
+        elif query[0] == 'C':
             return self.createRSPPacket("")
 
         elif query[0].find('Attached') != -1:
@@ -715,11 +867,8 @@ class GDBServer(threading.Thread):
             self.logger.warning("Client issued a deprecated qL message.")
             return self.createRSPPacket("")
 
-        elif query[0].find('TStatus') != -1:
-            return self.createRSPPacket("")
-
-        elif query[0].find('Tf') != -1:
-            return self.createRSPPacket("")
+        elif query[0] in TRACE_QUERIES:
+            return self.createRSPPacket(self.handleTraceQuery(query))
 
         elif 'Offsets' in query[0]:
             resp = "Text=0;Data=0;Bss=0"
@@ -730,7 +879,7 @@ class GDBServer(threading.Thread):
             return self.createRSPPacket(resp)
 
         elif query[0].startswith('Rcmd,'):
-            cmd = hexDecode(query[0][5:].split('#')[0])
+            cmd = hexDecode(query[0][5:])
             self.logger.debug('Remote command: %s', cmd)
 
             safecmd = {
@@ -808,19 +957,230 @@ class GDBServer(threading.Thread):
 
     def handleGeneralSet(self, msg):
         self.logger.debug("GDB general set: %s", msg)
-        feature = msg.split('#')[0]
+        feature = msg
 
         if feature == 'StartNoAckMode':
             # Disable acks after the reply and ack.
             self.clear_send_acks = True
             return self.createRSPPacket("OK")
+        elif feature.startswith('T'):
+            return self.createRSPPacket(self.handleTraceSet(msg.split(':')))
         else:
             return self.createRSPPacket("")
 
+    def handleTraceSet(self, fields):
+        """Handle the QT (tracepoints) packets."""
+        tracing = self.target.tracepoints
+        if tracing is None:
+            return ""
+
+        command = fields[0][1:]
+        try:
+            if command == 'init':
+                tracing.clear()
+                self.trace_frame = None
+
+            elif command == 'DP':
+                return self.defineTracepoint(fields[1:])
+
+            elif command == 'DV':
+                tracing.define_variable(int(fields[1], 16), int(fields[2], 16))
+
+            elif command == 'Start':
+                self.trace_frame = None
+                tracing.start()
+
+            elif command == 'Stop':
+                tracing.stop()
+
+            elif command == 'Frame':
+                return self.selectTraceFrame(fields[1:])
+
+            elif command == 'Buffer':
+                if fields[1] == 'circular':
+                    tracing.buffer.circular = fields[2] == '1'
+                elif fields[1] == 'size' and fields[2] != '-1':
+                    tracing.buffer.size = int(fields[2], 16)
+
+            elif command in ('Enable', 'Disable'):
+                tracepoint = tracing.tracepoints.get(int(fields[1], 16))
+                if tracepoint is None:
+                    return 'E01'
+                tracepoint.enabled = command == 'Enable'
+
+            elif command not in ('DPsrc', 'ro', 'Disconnected', 'Notes'):
+                return ""
+
+        except (AgentExpressionError, IndexError, TypeError, ValueError), err:
+            self.logger.error("Invalid trace packet QT%s: %s", command, err)
+            return 'E01'
+
+        return 'OK'
+
+    def defineTracepoint(self, fields):
+        """Define a tracepoint (QTDP:n:addr:ena:step:pass[:Xlen,expr]) or
+        add actions to it (QTDP:-n:addr:actions).
+        """
+        tracing = self.target.tracepoints
+
+        if fields[0].startswith('-'):
+            tracepoint = tracing.tracepoints.get(int(fields[0][1:], 16))
+            if tracepoint is None:
+                return 'E01'
+
+            actions = ':'.join(fields[2:]).rstrip('-')
+            if actions.startswith('S'):
+                # While-stepping isn't supported, only the first frame of
+                # these tracepoints is collected.
+                self.logger.warning("Ignoring while-stepping actions of "
+                                    "tracepoint %d", tracepoint.number)
+                return 'OK'
+
+            self.addTracepointActions(tracepoint, actions)
+            return 'OK'
+
+        tracepoint = Tracepoint(int(fields[0], 16), int(fields[1], 16),
+                                fields[2] == 'E', int(fields[3], 16),
+                                int(fields[4].rstrip('-'), 16))
+
+        for field in fields[5:]:
+            field = field.rstrip('-')
+            if field.startswith('X'):
+                tracepoint.condition = parse_condition_list([field])[0]
+            elif field.startswith('F'):
+                # Fast tracepoints make no sense in an emulator.
+                return 'E01'
+
+        tracing.add_tracepoint(tracepoint)
+        return 'OK'
+
+    def addTracepointActions(self, tracepoint, actions):
+        """Add the collection actions (R, M and X) of a QTDP packet to a
+        tracepoint.
+        """
+        pos = 0
+        while pos < len(actions):
+            match = TRACE_ACTION.match(actions, pos)
+            if match is None:
+                raise ValueError("Invalid tracepoint action at %d" % pos)
+
+            mask, base, offset, length, expr_len = match.groups()
+            pos = match.end()
+
+            if mask is not None:
+                tracepoint.registers = int(mask, 16) != 0
+
+            elif base is not None:
+                # Memory relative to a register or absolute (-1).
+                base = int(base, 16)
+                if base in (-1, 0xFFFFFFFF):
+                    base = None
+                elif base >= len(self.target.register_list):
+                    raise ValueError("Invalid base register %d" % base)
+                tracepoint.memory.append((base, int(offset, 16),
+                                          int(length, 16)))
+
+            else:
+                end = pos + int(expr_len, 16) * 2
+                tracepoint.expressions.append(
+                    AgentExpression(hexDecode(actions[pos:end])))
+                pos = end
+
+    def selectTraceFrame(self, fields):
+        """Select the trace frame memory and registers are read from
+        (QTFrame:n, QTFrame:pc:addr, QTFrame:tdp:n, QTFrame:range:start:end
+        and QTFrame:outside:start:end).
+        """
+        tracing = self.target.tracepoints
+        start = self.trace_frame.number + 1 if self.trace_frame else 0
+
+        if fields[0] == 'pc':
+            addr = int(fields[1], 16)
+            number = tracing.find_frame(start, lambda tp: tp.address == addr)
+        elif fields[0] == 'tdp':
+            tdp = int(fields[1], 16)
+            number = tracing.find_frame(start, lambda tp: tp.number == tdp)
+        elif fields[0] in ('range', 'outside'):
+            low, high = int(fields[1], 16), int(fields[2], 16)
+            inside = fields[0] == 'range'
+            number = tracing.find_frame(start,
+                    lambda tp: (low <= tp.address <= high) == inside)
+        else:
+            number = int(fields[0], 16)
+            if number < 0 or number >= len(tracing.buffer):
+                number = None
+
+        if number is None:
+            self.trace_frame = None
+            return 'F-1'
+
+        self.trace_frame = tracing.frame(number)
+        return 'F%xT%x' % (number, self.trace_frame.tracepoint)
+
+    def getTraceFrameRegisters(self):
+        """Return the hexadecimal encoded registers of the selected trace
+        frame. Registers not collected are unavailable ('x'), except the PC
+        which is the tracepoint address.
+        """
+        registers = self.trace_frame.registers
+        values = []
+
+        if registers is not None:
+            offset = 0
+            for reg in self.target.register_list:
+                values.append(hexEncode(registers[offset:offset + reg.size]))
+                offset += reg.size
+
+        else:
+            values = ['xx' * reg.size for reg in self.target.register_list]
+            tracepoint = self.target.tracepoints.tracepoints.get(
+                self.trace_frame.tracepoint)
+            if tracepoint is not None:
+                pc = self.target.emu.registers.pc.gdb_number
+                values[pc] = hexEncode(self.target.register_structs[pc].pack(
+                    tracepoint.address))
+
+        return values
+
+    def handleTraceQuery(self, query):
+        """Handle the qT (tracepoints) queries."""
+        tracing = self.target.tracepoints
+        if tracing is None:
+            return ""
+
+        if query[0] == 'TStatus':
+            trace_buffer = tracing.buffer
+            return ";".join([
+                'T%d' % tracing.running,
+                '%s:%x' % (tracing.stop_reason, tracing.stop_tracepoint),
+                'tframes:%x' % len(trace_buffer),
+                'tcreated:%x' % trace_buffer.created,
+                'tfree:%x' % trace_buffer.free,
+                'tsize:%x' % trace_buffer.size,
+                'circular:%d' % trace_buffer.circular,
+                'disconn:0'])
+
+        elif query[0] == 'TP':
+            tracepoint = tracing.tracepoints.get(int(query[1], 16))
+            if tracepoint is None:
+                return 'E01'
+            return 'V%x:0' % tracepoint.hits
+
+        elif query[0] == 'TV':
+            number = int(query[1], 16)
+            if self.trace_frame is not None:
+                variables = self.trace_frame.variables
+            else:
+                variables = tracing.variables
+            if number not in variables:
+                return 'U'
+            return 'V%x' % (variables[number] & 0xFFFFFFFFFFFFFFFF)
+
+        # Nothing to upload (qTfP, qTsP, qTfV and qTsV).
+        return 'l'
+
     def handleQueryXML(self, query, offset, size):
-        print "X" * 200
         self.logger.debug('GDB query %s: offset: %s, size: %s', query, offset, size)
-        raise Exception("hola manola")
         xml = ''
         if query == 'memory_map':
             xml = self.target.memoryMapXML
@@ -833,7 +1193,7 @@ class GDBServer(threading.Thread):
 
         if offset > size_xml:
             self.logger.error('GDB: offset target.xml > size!')
-            return
+            return 'E01'
 
         if size > (self.packet_size - 4):
             size = self.packet_size - 4
@@ -850,21 +1210,19 @@ class GDBServer(threading.Thread):
 
 
     def createRSPPacket(self, data):
-        resp = '$' + data + '#'
-
-        c = 0
-        checksum = 0
-        for c in data:
-            checksum += ord(c)
-        checksum = checksum % 256
-        checksum = hex(checksum)
+        return "$%s#%02x" % (data, sum(bytearray(data)) & 0xFF)
 
-        if int(checksum[2:], 16) < 0x10:
-            resp += '0'
-        resp += checksum[2:]
+    def send(self, data):
+        """Queue data to be sent to the client by the next flush."""
+        self.out_buffer.append(data)
 
-        return resp
+    def flush(self):
+        """Send all the queued data with a single write."""
+        if self.out_buffer:
+            data = "".join(self.out_buffer)
+            del self.out_buffer[:]
+            self.abstract_socket.write(data)
 
     def ack(self):
         if self.send_acks:
-            self.abstract_socket.write("+")
+            self.send("+")
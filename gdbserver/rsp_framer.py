@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+__author__       = "Sebastian 'topo' Muniz"
+__copyright__   = "Copyright 2017"
+__credits__     = []
+__license__     = "GPL"
+__version__     = "0.1"
+__maintainer__  = "Sebastian Muniz"
+__email__       = "sebastianmuniz@gmail.com"
+__description__ = "Pimped out multi-architecture CPU emulator"
+
+__all__ = ["RSPFramer", "RSP_PACKET", "RSP_BAD_PACKET", "RSP_ACK", "RSP_NACK",
+        "RSP_INTERRUPT", "rsp_escape", "rsp_unescape", "rsp_run_length_decode"]
+
+# Events produced by the framer.
+RSP_PACKET = 0          # A complete packet, payload decoded.
+RSP_BAD_PACKET = 1      # Corrupted packet (checksum, encoding or size).
+RSP_ACK = 2             # '+'
+RSP_NACK = 3            # '-'
+RSP_INTERRUPT = 4       # '\x03' (Ctrl-C) received outside of a packet.
+
+# Framer states.
+_IDLE = 0
+_PACKET = 1
+_DISCARD = 2
+
+# Default maximum size of a packet payload (before decoding).
+RSP_MAX_PACKET_SIZE = 0x10000
+
+
+def rsp_escape(data):
+    """Escape the bytes of a binary payload that can't be sent as they are
+    ('#', '$', '}' and '*').
+    """
+    # '}' goes first, the others are escaped with it.
+    return data.replace('}', '}]').replace('#', '}\x03').replace(
+            '$', '}\x04').replace('*', '}\x0a')
+
+
+def rsp_unescape(data):
+    """Decode the '}' escaped bytes of a binary payload."""
+    if '}' not in data:
+        return data
+
+    parts = data.split('}')
+    decoded = [parts[0]]
+    for part in parts[1:]:
+        if not part:
+            raise ValueError("Truncated escape sequence")
+        decoded.append(chr(ord(part[0]) ^ 0x20))
+        decoded.append(part[1:])
+
+    return "".join(decoded)
+
+
+def rsp_run_length_decode(data):
+    """Expand the '*' run-length encoded sequences of a payload."""
+    if '*' not in data:
+        return data
+
+    decoded = []
+    last = None
+    pos = 0
+    while True:
+        idx = data.find('*', pos)
+        if idx == -1:
+            decoded.append(data[pos:])
+            break
+
+        if idx > pos:
+            decoded.append(data[pos:idx])
+            last = data[idx - 1]
+
+        if last is None or idx + 1 >= len(data):
+            raise ValueError("Invalid run-length encoding")
+
+        # The character after '*' encodes the number of extra repetitions.
+        decoded.append(last * (ord(data[idx + 1]) - 29))
+        pos = idx + 2
+
+    return "".join(decoded)
+
+
+class RSPFramer(object):
+    """Incremental framer for the GDB Remote Serial Protocol.
+
+    Bytes received from the client are fed as they come and the framer
+    returns the events found in them: complete packets (checksum verified,
+    run-length decoded and unescaped), corrupted packets, acks, nacks and
+    interrupts. Garbage outside of packets is dropped right away and packets
+    larger than `max_packet_size` are discarded, so the memory used is
+    bounded.
+
+    Checksums can be left unverified (`verify_checksums`) once the client
+    agreed on no-ack mode, as the transport is reliable.
+    """
+
+    def __init__(self, max_packet_size=RSP_MAX_PACKET_SIZE):
+        self.max_packet_size = max_packet_size
+        self.verify_checksums = True
+        self.reset()
+
+    def reset(self):
+        """Forget any partially received packet."""
+        self._buffer = ""
+        self._state = _IDLE
+
+    def feed(self, data):
+        """Process the received bytes and return the list of events (tuples
+        of event type and payload) completed by them.
+        """
+        events = []
+        buf = self._buffer + data
+        pos = 0
+
+        while pos < len(buf):
+            if self._state == _IDLE:
+                start = buf.find('$', pos)
+                end = len(buf) if start == -1 else start
+
+                # Only acks and interrupts matter outside of packets.
+                for c in buf[pos:end]:
+                    if c == '+':
+                        events.append((RSP_ACK, None))
+                    elif c == '-':
+                        events.append((RSP_NACK, None))
+                    elif c == '\x03':
+                        events.append((RSP_INTERRUPT, None))
+
+                if start == -1:
+                    pos = len(buf)
+                    break
+
+                self._state = _PACKET
+                pos = start + 1
+
+            end = buf.find('#', pos)
+
+            if self._state == _DISCARD:
+                # Skip the rest of an oversized packet, checksum included.
+                if end == -1:
+                    pos = len(buf)
+                    break
+                if end + 3 > len(buf):
+                    pos = end
+                    break
+                self._state = _IDLE
+                pos = end + 3
+                continue
+
+            if end == -1 or end + 3 > len(buf):
+                if len(buf) - pos > self.max_packet_size + 3:
+                    events.append((RSP_BAD_PACKET, None))
+                    self._state = _DISCARD
+                    pos = len(buf) if end == -1 else end
+                    continue
+                break
+
+            self._state = _IDLE
+            events.append(self._decode(buf[pos:end], buf[end + 1:end + 3]))
+            pos = end + 3
+
+        self._buffer = buf[pos:]
+        return events
+
+    def _decode(self, payload, checksum):
+        """Verify and decode a packet payload and return its event."""
+        if len(payload) > self.max_packet_size:
+            return (RSP_BAD_PACKET, None)
+
+        try:
+            if self.verify_checksums and \
+                    int(checksum, 16) != sum(bytearray(payload)) & 0xFF:
+                return (RSP_BAD_PACKET, None)
+
+            return (RSP_PACKET, rsp_unescape(rsp_run_length_decode(payload)))
+
+        except ValueError:
+            return (RSP_BAD_PACKET, None)
@@ -10,7 +10,12 @@ __email__       = "sebastianmuniz@gmail.com"
 __description__ = "Pimped out multi-architecture CPU emulator"
 
 from traceback import format_exc
+from bisect import bisect_right, insort
+import ctypes
 import logging
+import mmap
+import os
+import struct
 
 import unicorn as uc
 
@@ -23,9 +28,22 @@ import capstone as cs
 
 import colorlog
 
-__all__ = ["PimpMyRide", "PimpMyRideException", "LOG_LEVELS"]
+from utility.conversion import uint64_array
+from utility.memory_map import MemoryMap
+from utility.registers import get_register_table
+
+__all__ = ["PimpMyRide", "PimpMyRideException", "LOG_LEVELS", "TRACE_LEVELS",
+        "TRACE_OFF", "TRACE_BREAKPOINTS", "TRACE_PC", "TRACE_FULL",
+        "WATCH_READ", "WATCH_WRITE", "WATCH_ACCESS"]
 
 PAGE_SIZE = 0x1000 # Default page size is 4KB
+PAGE_SHIFT = 12
+
+MAX_ADDRESS = (1 << 64) - 1
+
+# Lazy memory areas are mapped by (aligned) chunks of this size on first
+# touch, so a sequential scan doesn't fault on every page.
+LAZY_CHUNK_SIZE = 0x10000
 
 COMPILE_GCC = 0
 COMPILE_MSVC = 1
@@ -38,11 +56,84 @@ LOG_LEVELS = {
     'critical': logging.CRITICAL
 }
 
+# Instruction tracing tiers. Every tier only installs the hooks it needs.
+TRACE_OFF = 0           # No hooks at all (breakpoints are ignored).
+TRACE_BREAKPOINTS = 1   # Address-ranged hooks on the breakpoints only.
+TRACE_PC = 2            # Breakpoints + executed PCs stored in a buffer.
+TRACE_FULL = 3          # Breakpoints + registers and disassembly logging.
+
+TRACE_LEVELS = {
+    'off': TRACE_OFF,
+    'breakpoints': TRACE_BREAKPOINTS,
+    'pc': TRACE_PC,
+    'full': TRACE_FULL
+}
+
+# Default number of PCs kept by the TRACE_PC tier.
+PC_TRACE_SIZE = 0x100000
+
+# Watchpoint kinds (the accesses they stop on).
+WATCH_READ = 1
+WATCH_WRITE = 2
+WATCH_ACCESS = WATCH_READ | WATCH_WRITE
+
+# Largest memory access of an instruction. Memory hooks are matched on the
+# start address of the accesses, watchpoint hooks begin this much earlier to
+# catch the accesses overlapping their range.
+MAX_ACCESS_SIZE = 16
+
+# Thumb state bit of the ARM CPSR.
+CPSR_THUMB = 0x20
+
 class PimpMyRideException(Exception):
     """Generic exception for PimpMyRide."""
     pass
 
 
+class Snapshot(object):
+    """Emulator state saved by PimpMyRide.snapshot()."""
+
+    def __init__(self, context, mappings, regions, start_address):
+        self.context = context              # Unicorn CPU context.
+        self.mappings = mappings            # Unicorn (begin, end, perms).
+        self.regions = regions              # (start, end, content) tuples.
+        self.start_address = start_address
+
+        self._starts = [start for start, end, content in regions]
+
+    def page(self, address):
+        """Return the saved contents of the page at the specified address."""
+        start, end, content = self.regions[
+            bisect_right(self._starts, address) - 1]
+        offset = address - start
+        return content[offset:offset + PAGE_SIZE]
+
+
+class HostRegion(object):
+    """Host memory (an anonymous or file-backed mmap) backing a range of the
+    emulator memory. Unicorn works on it directly (mem_map_ptr).
+    """
+
+    def __init__(self, address, backing, filename=None):
+        self.address = address
+        self.size = len(backing)
+        self.backing = backing
+        self.filename = filename        # Backing file (None if anonymous).
+
+        # ctypes view of the buffer, it gives its host address and keeps it
+        # exported (an exported mmap can't be closed or resized).
+        self.view = (ctypes.c_ubyte * self.size).from_buffer(backing)
+
+    @property
+    def pointer(self):
+        """Return the host address of the buffer."""
+        return ctypes.addressof(self.view)
+
+    def __repr__(self):
+        return "<HostRegion 0x%08X-0x%08X>" % (self.address,
+                                              self.address + self.size)
+
+
 class PimpMyRide(object):
     """
     Main class implementing the multi-architecture CPU emulator with debugging
@@ -76,15 +167,40 @@ class PimpMyRide(object):
 
         self.__memory_areas = []
         self.__memory_contents = []
+        self.__memory_files = []
+
+        # Pages of the lazy memory areas, mapped on first touch.
+        self.__lazy_index = MemoryMap()
+        self.__lazy_hook = None
+
+        # Host buffers backing the mapped memory, by address.
+        self.__host_regions = dict()
+        self.__host_starts = []
+
+        # Index of the address ranges currently mapped in Unicorn.
+        self.__memory_index = MemoryMap()
 
         self.stack = self._align_address(stack)
         self.stack_size = stack_size
 
         self.compiler = compiler
 
-        self.breakpoints = list()
+        self.breakpoints = set()
         self.breakpoints_callback = list()
 
+        # Breakpoint address to the condition it needs to hold to stop.
+        self.breakpoint_conditions = dict()
+
+        # Watchpoints as (address, size, kind) tuples and the (kind, address)
+        # of the one that stopped the last emulation (None if none did).
+        self.watchpoints = set()
+        self.watchpoint_hit = None
+
+        # Number of emulations (emu_start calls) since init() and the
+        # functions called before each one of them.
+        self.emulations = 0
+        self.__start_callbacks = list()
+
         # Convert IDA architectures IDs to our own.
         if architecture == "ppc": # FIXME : pyelftools does not recognize
                                     # PowerPC architecture, hence does not
@@ -157,6 +273,40 @@ class PimpMyRide(object):
         self.__regs = dict()
         self.__hooks = dict()
 
+        # Registers of the current architecture and their Unicorn ids.
+        self.__registers = get_register_table(cur_arch, cur_mode)
+        self.__register_ids = self.__registers.ids
+
+        # Instruction tracing settings and the Unicorn handles of the hooks
+        # installed for them.
+        self.__trace_level = TRACE_OFF
+        self.__trace_hooks = list()
+        self.__breakpoint_hooks = dict()
+        self.__watchpoint_hooks = dict()
+
+        # Pages written since the last snapshot was taken or restored.
+        self.__snapshot_base = None
+        self.__dirty_pages = set()
+        self.__dirty_hook = None
+
+        # Address functions executed by call() return to.
+        self.__return_sentinel = None
+
+        # Breakpoint to ignore once when resuming from its own address.
+        self.__resume_breakpoint = None
+
+        # Address to step out of (once) before stopping on a range exit.
+        self.__range_step_skip = None
+
+        # Memory contents overwritten by the access a watchpoint stopped, and
+        # whether the watchpoints are ignored (while completing that access).
+        self.__watchpoint_undo = None
+        self.__watchpoint_skip = False
+
+        # Executed PCs recorded by the TRACE_PC tier.
+        self.pc_trace_size = PC_TRACE_SIZE
+        self.pc_trace = uint64_array()
+
         # Setup the register configuration.
         self._setup_registers()
 
@@ -200,15 +350,88 @@ class PimpMyRide(object):
                     "Invalid memory content size specified (%d)" % size)
         self.__memory_contents.append([address, content])
 
-    def add_memory_area(self, address, size):
-        """Add a memory region for the code emulation."""
-        # Add the areas as a tuple (addr, size) unless we can think of a better
-        # way to do it.
+    def add_memory_area(self, address, size, perm=uc.UC_PROT_ALL,
+                        lazy=False):
+        """Add a memory region for the code emulation.
+
+        The pages of a lazy area are only mapped (and filled with their
+        contents) when first accessed.
+        """
+        # Add the areas as a list [addr, size, perm, lazy] unless we can
+        # think of a better way to do it.
         # TODO : Validate area is valid for current architecture
         if size <= 0:
             raise PimpMyRideException(
                     "Invalid memory area size specified (%d)" % size)
-        self.__memory_areas.append([address, size])
+        self.__memory_areas.append([address, size, perm, lazy])
+
+        if lazy:
+            self.__lazy_index.add(*self.__memory_area_range(address, size))
+
+        # Areas added once the emulator is running are mapped right away.
+        if self.__uc is not None:
+            if not lazy:
+                self.__map_memory_area(address, size, perm)
+            elif self.__lazy_hook is None:
+                self.__lazy_hook = self.__uc.hook_add(
+                    uc.UC_HOOK_MEM_UNMAPPED, self.__lazy_page_callback)
+
+    def add_memory_file(self, address, filename, offset=0, size=None):
+        """Add the contents of a memory region: `size` bytes (the rest of the
+        file if None) of a file from the specified offset on, like an ELF
+        PT_LOAD segment.
+
+        The pages entirely covered by the region are mapped from the file
+        (copy-on-write) instead of being copied, the rest is copied. Like
+        add_memory_content(), the region must lie within memory areas.
+        """
+        file_size = os.path.getsize(filename)
+        if size is None:
+            size = file_size - offset
+
+        if size <= 0 or offset + size > file_size:
+            raise PimpMyRideException(
+                    "Invalid range 0x%X-0x%X of %s" % (
+                        offset, offset + size, filename))
+
+        self.__memory_files.append((address, filename, offset, size))
+
+        if self.__uc is not None:
+            self.__write_memory_file_edges(address, filename, offset, size)
+
+    def remove_memory_area(self, address, size):
+        """Remove a memory region previously added for the code emulation."""
+        areas = [area for area in self.__memory_areas
+                 if area[:2] == [address, size]]
+        if not areas:
+            raise PimpMyRideException(
+                    "Unknown memory area 0x%08X (size 0x%X)" % (address, size))
+        self.__memory_areas.remove(areas[0])
+
+        if areas[0][3]:
+            self.__lazy_index.clear()
+            for address_, size_, perm, lazy in self.__memory_areas:
+                if lazy:
+                    self.__lazy_index.add(
+                        *self.__memory_area_range(address_, size_))
+
+        if self.__uc is not None:
+            # Pages shared with a remaining area stay mapped.
+            remaining = MemoryMap()
+            for address_, size_, perm, lazy in self.__memory_areas:
+                remaining.add(*self.__memory_area_range(address_, size_))
+
+            address_aligned, size = self.__memory_area_range(address, size)
+            for gap_start, gap_end in remaining.gaps(
+                    address_aligned, address_aligned + size):
+                for start, end in self.__memory_index.intersection(
+                        gap_start, gap_end):
+                    self._memory_unmap(start, end - start)
+
+    @property
+    def memory_map(self):
+        """Return the index of the memory ranges mapped in the emulator."""
+        return self.__memory_index
 
     @property
     def start_address(self):
@@ -222,7 +445,9 @@ class PimpMyRide(object):
 
     @property
     def return_address(self):
-        """Return the return address."""
+        """Return the return address (None stops the emulation at the
+        address call() returns to, which no code reaches by itself).
+        """
         return self._return_address
 
     @return_address.setter
@@ -231,9 +456,18 @@ class PimpMyRide(object):
         self._return_address = address
 
     def stop(self):
-        """Stop the emulation phase."""
-        # TODO
-        pass
+        """Stop the emulation phase.
+
+        It can be called from any thread, the emulation stops as soon as the
+        current translation block is over.
+        """
+        if self.__uc is None:
+            return
+
+        try:
+            self.__uc.emu_stop()
+        except uc.UcError, err:
+            self.logger.debug("Cannot stop the emulation: %s", err)
 
     def init(self):
         """Initialize emulator settings previous to its usage."""
@@ -249,17 +483,24 @@ class PimpMyRide(object):
         if self.start_address is None:
             raise PimpMyRideException("Start address not specified")
 
-        if self.return_address is None:
-            raise PimpMyRideException("Return address not specified")
-
         if not len(self.__memory_areas):
             raise PimpMyRideException("No memory areas specified")
 
-        if not len(self.__memory_contents):
+        if not len(self.__memory_contents) and not len(self.__memory_files):
             raise PimpMyRideException("No memory contents specified")
 
         # Create a new Unicorn instance.
         self.__uc = uc.Uc(self.architecture, self.mode)
+        self.__memory_index.clear()
+        self.__host_regions.clear()
+        del self.__host_starts[:]
+
+        self.__snapshot_base = None
+        self.__dirty_pages.clear()
+        self.__dirty_hook = None
+        self.__lazy_hook = None
+        self.__return_sentinel = None
+        self.emulations = 0
 
         # Create a new Capstone instance.
         self.__cs = cs.Cs(self._cs_arch, self._cs_mode) 
@@ -269,18 +510,38 @@ class PimpMyRide(object):
         #
         self.__initialize_memory()
 
+        # Map the return address used by call() now so that snapshots taken
+        # before the first call already include it.
+        self.__return_sentinel_address()
+
         #
         # Inialize the emulator hooks.
         #
         self.__initialize_hooks()
 
         #
-        # Inialize the emulated CPU registers.
+        # Inialize the emulated CPU registers (the PC unless the user set it).
         #
+        self.__uc.reg_write(self.REG_PC, self.start_address)
         self.__initialize_registers()
 
+    def __current_address(self):
+        """Return the address the emulation resumes from: the PC, which the
+        user (or the debugger) may have changed since the last emulation.
+        """
+        pc = self.__uc.reg_read(self.REG_PC)
+
+        # Unicorn only keeps executing Thumb code if told with the low bit.
+        if self.architecture == uc.UC_ARCH_ARM and \
+                self.__uc.reg_read(UC_ARM_REG_CPSR) & CPSR_THUMB:
+            pc |= 1
+
+        return pc
+
     def start(self, count=0, timeout=0):
-        """Start the emulation phase with the parameters previously defined."""
+        """Start the emulation phase from the current PC."""
+        self.start_address = self.__current_address()
+
         #
         # Proceed to the emulation phase.
         #
@@ -288,10 +549,20 @@ class PimpMyRide(object):
             self.logger.info("Starting emulation at 0x%08X (count=%d)" % (
                     self.start_address, count))
 
-            self.__uc.emu_start(self.start_address,
-                                self.return_address,
-                                timeout,
-                                count)
+            # Do not stop again on the breakpoint we are resuming from.
+            pc = self.__uc.reg_read(self.REG_PC)
+            if pc in self.breakpoints:
+                self.__resume_breakpoint = pc
+
+            self.watchpoint_hit = None
+
+            self.__emu_start(self.start_address,
+                             self.__stop_address(),
+                             timeout,
+                             count)
+
+            if self.watchpoint_hit is not None:
+                self.__complete_watched_access()
 
         except uc.UcError, err:
             self.logger.debug(format_exc())
@@ -301,7 +572,305 @@ class PimpMyRide(object):
 
             #raise PimpMyRideException(err)
 
+        self.__resume_breakpoint = None
+
+    def __stop_address(self):
+        """Return the address start() stops at."""
+        if self.return_address is not None:
+            return self.return_address
+        return self.__return_sentinel_address()
+
+    def __emu_start(self, begin, until, timeout=0, count=0):
+        """Run an emulation, every emulation goes through here."""
+        for callback_fn in self.__start_callbacks:
+            callback_fn(self)
+
+        self.emulations += 1
+        self.__uc.emu_start(begin, until, timeout, count)
+
+    def add_start_callback(self, callback_fn):
+        """Call `callback_fn(emu)` before every emulation starts."""
+        self.__start_callbacks.append(callback_fn)
+
+    def remove_start_callback(self, callback_fn):
+        """Remove a callback added by add_start_callback()."""
+        self.__start_callbacks.remove(callback_fn)
+
+    def __complete_watched_access(self):
+        """Execute the instruction a watchpoint stopped on.
+
+        Stopping from a memory hook interrupts the instruction right after
+        its access, leaving the PC on it. The access is undone and the
+        instruction executed again (ignoring the watchpoints) so it's
+        executed exactly once and the PC is past it, like GDB expects.
+        """
+        pc = self.__uc.reg_read(self.REG_PC)
+
+        if self.__watchpoint_undo is not None:
+            address, content = self.__watchpoint_undo
+            self.__uc.mem_write(address, content)
+
+        if pc in self.breakpoints:
+            self.__resume_breakpoint = pc
+
+        self.__watchpoint_skip = True
+        try:
+            self.__emu_start(pc, self.__stop_address(), 0, 1)
+        finally:
+            self.__watchpoint_skip = False
+            self.__watchpoint_undo = None
+            self.__resume_breakpoint = None
+
+    def step_range(self, start, end, timeout=0):
+        """Emulate from the current address while the PC stays in the range
+        [start, end), at least one instruction is always executed.
+
+        Only the addresses outside of the range are hooked, so the code in
+        it runs at full speed until it jumps out (or hits a breakpoint).
+        """
+        pc = self.__uc.reg_read(self.REG_PC)
+        if not start <= pc < end:
+            self.__range_step_skip = pc
+
+        hooks = list()
+        try:
+            if start > 0:
+                hooks.append(self.__uc.hook_add(uc.UC_HOOK_CODE,
+                        self.__range_step_callback, None, 0, start - 1))
+            hooks.append(self.__uc.hook_add(uc.UC_HOOK_CODE,
+                    self.__range_step_callback, None, end, MAX_ADDRESS))
+
+            self.start(timeout=timeout)
+
+        finally:
+            for handle in hooks:
+                self.__uc.hook_del(handle)
+            self.__range_step_skip = None
+
+    def snapshot(self):
+        """Save the CPU context and the contents of the mapped memory.
+
+        From then on, every page written by the emulated code is tracked so
+        restoring this snapshot only has to rewrite those pages.
+        """
+        if self.__uc is None:
+            raise PimpMyRideException("Emulator not initialized")
+
+        regions = list()
+        for start, end in self.__memory_index.regions():
+            regions.append(
+                (start, end, str(self.__uc.mem_read(start, end - start))))
+
+        snapshot = Snapshot(self.__uc.context_save(),
+                            list(self.__uc.mem_regions()),
+                            regions,
+                            self.start_address)
+
+        if self.__dirty_hook is None:
+            self.__dirty_hook = self.__uc.hook_add(
+                uc.UC_HOOK_MEM_WRITE, self.__dirty_page_callback)
+
+        self.__snapshot_base = snapshot
+        self.__dirty_pages.clear()
+
+        return snapshot
+
+    def restore(self, snapshot):
+        """Bring the emulator back to the state saved in the snapshot.
+
+        Restoring the last snapshot taken (or restored) only rewrites the
+        pages written since then. Any other snapshot is compared page by page
+        with the current memory contents.
+        """
+        if self.__uc is None:
+            raise PimpMyRideException("Emulator not initialized")
+
+        if list(self.__uc.mem_regions()) != snapshot.mappings:
+            self.__unmap_lazy_pages(snapshot)
+
+        if list(self.__uc.mem_regions()) != snapshot.mappings:
+            self.__restore_mappings(snapshot)
+
+        elif snapshot is self.__snapshot_base:
+            for page in self.__dirty_pages:
+                address = page << PAGE_SHIFT
+                self.__uc.mem_write(address, snapshot.page(address))
+
+        else:
+            for start, end, content in snapshot.regions:
+                current = self.__uc.mem_read(start, end - start)
+                if current == content:
+                    continue
+
+                for offset in xrange(0, end - start, PAGE_SIZE):
+                    page = content[offset:offset + PAGE_SIZE]
+                    if current[offset:offset + PAGE_SIZE] != page:
+                        self.__uc.mem_write(start + offset, page)
+
+        self.__snapshot_base = snapshot
+        self.__dirty_pages.clear()
+
+        self.__uc.context_restore(snapshot.context)
+        self.start_address = snapshot.start_address
+
+    def __unmap_lazy_pages(self, snapshot):
+        """Unmap the lazy pages mapped since the snapshot was taken, they're
+        mapped again (with their initial contents) when touched.
+        """
+        mappings = set(snapshot.mappings)
+        for begin, end, perms in list(self.__uc.mem_regions()):
+            end += 1
+            if (begin, end - 1, perms) in mappings or \
+                    not self.__lazy_index.contains(begin, end):
+                continue
+
+            self._memory_unmap(begin, end - begin)
+            self.__dirty_pages.difference_update(
+                xrange(begin >> PAGE_SHIFT, end >> PAGE_SHIFT))
+
+    def __restore_mappings(self, snapshot):
+        """Map the memory layout saved in the snapshot from scratch."""
+        self.logger.debug("Memory layout changed, remapping all the memory.")
+
+        for begin, end, perms in list(self.__uc.mem_regions()):
+            self._memory_unmap(begin, end - begin + 1)
+
+        for begin, end, perms in snapshot.mappings:
+            self._memory_map(begin, end - begin + 1, perms)
+
+        for start, end, content in snapshot.regions:
+            self.__uc.mem_write(start, content)
+
+    def __dirty_page_callback(self, _uc, access, address, size, value, user_data):
+        """Built-in callback keeping track of the pages written."""
+        self.__dirty_pages.add(address >> PAGE_SHIFT)
+        self.__dirty_pages.add((address + size - 1) >> PAGE_SHIFT)
+
+    def call(self, address, *args, **kwargs):
+        """Call the function at the specified address and return the value
+        of its result register.
+
+        The arguments are passed according to the current ABI (REG_ARGS first,
+        then the stack) and the function returns to a sentinel address where
+        the emulation stops. The optional `count` and `timeout` keywords limit
+        the emulation like in start().
+        """
+        if self.__uc is None:
+            raise PimpMyRideException("Emulator not initialized")
+
+        sentinel = self.__setup_call(address, args)
+
+        try:
+            self.__emu_start(address, sentinel,
+                             kwargs.get("timeout", 0),
+                             kwargs.get("count", 0))
+
+        except uc.UcError, err:
+            raise PimpMyRideException(
+                "Emulation error calling 0x%08X : %s" % (address, err))
+
+        pc = self.__uc.reg_read(self.REG_PC)
+        if pc != sentinel:
+            raise PimpMyRideException(
+                "Function at 0x%08X did not return (stopped at 0x%08X)" % (
+                address, pc))
+
+        return self.__uc.reg_read(self.REG_RES)
+
+    def call_many(self, address, args_list, **kwargs):
+        """Call the function at the specified address once per arguments
+        tuple and return the list of results.
+
+        A snapshot of the emulator is taken before the first call and
+        restored before each one of them, so every call starts from the same
+        state with no setup cost besides the pages it dirtied.
+        """
+        if self.__uc is None:
+            raise PimpMyRideException("Emulator not initialized")
+
+        snapshot = self.snapshot()
+
+        results = list()
+        for args in args_list:
+            self.restore(snapshot)
+            results.append(self.call(address, *args, **kwargs))
+
+        return results
+
+    def __setup_call(self, address, args):
+        """Set the arguments and the return address for a call to the
+        function at the specified address and return the sentinel address
+        the function will return to.
+        """
+        sentinel = self.__return_sentinel_address()
+
+        if self.REG_CALL is not None:
+            self.__uc.reg_write(self.REG_CALL, address)
+
+        mask = (1 << (self.step * 8)) - 1
+        fmt = self.pack_endian + self.pack_format
+
+        reg_args = args[:len(self.REG_ARGS)]
+        stack_args = args[len(self.REG_ARGS):]
+
+        for reg, value in zip(self.REG_ARGS, reg_args):
+            self.__uc.reg_write(reg, value & mask)
+
+        # Stack arguments go above the area some ABIs reserve for the register
+        # arguments (MIPS home space, MSVC shadow space).
+        frame = "\x00" * self.STACK_ARGS_OFFSET
+        frame += "".join([struct.pack(fmt, value & mask) for value in stack_args])
+
+        sp = self.stack + self.stack_size * PAGE_SIZE - len(frame)
+        sp &= ~0xF
+
+        if self.REG_RA:
+            self.__uc.reg_write(self.REG_RA, sentinel)
+        else:
+            # The return address is pushed on the stack (x86).
+            sp -= self.step
+            frame = struct.pack(fmt, sentinel) + frame
+
+        # Through write_memory() so restoring a snapshot undoes the frame.
+        self.write_memory(sp, frame)
+        self.__uc.reg_write(self.REG_SP, sp)
+
+        return sentinel
+
+    def __return_sentinel_address(self):
+        """Return the address functions called by call() return to, mapping
+        an unused page for it if necessary.
+        """
+        sentinel = self.__return_sentinel
+        if sentinel is not None and self.__memory_index.find(sentinel):
+            return sentinel
+
+        # Emulation stops before fetching from the sentinel but it still has
+        # to be mapped. Never use the first page so NULL accesses still fail,
+        # nor the pages of lazy areas.
+        for start, end in self.__memory_index.gaps(PAGE_SIZE,
+                                                   1 << (self.step * 8)):
+            gaps = self.__lazy_index.gaps(start, end)
+            if gaps:
+                sentinel = gaps[0][0]
+                break
+        else:
+            raise PimpMyRideException("No free memory for the return address")
+
+        self._memory_map(sentinel, PAGE_SIZE)
+        self.__return_sentinel = sentinel
+
+        return sentinel
+
     def _setup_registers(self):
+        # Bytes reserved on the stack by the caller before the arguments not
+        # passed in registers.
+        self.STACK_ARGS_OFFSET = 0
+
+        # Register holding the address of the function called by call(), for
+        # the ABIs whose code expects it.
+        self.REG_CALL = None
+
         if self.architecture == uc.UC_ARCH_X86:
             self.pack_endian = '<'
             if self.mode == uc.UC_MODE_16:
@@ -332,6 +901,7 @@ class PimpMyRide(object):
                             UC_X86_REG_R8, UC_X86_REG_R9]
                 elif self.compiler == COMPILE_MSVC:
                     self.REG_ARGS = [UC_X86_REG_RCX, UC_X86_REG_RDX, UC_X86_REG_R8, UC_X86_REG_R9]
+                    self.STACK_ARGS_OFFSET = 0x20
 
         elif self.architecture == uc.UC_ARCH_ARM:
             #
@@ -368,18 +938,25 @@ class PimpMyRide(object):
             #
             # MIPS architecture definitions.
             #
-            self.pack_endian = '<'
-            if self.mode == uc.UC_MODE_MIPS32:
-                self.step = 4
-                self.pack_format = 'I'
-            elif self.mode == uc.UC_MODE_MIPS64:
+            if self.mode & uc.UC_MODE_BIG_ENDIAN:
+                self.pack_endian = '>'
+            else:
+                self.pack_endian = '<'
+            if self.mode & uc.UC_MODE_MIPS64:
                 self.step = 8
                 self.pack_format = 'Q'
+            else:
+                self.step = 4
+                self.pack_format = 'I'
             self.REG_PC = UC_MIPS_REG_PC
             self.REG_SP = UC_MIPS_REG_SP
             self.REG_RA = UC_MIPS_REG_RA
             self.REG_RES = UC_MIPS_REG_V0
             self.REG_ARGS = [UC_MIPS_REG_A0, UC_MIPS_REG_A1, UC_MIPS_REG_A2, UC_MIPS_REG_A3]
+            self.STACK_ARGS_OFFSET = len(self.REG_ARGS) * self.step
+
+            # PIC code computes $gp from $t9 in its prologue.
+            self.REG_CALL = UC_MIPS_REG_T9
 
     def _align_address(self, address):
         """Align the specified address to a page boundary."""
@@ -389,50 +966,243 @@ class PimpMyRide(object):
         """Initialize the emulator memory with the appropriate ranges and
         contents.
         """
-        # Initialize the stack memory.
+        # Initialize the stack memory (host memory is already zero filled).
         stack_size = (self.stack_size) * PAGE_SIZE
 
         self._memory_map(self.stack, stack_size)
-        self.write_memory(self.stack, "\x00" * stack_size)
 
         sp = self.stack + self.stack_size * PAGE_SIZE
         self.__uc.reg_write(self.REG_SP, sp)
 
+        # Map the pages coming straight from files first, the memory areas
+        # only fill the gaps left. Lazy areas are left alone, along with
+        # their contents.
+        for address, filename, offset, size in self.__memory_files:
+            if not self.__lazy_index.contains(address, address + size):
+                self.__map_memory_file(address, filename, offset, size,
+                                       address, address + size)
+
         # Iterate through all the memory areas specified to map them all and
         # write content to them if necessary.
-        for address, size in self.__memory_areas:
-            size = self._align_address(size) + PAGE_SIZE # FIXME : horrible kludge! Will break contignous sections.
-            address_aligned = self._align_address(address)
-
-            self._memory_map(address_aligned, size, uc.UC_PROT_ALL)
+        for address, size, perm, lazy in self.__memory_areas:
+            if not lazy:
+                self.__map_memory_area(address, size, perm)
 
         # Add the content to every previously mapped memory area.
         # Iterate through all the memory areas specified to map them all and
         # write content to them if necessary.
         for address, content in self.__memory_contents:
-            self.write_memory(address, content)
+            if not self.__lazy_index.contains(address, address + len(content)):
+                self.write_memory(address, content)
+
+        for address, filename, offset, size in self.__memory_files:
+            if not self.__lazy_index.contains(address, address + size):
+                self.__write_memory_file_edges(address, filename, offset,
+                                               size)
+
+    def __memory_file_pages(self, address, offset, size):
+        """Return the (start, end) range of the pages of a file region that
+        can be mapped from the file (None if there are none).
+        """
+        # The file offset and the address must share the page offset.
+        if (address ^ offset) & (PAGE_SIZE - 1):
+            return None
+
+        start = self._align_address(address + PAGE_SIZE - 1)
+        end = self._align_address(address + size)
+        if start >= end:
+            return None
+        return start, end
+
+    def __map_memory_file(self, address, filename, offset, size,
+                          start_address, end_address, perm=None):
+        """Map the pages of a file region within [start_address,
+        end_address) straight from the file (with the permissions of their
+        memory area if `perm` is None).
+        """
+        pages = self.__memory_file_pages(address, offset, size)
+        if pages is None:
+            return
+
+        start = max(pages[0], start_address)
+        end = min(pages[1], end_address)
+        if start >= end or self.__memory_index.overlaps(start, end):
+            # Something is mapped there already, it gets a copy.
+            return
+
+        with open(filename, 'rb') as f:
+            backing = mmap.mmap(f.fileno(), end - start, mmap.MAP_PRIVATE,
+                                mmap.PROT_READ | mmap.PROT_WRITE,
+                                offset=offset + start - address)
+
+        if perm is None:
+            perm = self.__area_permissions(start)
+        self._memory_map(start, end - start, perm, backing, filename)
+
+    def __area_permissions(self, address):
+        """Return the permissions of the memory area holding the address."""
+        for area_address, size, perm, lazy in self.__memory_areas:
+            start, size = self.__memory_area_range(area_address, size)
+            if start <= address < start + size:
+                return perm
+        return uc.UC_PROT_ALL
+
+    def __map_lazy_pages(self, address):
+        """Map the chunk of the lazy area around the address and fill it
+        with its contents. Return False if the address isn't lazy.
+        """
+        if self.__uc is None or not self.__lazy_index.find(address):
+            return False
+
+        # The chunk stays within the area (and its permissions).
+        for area_address, size, perm, lazy in self.__memory_areas:
+            area_start, size = self.__memory_area_range(area_address, size)
+            if lazy and area_start <= address < area_start + size:
+                break
+        else:
+            return False
+
+        chunk = address // LAZY_CHUNK_SIZE * LAZY_CHUNK_SIZE
+        start = max(area_start, chunk)
+        end = min(area_start + size, chunk + LAZY_CHUNK_SIZE)
+
+        self.logger.debug("Mapping lazy pages 0x%08X - 0x%08X", start, end)
+
+        for file_address, filename, offset, size in self.__memory_files:
+            if file_address < end and file_address + size > start:
+                self.__map_memory_file(file_address, filename, offset, size,
+                                       start, end, perm)
+
+        for gap_start, gap_end in self.__memory_index.gaps(start, end):
+            self._memory_map(gap_start, gap_end - gap_start, perm)
+            self.__fill_memory(gap_start, gap_end)
+
+        return True
+
+    def __fill_memory(self, start_address, end_address):
+        """Write the memory contents (and the file ones) falling within the
+        range.
+        """
+        for address, content in self.__memory_contents:
+            start = max(start_address, address)
+            end = min(end_address, address + len(content))
+            if start < end:
+                self.__uc.mem_write(start,
+                                    content[start - address:end - address])
+
+        for address, filename, offset, size in self.__memory_files:
+            start = max(start_address, address)
+            end = min(end_address, address + size)
+            if start < end:
+                with open(filename, 'rb') as f:
+                    f.seek(offset + start - address)
+                    self.__uc.mem_write(start, f.read(end - start))
+
+    def __map_lazy_range(self, start_address, end_address):
+        """Map the lazy pages missing in the range. Return False if some of
+        them aren't lazy.
+        """
+        for start, end in self.__memory_index.gaps(start_address,
+                                                   end_address):
+            page = self._align_address(start)
+            while page < end:
+                if not self.__memory_index.find(page) and \
+                        not self.__map_lazy_pages(page):
+                    return False
+                page += PAGE_SIZE
+        return True
+
+    def __lazy_page_callback(self, _uc, access, address, size, value,
+                             user_data):
+        """Built-in callback mapping the lazy pages on their first access."""
+        return self.__map_lazy_range(address, address + max(size, 1))
+
+    def __write_memory_file_edges(self, address, filename, offset, size):
+        """Copy the parts of a file region not mapped from the file."""
+        pages = self.__memory_file_pages(address, offset, size)
+        region = self.__host_region(pages[0], pages[1]) if pages else None
+
+        if region is None or region.filename != filename:
+            pieces = [(address, address + size)]
+        else:
+            pieces = [(address, pages[0]), (pages[1], address + size)]
+
+        with open(filename, 'rb') as f:
+            for start, end in pieces:
+                if start < end:
+                    f.seek(offset + start - address)
+                    self.write_memory(start, f.read(end - start))
+
+    def __host_region(self, start_address, end_address):
+        """Return the HostRegion holding the whole range (if any)."""
+        idx = bisect_right(self.__host_starts, start_address) - 1
+        if idx < 0:
+            return None
+
+        region = self.__host_regions[self.__host_starts[idx]]
+        if end_address > region.address + region.size:
+            return None
+        return region
+
+    def memory_view(self, address, size):
+        """Return a (writable) memoryview of the emulator memory.
+
+        There's no copy involved, the view works on the host memory Unicorn
+        uses. The range must be mapped and lie within a single mapping.
+
+        Writes through the view aren't seen by the snapshot dirty tracking:
+        its pages are marked dirty when the view is created instead, so only
+        the next restore() undoes them. Get a new view after restoring before
+        writing to it again.
+        """
+        if self.__uc is None:
+            raise PimpMyRideException("Emulator not initialized")
+
+        region = None
+        if self.__is_valid_memory_range(address, address + size):
+            region = self.__host_region(address, address + size)
+
+        if region is None:
+            raise PimpMyRideException(
+                    "No host memory backing 0x%08X - 0x%08X" % (
+                        address, address + size))
+
+        if self.__dirty_hook is not None:
+            self.__dirty_pages.update(xrange(address >> PAGE_SHIFT,
+                ((address + size - 1) >> PAGE_SHIFT) + 1))
+
+        offset = address - region.address
+        return memoryview(region.view)[offset:offset + size]
+
+    def __memory_area_range(self, address, size):
+        """Return the page-aligned range used to map a memory area."""
+        start = self._align_address(address)
+        end = self._align_address(address + size + PAGE_SIZE - 1)
+        return start, end - start
+
+    def __map_memory_area(self, address, size, perm=uc.UC_PROT_ALL):
+        """Map a user-specified memory area into the emulator."""
+        address_aligned, size = self.__memory_area_range(address, size)
+
+        # Only map the pages not already mapped by a neighbouring area.
+        for start, end in self.__memory_index.gaps(
+                address_aligned, address_aligned + size):
+            self._memory_map(start, end - start, perm)
 
     def __is_valid_memory_range(self, start_address, end_address):
-        """..."""
-        # Iterate through all the memory areas to validate the range.
-        for address, size in self.__memory_areas:
-            if start_address >= address and end_address <= address + size:
-                self.logger.debug(
-                    "Successfully validating memory range 0x%08X - 0x%08X" % (
-                    start_address, end_address))
-                return True
-
-        # FIXME Make this better by adding this area to the other memory areas
-        # (probably with different settings & permissions).
-        if start_address >= self.stack and end_address <= (self.stack_size * PAGE_SIZE) + self.stack:
-            self.logger.debug(
-                "Successfully validating memory range 0x%08X - 0x%08X" % (
-                start_address, end_address))
+        """Check the whole range lies within the mapped memory (stack
+        included).
+        """
+        if self.__memory_index.contains(start_address, end_address):
+            return True
+
+        # Lazy pages not accessed yet are mapped now.
+        if self.__map_lazy_range(start_address, end_address):
             return True
 
         self.logger.debug(
-            "Unable to validate memory range 0x%08X - 0x%08X" % (
-            start_address, end_address))
+            "Unable to validate memory range 0x%08X - 0x%08X",
+            start_address, end_address)
         return False
 
     def read_memory(self, address, size):
@@ -441,223 +1211,121 @@ class PimpMyRide(object):
         if not self.__is_valid_memory_range(address, address + size):
             return ""
 
-        self.logger.debug("Reading %d(0x%X) bytes at 0x%08X" % (
-            size, size, address))
+        self.logger.debug("Reading %d(0x%X) bytes at 0x%08X",
+            size, size, address)
 
         # This will fail if the memory area was not yet defined in Unicorn.
         return str(self.__uc.mem_read(address, size))
 
     def write_memory(self, address, content):
-        """Set the content of a memory area with user-defined content."""
+        """Set the content of a memory area with user-defined content.
+
+        Return True if the content was written, False if the range isn't
+        mapped.
+        """
         # check memory range to write is valid.
         if not self.__is_valid_memory_range(address, address + len(content)):
-            return ""
+            return False
 
-        self.logger.debug("Writting %d(0x%X) bytes at 0x%08X" % (
-            len(content), len(content), address))
+        self.logger.debug("Writting %d(0x%X) bytes at 0x%08X",
+            len(content), len(content), address)
+
+        # Writes from the host side don't trigger the emulator hooks.
+        if self.__dirty_hook is not None:
+            self.__dirty_pages.update(xrange(address >> PAGE_SHIFT,
+                ((address + len(content) - 1) >> PAGE_SHIFT) + 1))
 
         # This will fail if the memory area was not yet defined in Unicorn.
         self.__uc.mem_write(address, content)
+        return True
+
+    def _memory_map(self, address, size, perm=None, backing=None,
+                    filename=None):
+        """Map the specified address to a new memory area.
 
-    def _memory_map(self, address, size, perm=None):
-        """Map the specified address to a new memory area."""
+        The memory lives in a host buffer: `backing` (a mmap of `size`
+        bytes, mapping `filename` if any) or an anonymous mapping, whose pages
+        are only allocated (zero filled) when first touched.
+        """
         # This function should not be called directrly. Use add_memory_area
         # instead.
         self.logger.debug("Mapping 0x%08X - 0x%08X (size 0x%X)" % (
             address, address + size, size))
 
-        if perm:
-            self.__uc.mem_map(address, size, perm)
-        else:
-            self.__uc.mem_map(address, size)
+        if backing is None:
+            backing = mmap.mmap(-1, size)
+
+        region = HostRegion(address, backing, filename)
+
+        if perm is None:
+            perm = uc.UC_PROT_ALL
+        self.__uc.mem_map_ptr(address, size, perm, region.pointer)
+
+        self.__host_regions[address] = region
+        insort(self.__host_starts, address)
+
+        self.__memory_index.add(address, size)
+
+    def _memory_unmap(self, address, size):
+        """Unmap the specified memory area from the emulator."""
+        self.logger.debug("Unmapping 0x%08X - 0x%08X (size 0x%X)" % (
+            address, address + size, size))
+
+        self.__uc.mem_unmap(address, size)
+
+        self.__memory_index.remove(address, size)
+
+        # Release the host buffers no longer mapped at all (the ones still
+        # partially mapped are kept whole).
+        for start in [start for start in self.__host_starts
+                      if start >= address and start < address + size]:
+            region = self.__host_regions[start]
+            if region.address + region.size <= address + size:
+                del self.__host_regions[start]
+                self.__host_starts.remove(start)
 
     def _get_bit(self, value, offset):
         """Get the specified bit value from a bigger number."""
         mask = 1 << offset
         return 1 if (value & mask) > 0 else 0
 
+    @property
+    def registers(self):
+        """Return the RegisterTable of the current architecture."""
+        return self.__registers
+
     def _reg_map(self, reg_name):
         """Map register name to its corresponding index used by Unicorn."""
-
-        reg_map = None
-
-        if self.architecture == uc.UC_ARCH_MIPS:
-            reg_map = {
-                "zero" : UC_MIPS_REG_ZERO, #=2
-                "at" : UC_MIPS_REG_AT, #=3
-                "v0" : UC_MIPS_REG_V0, #=4
-                "v1" : UC_MIPS_REG_V1, #=5
-                "a0" : UC_MIPS_REG_A0, #=6
-                "a1" : UC_MIPS_REG_A1, #=7
-                "a2" : UC_MIPS_REG_A2, #=8
-                "a3" : UC_MIPS_REG_A3, #=9
-                "t0" : UC_MIPS_REG_T0, #=10
-                "t1" : UC_MIPS_REG_T1, #=11
-                "t2" : UC_MIPS_REG_T2, #=12
-                "t3" : UC_MIPS_REG_T3, #=13
-                "t4" : UC_MIPS_REG_T4, #=14
-                "t5" : UC_MIPS_REG_T5, #=15
-                "t6" : UC_MIPS_REG_T6, #=16
-                "t7" : UC_MIPS_REG_T7, #=17
-                "s0" : UC_MIPS_REG_S0, #=18
-                "s1" : UC_MIPS_REG_S1, #=19
-                "s2" : UC_MIPS_REG_S2, #=20
-                "s3" : UC_MIPS_REG_S3, #=21
-                "s4" : UC_MIPS_REG_S4, #=22
-                "s5" : UC_MIPS_REG_S5, #=23
-                "s6" : UC_MIPS_REG_S6, #=24
-                "s7" : UC_MIPS_REG_S7, #=25
-                "t8" : UC_MIPS_REG_T8, #=26
-                "t9" : UC_MIPS_REG_T9, #=27
-                "k0" : UC_MIPS_REG_K0, #=28
-                "k1" : UC_MIPS_REG_K1, #=29
-                "gp" : UC_MIPS_REG_GP, #=30
-                "sp" : UC_MIPS_REG_SP, #=31
-                "fp" : UC_MIPS_REG_FP, #=32
-                #"s8" : UC_MIPS_REG_S8, #=32
-                "ra" : UC_MIPS_REG_RA, #=33
-                "hi" : UC_MIPS_REG_HI, #= 129
-                "lo" : UC_MIPS_REG_LO, #= 130
-                "pc" : UC_MIPS_REG_PC, #= 1
-                #UC_MIPS_REG_HI0, #=45
-                #UC_MIPS_REG_HI1, #=46
-                #UC_MIPS_REG_HI2, #=47
-                #UC_MIPS_REG_HI3, #=48
-                #UC_MIPS_REG_LO0, #=45
-                #UC_MIPS_REG_LO1, #=46
-                #UC_MIPS_REG_LO2, #=47
-                #UC_MIPS_REG_LO3, #=48
-                }
-
-        elif self.architecture == uc.UC_ARCH_ARM64:
-            reg_map = {
-                "r0"    : UC_ARM64_REG_X0, #= 199
-                "r1"    : UC_ARM64_REG_X1, #= 200
-                "r2"    : UC_ARM64_REG_X2, #= 201
-                "r3"    : UC_ARM64_REG_X3, #= 202
-                "r4"    : UC_ARM64_REG_X4, #= 203
-                "r5"    : UC_ARM64_REG_X5, #= 204
-                "r6"    : UC_ARM64_REG_X6, #= 205
-                "r7"    : UC_ARM64_REG_X7, #= 206
-                "r8"    : UC_ARM64_REG_X8, #= 207
-                "r9"    : UC_ARM64_REG_X9, #= 208
-                "r10"   : UC_ARM64_REG_X10, #= 209
-                "r11"   : UC_ARM64_REG_X11, #= 210
-                "r12"   : UC_ARM64_REG_X12, #= 211
-                "r13"   : UC_ARM64_REG_X13, #= 212
-                "r14"   : UC_ARM64_REG_X14, #= 213
-                "r15"   : UC_ARM64_REG_X15, #= 214
-                "r16"   : UC_ARM64_REG_X16, #= 215
-                "r17"   : UC_ARM64_REG_X17, #= 216
-                "r18"   : UC_ARM64_REG_X18, #= 217
-                "r19"   : UC_ARM64_REG_X19, #= 218
-                "r20"   : UC_ARM64_REG_X20, #= 219
-                "r21"   : UC_ARM64_REG_X21, #= 220
-                "r22"   : UC_ARM64_REG_X22, #= 221
-                "r23"   : UC_ARM64_REG_X23, #= 222
-                "r24"   : UC_ARM64_REG_X24, #= 223
-                "r25"   : UC_ARM64_REG_X25, #= 224
-                "r26"   : UC_ARM64_REG_X26, #= 225
-                "r27"   : UC_ARM64_REG_X27, #= 226
-                "r28"   : UC_ARM64_REG_X28, #= 227
-
-                "r29"   : UC_ARM64_REG_X29, #= 1
-                "r30"   : UC_ARM64_REG_X30, #= 2
-
-                "r31"   : UC_ARM64_REG_SP, #= 4
-                "sp"    : UC_ARM64_REG_SP, #= 4
-                #"xzr"   : UC_ARM64_REG_XZR, #= 7
-
-                "pc"    : UC_ARM64_REG_PC, #= 260
-                }
-
-        elif self.architecture == uc.UC_ARCH_X86:
-            if self.mode == uc.UC_MODE_16:
-                raise Exception("Register map not implemented")
-            elif self.mode == uc.UC_MODE_32:
-                raise Exception("Register map not implemented")
-            elif self.mode == uc.UC_MODE_64:
-                reg_map = {
-                    "rax" : UC_X86_REG_RAX,
-                    "rbx" : UC_X86_REG_RBX,
-                    "rcx" : UC_X86_REG_RCX,
-                    "rdx" : UC_X86_REG_RDX,
-                    "rdi" : UC_X86_REG_RSI,
-                    "rsi" : UC_X86_REG_RDI,
-                    "rbp" : UC_X86_REG_RBP,
-                    "rsp" : UC_X86_REG_RSP,
-                    "rip" : UC_X86_REG_RIP,
-                    "r8"  : UC_X86_REG_R8,
-                    "r9"  : UC_X86_REG_R9,
-                    "r10" : UC_X86_REG_R10,
-                    "r11" : UC_X86_REG_R11,
-                    "r12" : UC_X86_REG_R12,
-                    "r13" : UC_X86_REG_R13,
-                    "r14" : UC_X86_REG_R14,
-                    "r15" : UC_X86_REG_R15,
-                }
-
-        elif self.architecture == uc.UC_ARCH_ARM:
-            if self.mode == uc.UC_MODE_ARM:
-                reg_map = {
-                    "r0"    : UC_ARM64_REG_W0, #= 199
-                    "r1"    : UC_ARM64_REG_W1, #= 200
-                    "r2"    : UC_ARM64_REG_W2, #= 201
-                    "r3"    : UC_ARM64_REG_W3, #= 202
-                    "r4"    : UC_ARM64_REG_W4, #= 203
-                    "r5"    : UC_ARM64_REG_W5, #= 204
-                    "r6"    : UC_ARM64_REG_W6, #= 205
-                    "r7"    : UC_ARM64_REG_W7, #= 206
-                    "r8"    : UC_ARM64_REG_W8, #= 207
-                    "r9"    : UC_ARM64_REG_W9, #= 208
-                    "r10"   : UC_ARM64_REG_W10, #= 209
-                    "r11"   : UC_ARM64_REG_W11, #= 210
-                    "r12"   : UC_ARM64_REG_W12, #= 211
-                    "r13"   : UC_ARM64_REG_W13, #= 212
-                    "r14"   : UC_ARM64_REG_W14, #= 213
-                    "r15"   : UC_ARM64_REG_W15, #= 214
-                    "r16"   : UC_ARM64_REG_W16, #= 215
-                    "r17"   : UC_ARM64_REG_W17, #= 216
-                    "r18"   : UC_ARM64_REG_W18, #= 217
-                    "r19"   : UC_ARM64_REG_W19, #= 218
-                    "r20"   : UC_ARM64_REG_W20, #= 219
-                    "r21"   : UC_ARM64_REG_W21, #= 220
-                    "r22"   : UC_ARM64_REG_W22, #= 221
-                    "r23"   : UC_ARM64_REG_W23, #= 222
-                    "r24"   : UC_ARM64_REG_W24, #= 223
-                    "r25"   : UC_ARM64_REG_W25, #= 224
-                    "r26"   : UC_ARM64_REG_W26, #= 225
-                    "r27"   : UC_ARM64_REG_W27, #= 226
-                    "r28"   : UC_ARM64_REG_W28, #= 227
-
-                    "r29"   : UC_ARM64_REG_W29, #= 1
-                    "r30"   : UC_ARM64_REG_W30, #= 2
-
-                    "r31"    : UC_ARM64_REG_SP, #= 4
-                    "sp"    : UC_ARM64_REG_SP, #= 4
-                    #"xzr"   : UC_ARM64_REG_XZR, #= 7
-
-                    "pc"    : UC_ARM64_REG_PC, #= 260
-                    }
-            elif self.mode == uc.UC_MODE_THUMB:
-                raise Exception("Register map for ARM thumb-mode not implemented")
-
-        else:
-            raise Exception("Register map not implemented")
-
-        return reg_map.get(reg_name, 0x11223344)
+        try:
+            return self.__register_ids[reg_name]
+        except KeyError:
+            raise PimpMyRideException("Unknown register %s" % reg_name)
 
     def read_register(self, reg_name):
         """Return the value of the register specified by its name."""
         reg_idx = self._reg_map(reg_name)
-        reg_val = self.__uc.reg_read(reg_idx)
-        #print "_" * 50
-        #self.logger.info("Requesting register %s = 0x%08X" % (reg_name, reg_val))
+        if reg_idx is None:
+            # Not emulated by Unicorn.
+            return 0
 
-        return reg_val
+        return self.__uc.reg_read(reg_idx)
+
+    def read_registers(self, reg_names):
+        """Return the list of values of the registers specified by their
+        names.
+        """
+        reg_read = self.__uc.reg_read
+        reg_ids = [self._reg_map(reg_name) for reg_name in reg_names]
+        return [reg_read(reg_idx) if reg_idx is not None else 0
+                for reg_idx in reg_ids]
 
     def __show_regs(self):
         """..."""
+        # Reading all the registers is expensive, don't bother if nobody is
+        # going to see them.
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+
         self.logger.debug("Registers:")
         try:
             if self.architecture == uc.UC_ARCH_MIPS:
@@ -791,6 +1459,16 @@ class PimpMyRide(object):
             self.logger.debug("Adding CODE hook : %s" % cb)
             self.__uc.hook_add(hook, cb)
 
+        if len(self.__lazy_index):
+            self.__lazy_hook = self.__uc.hook_add(
+                uc.UC_HOOK_MEM_UNMAPPED, self.__lazy_page_callback)
+
+        # Install the hooks required by the current tracing tier.
+        self.__trace_hooks = list()
+        self.__breakpoint_hooks = dict()
+        self.__watchpoint_hooks = dict()
+        self.__install_trace_hooks()
+
         #TODO Add more hooks
 
     def __initialize_registers(self):
@@ -807,9 +1485,9 @@ class PimpMyRide(object):
     def write_register(self, register, value):
         """Write the specified value into the specified register."""
         reg_idx = self._reg_map(register)
-        print "_" * 50
-        self.logger.info("Writing register %s = 0x%08X" % (register, value))
-        self.__uc.reg_write(reg_idx, value)
+        self.logger.debug("Writing register %s = 0x%08X", register, value)
+        if reg_idx is not None:
+            self.__uc.reg_write(reg_idx, value)
 
     def result(self):
         """Return the emulation results (if any)."""
@@ -833,64 +1511,222 @@ class PimpMyRide(object):
 
         return disasm
 
+    def instructions(self, address, size):
+        """Return the (address, size) of the instructions in the memory
+        range. Whatever can't be disassembled counts as a single instruction.
+        """
+        code = self.read_memory(address, size)
+
+        instructions = [(insn_address, insn_size) for insn_address, insn_size,
+                        mnemonic, op_str in self.__cs.disasm_lite(code, address)]
+
+        decoded = sum([insn_size for insn_address, insn_size in instructions])
+        if decoded < size:
+            instructions.append((address + decoded, size - decoded))
+
+        return instructions
+
     def add_code_hook(self, callback_fn):
         """Store user-specified callback function for the instruction tracing."""
         self.__hooks[uc.UC_HOOK_CODE] = callback_fn
 
-    def trace_instructions(self):
-        """Request the emulator to trace every executed instruction."""
-        # TODO Enhance this code to differentiate internal callback from
-        # user-defined hooks.
-        self.logger.debug("Internal code trace enabled.")
-        self.add_code_hook(self.__code_callback)
+    def add_address_hook(self, address, callback_fn):
+        """Call `callback_fn(emu, address)` every time the instruction at the
+        specified address is executed, without stopping the emulation.
 
-    def __code_callback(self, _uc, address, size, user_data):
-        """Built-in callback for instructions tracing."""
-        self.logger.debug("Tracing instruction at 0x%x, instruction size = %u" %(address, size))
-        try:
-            self.__show_regs()
+        Return the handle to pass to remove_hook().
+        """
+        if self.__uc is None:
+            raise PimpMyRideException("Emulator not initialized")
 
-            opcodes = _uc.mem_read(address, size)
+        def hook(_uc, address, size, user_data):
+            callback_fn(self, address)
 
-            self.logger.debug("")
-            disasm = self._show_disasm_inst(opcodes, address)
-            self.logger.debug("")
+        return self.__uc.hook_add(uc.UC_HOOK_CODE, hook, None, address, address)
 
-            if self.architecture == uc.UC_ARCH_MIPS:
-                new_pc = self.read_register("pc")
+    def add_block_hook(self, callback_fn, begin=1, end=0):
+        """Call `callback_fn` every time a basic block is executed.
 
-            elif self.architecture == uc.UC_ARCH_X86:
-                if self.mode == uc.UC_MODE_16:
-                    raise Exception("get PC map not implemented")
-                elif self.mode == uc.UC_MODE_32:
-                    raise Exception("get PC not implemented")
-                elif self.mode == uc.UC_MODE_64:
-                    new_pc = self.read_register("rip")
-            else:
-                raise Exception("get PC not implemented for current architecture")
+        It's installed as is as a Unicorn block hook (no wrapper, it runs on
+        every block) so it's called as callback_fn(uc, address, size,
+        user_data). Only the blocks starting in [begin, end] are reported if
+        given, the others don't pay for the hook at all. Return the handle to
+        pass to remove_hook().
 
-            if str(disasm[0][0]) == 'jal':
-                self.logger.error("============> %r" % (str(disasm[0][0]) == 'jal'))
-                #new_pc = int(str(disasm[0][1]), 16)
-                #new_pc = int(str(disasm[0][1]), 16)
-                self.logger.error("new pc (jal) = 0x%08X" % new_pc)
+        Unicorn reports the first block of every emulation but the first one
+        (see `emulations`) twice, the first time before executing any of its
+        instructions.
+        """
+        if self.__uc is None:
+            raise PimpMyRideException("Emulator not initialized")
 
-            #self.__uc.reg_write(UC_MIPS_REG_PC, new_pc)
+        return self.__uc.hook_add(uc.UC_HOOK_BLOCK, callback_fn, None,
+                                  begin, end)
 
-            self.logger.warning("New address 0x%08X" % new_pc)
-            self.start_address = new_pc
-            self.logger.debug("_" * 80)
+    def remove_hook(self, handle):
+        """Remove a hook installed by add_address_hook() or
+        add_block_hook().
+        """
+        self.__uc.hook_del(handle)
 
-            # Check breakpoint
-            if address in self.breakpoints:
-                self.logger.debug("_" * 80)
-                self.logger.debug("Stopping execution...")
-                self.__uc.emu_stop()
+    @property
+    def trace_level(self):
+        """Return the current instruction tracing tier."""
+        return self.__trace_level
+
+    def trace_instructions(self, level=TRACE_FULL):
+        """Select the instruction tracing tier (see TRACE_LEVELS).
 
-                self.logger.info("Breakpoint hit at 0x%08X" % address)
-                for cb in self.breakpoints_callback:
-                    cb(address)
-                self.logger.debug("_" * 80)
+        The hooks of the previous tier are removed and only the ones needed by
+        the new tier are installed, so it can be changed at any time.
+        """
+        if level not in TRACE_LEVELS.values():
+            raise PimpMyRideException("Invalid trace level %r" % level)
+
+        self.logger.debug("Instruction tracing level set to %d." % level)
+
+        if self.__uc is not None:
+            self.__remove_trace_hooks()
+
+        self.__trace_level = level
+
+        if self.__uc is not None:
+            self.__install_trace_hooks()
+
+    def __install_trace_hooks(self):
+        """Install the hooks needed by the current tracing tier."""
+        if self.__trace_level >= TRACE_BREAKPOINTS:
+            for addr in self.breakpoints:
+                self.__add_breakpoint_hook(addr)
+            for watchpoint in self.watchpoints:
+                self.__add_watchpoint_hooks(watchpoint)
+
+        if self.__trace_level == TRACE_PC:
+            del self.pc_trace[:]
+            self.__trace_hooks.append(
+                self.__uc.hook_add(uc.UC_HOOK_CODE, self.__pc_callback))
+
+        elif self.__trace_level == TRACE_FULL:
+            self.__trace_hooks.append(
+                self.__uc.hook_add(uc.UC_HOOK_CODE, self.__code_callback))
+
+    def __remove_trace_hooks(self):
+        """Remove every hook installed for the current tracing tier."""
+        for handle in self.__trace_hooks:
+            self.__uc.hook_del(handle)
+        self.__trace_hooks = list()
+
+        for addr in self.__breakpoint_hooks.keys():
+            self.__remove_breakpoint_hook(addr)
+
+        for watchpoint in self.__watchpoint_hooks.keys():
+            self.__remove_watchpoint_hooks(watchpoint)
+
+    def __add_breakpoint_hook(self, addr):
+        """Hook the execution of the instruction at the specified address."""
+        if addr in self.__breakpoint_hooks:
+            return
+
+        self.__breakpoint_hooks[addr] = self.__uc.hook_add(
+            uc.UC_HOOK_CODE, self.__breakpoint_callback, None, addr, addr)
+
+    def __remove_breakpoint_hook(self, addr):
+        """Remove the hook of the breakpoint at the specified address."""
+        handle = self.__breakpoint_hooks.pop(addr, None)
+        if handle is not None:
+            self.__uc.hook_del(handle)
+
+    def __breakpoint_callback(self, _uc, address, size, user_data):
+        """Built-in callback for the breakpoints hit."""
+        if address == self.__resume_breakpoint:
+            self.__resume_breakpoint = None
+            return
+
+        condition = self.breakpoint_conditions.get(address)
+        if condition is not None and not condition(self):
+            return
+
+        _uc.emu_stop()
+
+        self.logger.info("Breakpoint hit at 0x%08X", address)
+        for cb in self.breakpoints_callback:
+            cb(address)
+
+    def __add_watchpoint_hooks(self, watchpoint):
+        """Hook the accesses to a watched range (and only to it)."""
+        if watchpoint in self.__watchpoint_hooks:
+            return
+
+        address, size, kind = watchpoint
+        begin = max(address - MAX_ACCESS_SIZE + 1, 0)
+        end = address + size - 1
+
+        handles = list()
+        if kind & WATCH_READ:
+            handles.append(self.__uc.hook_add(uc.UC_HOOK_MEM_READ,
+                    self.__watchpoint_callback, watchpoint, begin, end))
+        if kind & WATCH_WRITE:
+            handles.append(self.__uc.hook_add(uc.UC_HOOK_MEM_WRITE,
+                    self.__watchpoint_callback, watchpoint, begin, end))
+
+        self.__watchpoint_hooks[watchpoint] = handles
+
+    def __remove_watchpoint_hooks(self, watchpoint):
+        """Remove the hooks of a watchpoint."""
+        for handle in self.__watchpoint_hooks.pop(watchpoint, ()):
+            self.__uc.hook_del(handle)
+
+    def __watchpoint_callback(self, _uc, access, address, size, value,
+            watchpoint):
+        """Built-in callback for the accesses to the watched ranges."""
+        start, length, kind = watchpoint
+        if self.__watchpoint_skip or self.watchpoint_hit is not None or \
+                address + size <= start or address >= start + length:
+            return
+
+        self.watchpoint_hit = (kind, max(address, start))
+
+        # Writes hooks are called before writing, save what gets overwritten.
+        if access == uc.UC_MEM_WRITE:
+            self.__watchpoint_undo = (address,
+                                      str(_uc.mem_read(address, size)))
+
+        _uc.emu_stop()
+
+        self.logger.info("Watchpoint hit at 0x%08X (%d bytes at 0x%08X)",
+                         self.__uc.reg_read(self.REG_PC), size, address)
+
+    def __range_step_callback(self, _uc, address, size, user_data):
+        """Built-in callback stopping the emulation out of a stepped range."""
+        if address == self.__range_step_skip:
+            self.__range_step_skip = None
+            return
+
+        _uc.emu_stop()
+
+    def __pc_callback(self, _uc, address, size, user_data):
+        """Built-in callback recording the executed instructions addresses."""
+        pc_trace = self.pc_trace
+        if len(pc_trace) >= self.pc_trace_size:
+            # Drop the oldest half instead of shifting on every instruction.
+            del pc_trace[:self.pc_trace_size // 2]
+        pc_trace.append(address)
+
+    def __code_callback(self, _uc, address, size, user_data):
+        """Built-in callback for instructions tracing."""
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+
+        self.logger.debug("Tracing instruction at 0x%x, instruction size = %u",
+                address, size)
+        try:
+            self.__show_regs()
+
+            opcodes = _uc.mem_read(address, size)
+
+            self.logger.debug("")
+            self._show_disasm_inst(opcodes, address)
+            self.logger.debug("_" * 80)
 
             # TODO : call user-defined function now?
 
@@ -912,14 +1748,58 @@ class PimpMyRide(object):
         self.breakpoints_callback.append(callback)
         return
 
-    def set_breakpoint(self, addr):
-        """Store a list of the address to check for breakpoints."""
-        self.breakpoints.append(addr)
+    def set_breakpoint(self, addr, condition=None):
+        """Set a breakpoint at the specified address.
+
+        Every breakpoint is a code hook ranged on its own address, so the
+        instructions in between run without calling back into Python. It can
+        be set at any time, even while the emulator is running.
+
+        `condition` is a callable receiving the emulator, the breakpoint only
+        stops the emulation when it returns True. Setting the breakpoint again
+        replaces its condition.
+        """
+        self.breakpoints.add(addr)
+
+        if condition is None:
+            self.breakpoint_conditions.pop(addr, None)
+        else:
+            self.breakpoint_conditions[addr] = condition
+
+        if self.__uc is not None and self.__trace_level >= TRACE_BREAKPOINTS:
+            self.__add_breakpoint_hook(addr)
         return
 
+    def set_watchpoint(self, addr, size, kind=WATCH_WRITE):
+        """Stop the emulation after the instructions accessing (reading,
+        writing or both, see WATCH_*) the range [addr, addr + size).
+
+        Only the accesses to the range call back into Python, the hooks are
+        ranged on it.
+        """
+        if kind not in (WATCH_READ, WATCH_WRITE, WATCH_ACCESS) or size <= 0:
+            raise PimpMyRideException("Invalid watchpoint")
+
+        watchpoint = (addr, size, kind)
+        self.watchpoints.add(watchpoint)
+
+        if self.__uc is not None and self.__trace_level >= TRACE_BREAKPOINTS:
+            self.__add_watchpoint_hooks(watchpoint)
+
+    def remove_watchpoint(self, addr, size, kind=WATCH_WRITE):
+        """Remove a watchpoint (and its hooks)."""
+        watchpoint = (addr, size, kind)
+        self.watchpoints.discard(watchpoint)
+
+        if self.__uc is not None:
+            self.__remove_watchpoint_hooks(watchpoint)
+
     def remove_breakpoint(self, addr):
-        """Remove the specified address from the breakpoint addresses list."""
-        if addr in self.breakpoints:
-            self.breakpoints.remove(addr)
+        """Remove the breakpoint (and its hook) at the specified address."""
+        self.breakpoints.discard(addr)
+        self.breakpoint_conditions.pop(addr, None)
+
+        if self.__uc is not None:
+            self.__remove_breakpoint_hook(addr)
         return
 
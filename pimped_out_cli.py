@@ -13,49 +13,26 @@ from sys import argv, exit, stdout
 from argparse import ArgumentParser
 from traceback import print_exc
 import logging
-from time import sleep
+import json
+from time import sleep, time
 
 try:
     from pimp_my_ride import *
 
     from target.board import Board
-    from target.emulated_target import EmulatedTargetX86_64
-    from target.emulated_target_aarch64 import EmulatedTargetAArch64
-    from target.emulated_target_arm import EmulatedTargetARM
-    from target.emulated_target_mips import EmulatedTargetMips
+    from target.emulated_target import EmulatedTarget
     from gdbserver.gdb_server import GDBServer
+    from elf_loader import ElfImage
+    from trace_recorder import TraceRecorder
+    from block_coverage import BlockCoverage
 
 except ImportError, err:
     print "Import Error : %s" % err
     exit(1)
 
-try:
-    from elftools.elf.elffile import ELFFile
-
-    from elftools.elf.descriptions import (
-        describe_ei_class, describe_ei_data, describe_ei_version,
-        describe_ei_osabi, describe_e_type, describe_e_machine,
-        describe_e_version_numeric, describe_p_type, describe_p_flags,
-        describe_sh_type, describe_sh_flags,
-        describe_symbol_type, describe_symbol_bind, describe_symbol_visibility,
-        describe_symbol_shndx, describe_reloc_type, describe_dyn_tag,
-        describe_ver_flags, describe_note
-        )
-
-except ImportError, err:
-    print "Missing 'pyelftools' module."
-    exit(1)
-
-def autodetect_architecture(image):
-    """Detect the current architecture in use by the disassembler being
-    used.
-    
-    """
-    architecture = image.get_machine_arch()
-    bits = image.elfclass
-    is_little_endian = image.little_endian
-
-    return (architecture, bits, is_little_endian)
+# Stack of the emulator used by the 'run' command.
+RUN_STACK = 0x7FF00000
+RUN_STACK_SIZE = 0x100 # Pages
 
 def get_gdb_server_settings(args):
     """Set GDB server settings."""
@@ -82,8 +59,11 @@ def logo(a=1):
 def main():
 
     log_levels = LOG_LEVELS.keys()
+    trace_levels = TRACE_LEVELS.keys()
 
-    parser = ArgumentParser(description=__description__)
+    parser = ArgumentParser(description=__description__,
+            epilog="Use '%s run --help' to call functions without a GDB "
+                   "server." % argv[0])
     parser.add_argument('--version', action='version', version=__version__)
     parser.add_argument('--logo', type=logo, action='store')
     parser.add_argument("-p", "--port", dest = "port_number", type=int, default = 3333, help = "Port number that GDB server will listen.")
@@ -95,8 +75,11 @@ def main():
     #parser.add_argument("-r", "--reset-break", dest = "break_on_reset", default = False, action="store_true", help = "Halt the target when reset." )
     #parser.add_argument("-s", "--step-int", dest = "step_into_interrupt", default = False, action="store_true", help = "Allow single stepping to step into interrupts." )
     #parser.add_argument("-f", "--frequency", dest = "frequency", default = 1000000, type=int, help = "Set the SWD clock frequency in Hz." )
+    parser.add_argument("-T", "--trace", dest = "trace", choices = trace_levels, default = 'breakpoints', help = "Set the instruction tracing level. Supported choices are: "+", ".join(trace_levels), metavar="LEVEL")
     parser.add_argument("-o", "--persist", dest = "persist", default = False, action="store_true", help = "Keep GDB server running even after remote has detached.")
     parser.add_argument("-t", "--target", dest = "target", default = None, help = "Target filename to emulate.", metavar="TARGET", required=True)
+    parser.add_argument("-s", "--start", dest = "start_address", default = None, help = "Address or symbol the emulation starts at (the ELF entry point by default).", metavar="ADDRESS")
+    parser.add_argument("-r", "--return", dest = "return_address", default = None, help = "Address or symbol the emulation stops at (it doesn't stop by default).", metavar="ADDRESS")
     #parser.add_argument("-bh", "--soft-bkpt-as-hard", dest = "soft_bkpt_as_hard", default = False, action = "store_true", help = "Replace software breakpoints with hardware breakpoints.")
     #group = parser.add_mutually_exclusive_group()
     #group.add_argument("-ce", "--chip_erase", action="store_true",help="Use chip erase when programming.")
@@ -114,81 +97,48 @@ def main():
     #setup_logging(args)
     gdb_server_settings = get_gdb_server_settings(args)
 
-    try:
-        fd = open(args.target, 'rb')
-    except IOError, err:
-        print "Error : Invalid filename (%s) specified." % args.target
-        return
-
-    image = ELFFile(fd)
-
-    #
-    # Obtain the memory ranges where we're going to operate.
-    #
-    #start_address = 0x004007e8 #image.header.e_entry # MIPS
-    #start_address = 0x4004F4 # X86-64
-    #start_address = 0x40058C # AArch64
-    start_address = 0x1043C # ARM
-
-    #ret_address = 0x0400814 #0x400502 # MIPS
-    #ret_address = 0x400504 # X86-64
-    #ret_address = 0x40059D # AArch64
-    ret_address = 0x10450 # ARM
-
-    #
-    # Read the code to emulate
-    #
-    dot_text = image.get_section_by_name(".text")
-
-    addr = dot_text.header.sh_addr
-    code = dot_text.data()
-
-    if not code or len(code) is 0:
-        print "[-] Unable to obtain codes to emulate. Quitting..."
-        return
-
     emu = None
     gdb = None
 
     try:
-        # Set architecture specific types for the current binary being
-        # analyzed.
-        architecture, bits, is_little_endian = autodetect_architecture(image)
-
-        # Initialize the emulator and set the operational parameters.
+        #
+        # Obtain the memory ranges where we're going to operate.
+        #
+        try:
+            image = ElfImage(args.target)
+        except IOError, err:
+            print "Error : Invalid filename (%s) specified." % args.target
+            return
+
+        start_address = image.entry
+        if args.start_address is not None:
+            start_address = image.resolve(args.start_address)
+
+        ret_address = None
+        if args.return_address is not None:
+            ret_address = image.resolve(args.return_address)
+
+        # Initialize the emulator and set the operational parameters. Every
+        # loadable segment is mapped, its pages on first touch.
         print "[+] Configuring emulator..."
         stack=0x1000
         stack_size = 5
 
-        emu = PimpMyRide(architecture, bits, is_little_endian,
+        emu = image.create_emulator(
                 log_level=LOG_LEVELS.get(args.log_level), stack=stack,
                 stack_size=stack_size)
 
-        emu.add_memory_area(addr, len(code) + 0x100)
-        emu.add_memory_content(addr, code)
-
         emu.start_address = start_address
         emu.return_address = ret_address
 
-        # AArch64 & ARM
+        # 'pc' and 'sp' name the right registers on every architecture.
         emu.init_register("pc", start_address)
         emu.init_register("sp", stack * stack_size)
 
-        # X86-64
-        #emu.init_register("rip", start_address)
-        #emu.init_register("rsp", stack * stack_size)
-
-        # MIPS
-        #emu.init_register("pc", start_address) # MIPS
-        #emu.init_register("sp", stack * stack_size)
-
-        # Set tracing all instructions with internal callback.
-        emu.trace_instructions()
+        # Set the instruction tracing level for the internal callbacks.
+        emu.trace_instructions(TRACE_LEVELS.get(args.trace))
 
-        board = Board(EmulatedTargetARM(emu))
-        #board = Board(EmulatedTargetAArch64(emu))
-        #board = Board(EmulatedTargetX86_64(emu))
-        #board = Board(EmulatedTargetMips(emu))
+        board = Board(EmulatedTarget(emu))
 
         print "[+] Initializing GDB server..."
         gdb = GDBServer(board, gdb_server_settings)
@@ -213,7 +163,133 @@ def main():
         if gdb is not None:
             gdb.stop()
 
+def parse_invocation(image, line):
+    """Return the (name, address, args) of an invocations file line
+    ('FUNCTION [ARG...]'), None for blank lines and comments.
+    """
+    fields = line.split('#', 1)[0].split()
+    if not fields:
+        return None
+
+    return (fields[0], image.resolve(fields[0]),
+            [int(arg, 0) for arg in fields[1:]])
+
+def run_invocation(emu, name, address, args, max_insns, timeout):
+    """Call a function and return the JSON-ready outcome of the call."""
+    outcome = {
+        'function' : name,
+        'address' : address,
+        'args' : args,
+        'result' : None,
+        'error' : None,
+    }
+
+    started = time()
+    try:
+        outcome['result'] = emu.call(address, *args, count=max_insns,
+                                     timeout=timeout)
+    except PimpMyRideException, err:
+        outcome['error'] = str(err)
+
+    outcome['elapsed'] = time() - started
+    outcome['pc'] = emu.read_register("pc")
+    outcome['mapped'] = sum([end - start for start, end in emu.memory_map])
+
+    return outcome
+
+def run_main(arguments):
+    """Headless mode: call functions of an image and print the outcome of
+    every call as a JSON line.
+    """
+    parser = ArgumentParser(prog="%s run" % argv[0],
+            description="Call functions of an ELF image without a GDB server.")
+    parser.add_argument("-t", "--target", dest = "target", help = "Target filename to emulate.", metavar="TARGET", required=True)
+    parser.add_argument("-f", "--function", dest = "function", default = None, help = "Name (or address) of the function to call.", metavar="NAME")
+    parser.add_argument("-a", "--args", dest = "args", nargs = "*", default = [], help = "Arguments of the function (decimal or hex).", metavar="ARG")
+    parser.add_argument("-i", "--invocations", dest = "invocations", default = None, help = "File with one 'FUNCTION [ARG...]' call per line, run back to back on the same emulator.", metavar="FILE")
+    parser.add_argument("-n", "--max-insns", dest = "max_insns", type=int, default = 0, help = "Maximum number of instructions per call (0 = no limit).")
+    parser.add_argument("--timeout", dest = "timeout", type=float, default = 0, help = "Maximum number of seconds per call (0 = no limit).")
+    parser.add_argument("-R", "--record", dest = "record", default = None, help = "Record the executed PCs of every call to a binary trace file.", metavar="FILE")
+    parser.add_argument("-C", "--coverage", dest = "coverage", default = None, help = "Write the basic blocks covered by all the calls to a drcov file.", metavar="FILE")
+    parser.add_argument("-l", "--log-level", dest = "log_level", choices = LOG_LEVELS.keys(), default = 'error', help = "Set the level of system logging output.", metavar="LEVEL")
+
+    args = parser.parse_args(arguments)
+
+    if (args.function is None) == (args.invocations is None):
+        parser.error("Either --function or --invocations is required")
+
+    try:
+        image = ElfImage(args.target)
+
+        if args.invocations is None:
+            invocations = [(args.function, image.resolve(args.function),
+                            [int(arg, 0) for arg in args.args])]
+        else:
+            with open(args.invocations) as f:
+                invocations = [invocation for invocation in
+                               [parse_invocation(image, line) for line in f]
+                               if invocation is not None]
+
+            if not invocations:
+                raise ValueError("No invocation in %s" % args.invocations)
+
+        # The pages of a single call are mapped on demand, back to back calls
+        # would map them again after every restore.
+        emu = image.create_emulator(lazy=len(invocations) == 1,
+                log_level=LOG_LEVELS.get(args.log_level), stack=RUN_STACK,
+                stack_size=RUN_STACK_SIZE)
+
+        emu.start_address = invocations[0][1]
+        emu.init()
+
+    except (PimpMyRideException, IOError, ValueError), err:
+        stdout.write(json.dumps({'error' : str(err)}) + "\n")
+        return 1
+
+    # Every call starts from the initial state of the emulator.
+    snapshot = emu.snapshot()
+    timeout = int(args.timeout * 1000000) # Unicorn wants microseconds.
+
+    recorder = None
+    if args.record is not None:
+        recorder = TraceRecorder(emu, args.record)
+        recorder.start()
+
+    coverage = None
+    if args.coverage is not None:
+        coverage = BlockCoverage.for_image(emu, image)
+        coverage.start()
+
+    failures = 0
+    try:
+        for name, address, call_args in invocations:
+            emu.restore(snapshot)
+            outcome = run_invocation(emu, name, address, call_args,
+                                     args.max_insns, timeout)
+            if outcome['error'] is not None:
+                failures += 1
+
+            # Cut the block the call stopped in (if it didn't return).
+            if recorder is not None:
+                recorder.truncate(outcome['pc'])
+
+            stdout.write(json.dumps(outcome, sort_keys=True) + "\n")
+            stdout.flush()
+
+    finally:
+        if recorder is not None:
+            recorder.stop()
+
+        if coverage is not None:
+            coverage.stop()
+            coverage.write_drcov(args.coverage)
+
+    return 1 if failures else 0
+
 if __name__ == "__main__":
+    if argv[1:2] == ["run"]:
+        exit(run_main(argv[2:]))
+
     print "%s v%s\n" % (__description__, __version__)
 
     main()
@@ -16,7 +16,7 @@
 """
 
 class Protocol(object):
-    def connect(self):
+    def connect(self, timeout=None):
         return
     
     def read(self):
@@ -30,3 +30,13 @@ class Protocol(object):
     
     def setBlocking(self, blocking):
         return
+
+    def fileno(self):
+        """Return the descriptor to wait on for data (or a new connection),
+        None if there's none.
+        """
+        return None
+
+    def shutdown(self):
+        """Close the connection and stop accepting new ones."""
+        return self.close()
@@ -32,12 +32,16 @@ class Socket(Protocol):
         self.s.bind(('', self.port))
         self.s.listen(5)
     
-    def connect(self):
+    def connect(self, timeout=0.5):
+        # The listening socket is kept open between connections.
+        if self.s is None:
+            self.init()
         self.conn = None
-        self.init()
-        rr,_,_ = select.select([self.s],[],[], 0.5)
+        rr,_,_ = select.select([self.s],[],[], timeout)
         if rr:
             self.conn, _ = self.s.accept()
+            # Packets are small and latency bound, don't let Nagle hold them.
+            self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         
         return self.conn
     
@@ -45,12 +49,25 @@ class Socket(Protocol):
         return self.conn.recv(self.packet_size)
     
     def write(self, data):
-        return self.conn.send(data)
+        return self.conn.sendall(data)
     
     def close(self):
         if self.conn != None:
             self.conn.close()
-        return self.s.close()
+            self.conn = None
+    
+    def shutdown(self):
+        self.close()
+        if self.s != None:
+            self.s.close()
+            self.s = None
     
     def setBlocking(self, blocking):
         return self.conn.setblocking(blocking)
+    
+    def fileno(self):
+        if self.conn != None:
+            return self.conn.fileno()
+        if self.s is None:
+            self.init()
+        return self.s.fileno()
@@ -27,7 +27,7 @@ class WebSocket(Protocol):
         self.wss = None
         return
     
-    def connect(self):
+    def connect(self, timeout=None):
         self.wss = None
         try:
             self.wss = create_connection(self.url)
@@ -44,6 +44,12 @@ class WebSocket(Protocol):
     def close(self):
         return self.wss.close()
     
+    def fileno(self):
+        # close() leaves the connection without a socket.
+        if self.wss is None or self.wss.sock is None:
+            return None
+        return self.wss.sock.fileno()
+    
     def setBlocking(self, blocking):
         if blocking != 0:
             self.wss.settimeout(None)
@@ -14,6 +14,11 @@
  See the License for the specific language governing permissions and
  limitations under the License.
 """
+import threading
+import struct
+
+from gdbserver import signals
+from gdbserver.utility import hexDecode
 
 TARGET_RUNNING = (1 << 0)
 TARGET_HALTED = (1 << 1)
@@ -22,6 +27,13 @@ WATCHPOINT_READ = 1
 WATCHPOINT_WRITE = 2
 WATCHPOINT_READ_WRITE = 3
 
+# Stop reply reason of every watchpoint type.
+WATCHPOINT_REASONS = {
+    WATCHPOINT_READ: 'rwatch',
+    WATCHPOINT_WRITE: 'watch',
+    WATCHPOINT_READ_WRITE: 'awatch',
+}
+
 class Target(object):
 
     def __init__(self, emu, transport=None):
@@ -31,6 +43,11 @@ class Target(object):
 
         self.emu = emu
 
+        # Set while the target is halted. Listeners are called every time the
+        # target halts (potentially from the thread running the emulation).
+        self.halt_event = threading.Event()
+        self.halt_listeners = list()
+
         # We want to get notified about breakpoints hit.
         self.emu.add_breakpoint_callback(self.breakpoint_callback)
 
@@ -38,6 +55,14 @@ class Target(object):
         self.pack_format = emu.pack_format
         self.step = emu.step
 
+        # Register values read since the target halted (None if not read).
+        self.register_list = []
+        self.register_cache = None
+        self.setRegisterList([])
+
+        # TraceCollector of the targets supporting tracepoints.
+        self.tracepoints = None
+
         self.state = None
 
     @property
@@ -49,6 +74,24 @@ class Target(object):
     def state(self, state):
         """Store the current state of the application."""
         self._state = state
+        self.invalidateRegisterCache()
+
+        if state == TARGET_HALTED:
+            self.halt_event.set()
+            for listener in self.halt_listeners:
+                listener()
+        else:
+            self.halt_event.clear()
+
+    def add_halt_listener(self, listener):
+        """Add a function to call every time the target halts."""
+        if listener not in self.halt_listeners:
+            self.halt_listeners.append(listener)
+
+    def remove_halt_listener(self, listener):
+        """Stop calling a function added by add_halt_listener()."""
+        if listener in self.halt_listeners:
+            self.halt_listeners.remove(listener)
 
     def setFlash(self, flash):
         self.flash = flash
@@ -68,6 +111,9 @@ class Target(object):
     def step(self):
         return
 
+    def step_range(self, start, end):
+        return
+
     def resume(self):
         return
 
@@ -95,16 +141,16 @@ class Target(object):
     def writeCoreRegister(self, id):
         return
 
-    def setBreakpoint(self, addr):
+    def setBreakpoint(self, addr, condition=None):
         return
 
     def removeBreakpoint(self, addr):
         return
 
-    def setWatchpoint(addr, size, type):
+    def setWatchpoint(self, addr, size, type):
         return
 
-    def removeWatchpoint(addr, size, type):
+    def removeWatchpoint(self, addr, size, type):
         return
 
     def reset(self):
@@ -120,14 +166,96 @@ class Target(object):
     def getMemoryMapXML(self):
         return self.memoryMapXML
 
+    def setRegisterList(self, registers):
+        """Set the registers (in GDB order) exposed by the target."""
+        self.register_list = list(registers)
+        self.register_names = [reg.name for reg in self.register_list]
+        self.register_masks = [reg.mask for reg in self.register_list]
+
+        # The whole register context is packed at once, single registers
+        # with their own struct.
+        self.register_struct = struct.Struct(self.endian + "".join(
+            [reg.pack_format for reg in self.register_list]))
+        self.register_structs = [struct.Struct(self.endian + reg.pack_format)
+                                 for reg in self.register_list]
+        self.invalidateRegisterCache()
+
+    def invalidateRegisterCache(self):
+        """Forget the register values read since the target halted."""
+        self.register_cache = None
+
+    def getRegisterValues(self):
+        """Return the values of the registers in `register_list`.
+
+        Registers are read from the emulator once per halt.
+        """
+        if self.register_cache is None:
+            values = self.emu.read_registers(self.register_names)
+            self.register_cache = [value & mask for value, mask in
+                                   zip(values, self.register_masks)]
+        return self.register_cache
+
     def getRegisterContext(self):
-        return ''
+        """Return hexadecimal dump of registers as expected by GDB."""
+        return self.register_struct.pack(*self.getRegisterValues()).encode("hex")
 
     def setRegisterContext(self, data):
-        return
+        """Store the specified values for the appropriate registers."""
+        data = hexDecode(data)
+        if len(data) >= self.register_struct.size:
+            values = self.register_struct.unpack_from(data)
+        else:
+            # Only the first registers were sent.
+            values = []
+            offset = 0
+            for reg_struct in self.register_structs:
+                if offset + reg_struct.size > len(data):
+                    break
+                values.append(reg_struct.unpack_from(data, offset)[0])
+                offset += reg_struct.size
+
+        for name, value in zip(self.register_names, values):
+            self.emu.write_register(name, value)
+        self.invalidateRegisterCache()
 
     def setRegister(self, reg, data):
-        return
+        """Store the (hexadecimal encoded) value of a register."""
+        if reg >= len(self.register_list):
+            return False
+        value = self.register_structs[reg].unpack(hexDecode(data))[0]
+        self.emu.write_register(self.register_names[reg], value)
+        self.invalidateRegisterCache()
+        return True
+
+    def gdbGetRegister(self, reg):
+        """Return the hexadecimal encoded value of a register."""
+        if reg >= len(self.register_list):
+            return ''
+        value = self.getRegisterValues()[reg]
+        return self.register_structs[reg].pack(value).encode("hex")
 
     def getTResponse(self, gdbInterrupt = False):
-        return ''
+        """
+        Returns a GDB T response string.  This includes:
+            The signal encountered.
+            The watchpoint hit (if any).
+            The current value of the expedited registers (pc, sp, ...).
+        """
+        if gdbInterrupt:
+            resp = ['T%02x' % signals.SIGINT]
+        else:
+            resp = ['T%02x' % signals.SIGTRAP]
+
+            # The watchpoint that stopped the target (if any) and the data
+            # address accessed.
+            if self.emu.watchpoint_hit is not None:
+                kind, address = self.emu.watchpoint_hit
+                resp.append('%s:%x;' % (WATCHPOINT_REASONS[kind], address))
+
+        values = self.getRegisterValues()
+        for reg in self.emu.registers.expedited:
+            number = reg.gdb_number
+            resp.append('%02x:%s;' % (number,
+                self.register_structs[number].pack(values[number]).encode("hex")))
+
+        return "".join(resp)
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+__author__       = "Sebastian 'topo' Muniz"
+__copyright__   = "Copyright 2017"
+__credits__     = []
+__license__     = "GPL"
+__version__     = "0.1"
+__maintainer__  = "Sebastian Muniz"
+__email__       = "sebastianmuniz@gmail.com"
+__description__ = "Pimped out multi-architecture CPU emulator"
+
+from array import array
+import logging
+import struct
+
+from gdbserver.agent_expr import AgentExpressionError
+from utility.conversion import uint64_array
+
+__all__ = ["Tracepoint", "TraceBuffer", "TraceFrame", "TraceCollector",
+        "TRACE_BUFFER_SIZE"]
+
+# Default size of the frame buffer (in bytes).
+TRACE_BUFFER_SIZE = 0x100000
+
+# Frame blocks: registers, memory and trace state variables.
+BLOCK_REGISTERS = 'R'
+BLOCK_MEMORY = 'M'
+BLOCK_VARIABLE = 'V'
+
+_MEMORY_HEADER = struct.Struct('<QH')       # Address and length.
+_VARIABLE_BLOCK = struct.Struct('<IQ')      # Number and value.
+
+# Largest memory block (the length has to fit in the block header).
+MAX_MEMORY_BLOCK = 0xFFFF
+
+# Reasons the trace run stopped (as reported to GDB).
+TRACE_NOT_RUN = 'tnotrun'
+TRACE_STOPPED = 'tstop'
+TRACE_FULL = 'tfull'
+TRACE_PASSCOUNT = 'tpasscount'
+TRACE_ERROR = 'terror'
+
+
+class Tracepoint(object):
+    """Address to collect data at (without stopping) and what to collect."""
+
+    def __init__(self, number, address, enabled=True, step_count=0,
+            pass_count=0):
+        self.number = number
+        self.address = address
+        self.enabled = enabled
+        self.step_count = step_count
+        self.pass_count = pass_count    # Stop the trace after n hits (0 = no).
+
+        self.condition = None           # AgentExpression (None = always).
+        self.registers = False          # Collect the registers.
+        self.memory = list()            # (base register, offset, length).
+        self.expressions = list()       # AgentExpression collecting data.
+
+        self.hits = 0
+
+    def __repr__(self):
+        return "<Tracepoint %d at 0x%X>" % (self.number, self.address)
+
+
+class TraceBuffer(object):
+    """Frames collected by the tracepoints.
+
+    Frames are stored back to back in a single bytearray, along with two
+    arrays holding where every frame starts and the tracepoint that
+    collected it. A full buffer either refuses new frames or, if it's
+    circular, drops the oldest ones. Dropped frames are only compacted away
+    once they take half of the storage, so dropping is amortized O(1).
+    """
+
+    def __init__(self, size=TRACE_BUFFER_SIZE, circular=False):
+        self.size = size
+        self.circular = circular
+        self.clear()
+
+    def clear(self):
+        """Drop every frame."""
+        self._data = bytearray()
+        # Frame offsets (plus _base), 64-bit as _base keeps growing when the
+        # buffer is circular. Tracepoint numbers are 32-bit in GDB.
+        self._starts = uint64_array()
+        self._tracepoints = array('I')  # Tracepoint number of every frame.
+        self._first = 0                 # Index of the oldest frame.
+        self._base = 0                  # Offset of _data[0].
+        self.created = 0                # Frames created since the clear.
+
+    def __len__(self):
+        return len(self._starts) - self._first
+
+    @property
+    def used(self):
+        """Return the number of bytes used by the frames."""
+        if not len(self):
+            return 0
+        return len(self._data) - (self._starts[self._first] - self._base)
+
+    @property
+    def free(self):
+        """Return the number of bytes available for new frames."""
+        return self.size - self.used
+
+    def add(self, tracepoint, data):
+        """Store a frame collected by a tracepoint.
+
+        Return False if it doesn't fit (the buffer is full).
+        """
+        if len(data) > self.size:
+            return False
+
+        while len(data) > self.free:
+            if not self.circular:
+                return False
+            self._drop_oldest()
+
+        self._starts.append(self._base + len(self._data))
+        self._tracepoints.append(tracepoint)
+        self._data.extend(data)
+        self.created += 1
+        return True
+
+    def _drop_oldest(self):
+        """Forget the oldest frame."""
+        self._first += 1
+
+        if not len(self):
+            del self._data[:]
+            del self._starts[:]
+            del self._tracepoints[:]
+            self._first = 0
+            self._base = 0
+            return
+
+        dropped = self._starts[self._first] - self._base
+        if dropped > len(self._data) // 2:
+            del self._data[:dropped]
+            del self._starts[:self._first]
+            del self._tracepoints[:self._first]
+            self._base += dropped
+            self._first = 0
+
+    def tracepoint(self, number):
+        """Return the number of the tracepoint that collected a frame."""
+        return self._tracepoints[self._first + number]
+
+    def frame_data(self, number):
+        """Return the contents of a frame (0 is the oldest one)."""
+        idx = self._first + number
+        start = self._starts[idx] - self._base
+        if idx + 1 < len(self._starts):
+            end = self._starts[idx + 1] - self._base
+        else:
+            end = len(self._data)
+        return str(self._data[start:end])
+
+
+class TraceFrame(object):
+    """Decoded contents of a frame of the trace buffer."""
+
+    def __init__(self, number, tracepoint, data):
+        self.number = number
+        self.tracepoint = tracepoint
+        self.registers = None           # Packed registers (if collected).
+        self.memory = list()            # (address, data) blocks.
+        self.variables = dict()
+
+        pos = 0
+        while pos < len(data):
+            block = data[pos]
+            pos += 1
+            if block == BLOCK_REGISTERS:
+                size, = struct.unpack_from('<H', data, pos)
+                self.registers = data[pos + 2:pos + 2 + size]
+                pos += 2 + size
+            elif block == BLOCK_MEMORY:
+                address, length = _MEMORY_HEADER.unpack_from(data, pos)
+                pos += _MEMORY_HEADER.size
+                self.memory.append((address, data[pos:pos + length]))
+                pos += length
+            else:
+                number, value = _VARIABLE_BLOCK.unpack_from(data, pos)
+                self.variables[number] = value
+                pos += _VARIABLE_BLOCK.size
+
+    def read_memory(self, address, size):
+        """Return the collected bytes from the address on (up to `size`,
+        empty if the address wasn't collected).
+        """
+        for start, data in self.memory:
+            if start <= address < start + len(data):
+                return data[address - start:address - start + size]
+        return ""
+
+
+class TraceCollector(object):
+    """Tracepoints of an emulator and the frames they collected.
+
+    While tracing, every tracepoint address gets a code hook collecting its
+    data into the TraceBuffer; the emulation never stops for them.
+    Tracepoints with while-stepping actions only collect their first frame.
+    """
+
+    def __init__(self, emu, registers, logger=None):
+        self.emu = emu
+        self.logger = logger or logging.getLogger(type(self).__name__)
+
+        # Registers (in GDB order) packed in the register blocks.
+        self.register_names = [reg.name for reg in registers]
+        self.register_masks = [reg.mask for reg in registers]
+        self.register_struct = struct.Struct(emu.pack_endian + "".join(
+            [reg.pack_format for reg in registers]))
+
+        self.buffer = TraceBuffer()
+        self.tracepoints = dict()
+        self.initial_variables = dict()
+        self.variables = dict()
+
+        self.running = False
+        self.stop_reason = TRACE_NOT_RUN
+        self.stop_tracepoint = 0
+
+        self.__hooks = list()
+        self.__by_address = dict()
+
+    def clear(self):
+        """Forget the tracepoints, the variables and the collected frames."""
+        self.stop()
+        self.tracepoints.clear()
+        self.initial_variables.clear()
+        self.variables.clear()
+        self.buffer.clear()
+        self.stop_reason = TRACE_NOT_RUN
+
+    def add_tracepoint(self, tracepoint):
+        """Add (or replace) a tracepoint."""
+        self.tracepoints[tracepoint.number] = tracepoint
+
+    def define_variable(self, number, value):
+        """Define a trace state variable and its initial value."""
+        self.initial_variables[number] = value
+
+    def start(self):
+        """Start a new trace run, previous frames are dropped."""
+        self.stop()
+
+        self.buffer.clear()
+        self.variables = dict(self.initial_variables)
+        self.stop_reason = TRACE_NOT_RUN
+        self.stop_tracepoint = 0
+
+        self.__by_address = dict()
+        for number in sorted(self.tracepoints):
+            tracepoint = self.tracepoints[number]
+            tracepoint.hits = 0
+            self.__by_address.setdefault(tracepoint.address, []).append(
+                tracepoint)
+
+        # One hook per address, whatever the number of tracepoints there.
+        for address in self.__by_address:
+            self.__hooks.append(self.emu.add_address_hook(address, self.__hit))
+
+        self.running = True
+
+    def stop(self, reason=TRACE_STOPPED, tracepoint=0):
+        """Stop the trace run (if any)."""
+        self.__halt(reason, tracepoint)
+
+        # Hooks can't be removed from a hook, the ones left behind are
+        # removed here (and do nothing until then).
+        for handle in self.__hooks:
+            self.emu.remove_hook(handle)
+        self.__hooks = list()
+
+    def __halt(self, reason, tracepoint=0):
+        """Stop collecting frames."""
+        if self.running:
+            self.running = False
+            self.stop_reason = reason
+            self.stop_tracepoint = tracepoint
+
+    def find_frame(self, start, match):
+        """Return the number of the first frame (from `start` on) whose
+        tracepoint satisfies `match`, None if there's none.
+        """
+        for number in xrange(start, len(self.buffer)):
+            tracepoint = self.tracepoints.get(self.buffer.tracepoint(number))
+            if tracepoint is not None and match(tracepoint):
+                return number
+        return None
+
+    def frame(self, number):
+        """Return the TraceFrame of a frame number."""
+        return TraceFrame(number, self.buffer.tracepoint(number),
+                          self.buffer.frame_data(number))
+
+    def __hit(self, emu, address):
+        """Collect the frames of the tracepoints at the executed address."""
+        if not self.running:
+            return
+
+        for tracepoint in self.__by_address.get(address, ()):
+            if not tracepoint.enabled:
+                continue
+
+            try:
+                if tracepoint.condition is not None and \
+                        not tracepoint.condition.evaluate(emu, self.variables):
+                    continue
+
+                data = self.__collect(emu, tracepoint)
+
+            except AgentExpressionError, err:
+                self.logger.error("Tracepoint %d failed: %s",
+                                  tracepoint.number, err)
+                self.__halt(TRACE_ERROR, tracepoint.number)
+                return
+
+            tracepoint.hits += 1
+
+            if not self.buffer.add(tracepoint.number, data):
+                self.__halt(TRACE_FULL)
+                return
+
+            if tracepoint.pass_count and \
+                    tracepoint.hits >= tracepoint.pass_count:
+                self.__halt(TRACE_PASSCOUNT, tracepoint.number)
+                return
+
+    def __collect(self, emu, tracepoint):
+        """Return the frame data collected by a tracepoint."""
+        blocks = []
+
+        def collect_memory(address, size):
+            size = min(size, MAX_MEMORY_BLOCK)
+            data = emu.read_memory(address, size)
+            if data:
+                blocks.append(BLOCK_MEMORY)
+                blocks.append(_MEMORY_HEADER.pack(address, len(data)))
+                blocks.append(data)
+
+        def collect(kind, where, value):
+            if kind == 'memory':
+                collect_memory(where, value)
+            else:
+                blocks.append(BLOCK_VARIABLE)
+                blocks.append(_VARIABLE_BLOCK.pack(where,
+                                                   value & 0xFFFFFFFFFFFFFFFF))
+
+        if tracepoint.registers:
+            values = emu.read_registers(self.register_names)
+            registers = self.register_struct.pack(*[value & mask
+                for value, mask in zip(values, self.register_masks)])
+            blocks.append(BLOCK_REGISTERS)
+            blocks.append(struct.pack('<H', len(registers)))
+            blocks.append(registers)
+
+        for base, offset, length in tracepoint.memory:
+            address = offset
+            if base is not None:
+                address += emu.read_register(self.register_names[base])
+            collect_memory(address & 0xFFFFFFFFFFFFFFFF, length)
+
+        for expression in tracepoint.expressions:
+            expression.evaluate(emu, self.variables, collect)
+
+        return "".join(blocks)
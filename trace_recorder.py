@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+__author__       = "Sebastian 'topo' Muniz"
+__copyright__   = "Copyright 2017"
+__credits__     = []
+__license__     = "GPL"
+__version__     = "0.1"
+__maintainer__  = "Sebastian Muniz"
+__email__       = "sebastianmuniz@gmail.com"
+__description__ = "Pimped out multi-architecture CPU emulator"
+
+from array import array
+import struct
+import zlib
+
+from pimp_my_ride import PimpMyRideException
+from utility.conversion import uint64_array
+
+__all__ = ["TraceRecorder", "TraceReader", "TRACE_CHUNK_BLOCKS"]
+
+# Number of basic blocks buffered before they're flushed as a chunk.
+TRACE_CHUNK_BLOCKS = 0x10000
+
+# File header: magic, version and flags.
+_TRACE_MAGIC = "PMRTRACE"
+_TRACE_VERSION = 1
+_FILE_HEADER = struct.Struct('<8sHH')
+
+# Chunk header: number of instructions and size of the compressed data.
+_CHUNK_HEADER = struct.Struct('<II')
+
+# The chunks hold the instruction sizes (one byte each) after the PCs.
+FLAG_SIZES = 0x1
+
+_MASK = (1 << 64) - 1
+
+
+def _varint(value):
+    """Return the LEB128 encoding of an unsigned value."""
+    data = bytearray()
+    while value > 0x7F:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    data.append(value)
+    return str(data)
+
+
+def _zigzag(value):
+    """Map a signed 64bits value to an unsigned one, small magnitudes to
+    small values.
+    """
+    value = (value + (1 << 63)) & _MASK
+    value -= 1 << 63
+    return ((value << 1) ^ (value >> 63)) & _MASK
+
+
+def _unzigzag(value):
+    """Reverse _zigzag()."""
+    return (value >> 1) ^ -(value & 1)
+
+
+class TraceRecorder(object):
+    """Record the PCs executed by a PimpMyRide emulator to a binary file.
+
+    The hook runs once per basic block and only appends the block address
+    and size to an array. Once TRACE_CHUNK_BLOCKS blocks are buffered they
+    are expanded into the PCs of their instructions and written as a chunk:
+    the PCs encoded as varint deltas (zigzag, backward jumps are negative),
+    followed by the instruction sizes if requested, all compressed with zlib.
+
+    Every block is disassembled once and the encoding of every jump from a
+    block to the next one is computed once, so flushing a chunk is mostly
+    joining cached strings.
+
+    The spurious report Unicorn makes of the first block of an emulation is
+    dropped. Blocks are disassembled when flushed, self-modifying code gets
+    the instructions found then. A block cut short by a stop is recorded
+    whole, except for the last one which stop() truncates at the current PC.
+    """
+
+    def __init__(self, emu, filename, sizes=False,
+                 chunk_blocks=TRACE_CHUNK_BLOCKS):
+        self.emu = emu
+        self.filename = filename
+        self.sizes = sizes
+        self.chunk_blocks = chunk_blocks
+
+        self.instructions = 0       # Instructions written so far.
+        self.chunks = 0
+
+        # Block address and size pairs.
+        self._buffer = uint64_array()
+        self._blocks = dict()       # (address, size) to its encoding.
+        self._edges = dict()        # (block, next block) to its encoding.
+        self._lengths = dict()      # Block to its number of instructions.
+        self._sizes = dict()        # Block to its instruction sizes.
+        self._last_block = None
+        self._spurious = None       # Where the spurious report will be.
+        self._file = None
+        self._hook = None
+
+    def start(self):
+        """Create the trace file and start recording."""
+        if self._hook is not None:
+            raise PimpMyRideException("Trace already being recorded")
+
+        self._file = open(self.filename, 'wb')
+        self._file.write(_FILE_HEADER.pack(_TRACE_MAGIC, _TRACE_VERSION,
+                                           FLAG_SIZES if self.sizes else 0))
+
+        self._hook = self.emu.add_block_hook(self._block_callback())
+        self.emu.add_start_callback(self._emulation_started)
+
+    def stop(self):
+        """Stop recording, write what's buffered and close the file."""
+        if self._hook is None:
+            return
+
+        self.emu.remove_hook(self._hook)
+        self.emu.remove_start_callback(self._emulation_started)
+        self._hook = None
+
+        self.truncate(self.emu.read_register("pc"))
+        self.flush()
+        self._spurious = None
+
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _block_callback(self):
+        """Return the block hook, it only touches local names."""
+        buffer = self._buffer
+        append = buffer.append
+        limit = self.chunk_blocks * 2
+        flush = self.flush
+
+        def callback(_uc, address, size, user_data):
+            append(address)
+            append(size)
+            if len(buffer) >= limit:
+                flush()
+
+        return callback
+
+    def _emulation_started(self, emu):
+        """Start callback: expect a spurious report (see add_block_hook())."""
+        self._drop_spurious()
+        if emu.emulations:
+            self._spurious = len(self._buffer)
+
+    def _drop_spurious(self):
+        """Drop the spurious report of the current emulation (if made)."""
+        if self._spurious is not None and len(self._buffer) > self._spurious:
+            del self._buffer[self._spurious:self._spurious + 2]
+            self._spurious = None
+
+    def truncate(self, pc):
+        """Drop the instructions of the last block from `pc` on, the
+        emulation stopped there before executing them.
+        """
+        self._drop_spurious()
+
+        buffer = self._buffer
+        if not buffer:
+            return
+
+        address, size = buffer[-2], buffer[-1]
+        if address <= pc < address + size:
+            if pc == address:
+                del buffer[-2:]
+            else:
+                buffer[-1] = pc - address
+
+    def flush(self):
+        """Write the buffered blocks as a chunk."""
+        self._drop_spurious()
+
+        buffer = self._buffer
+        if not buffer or self._file is None:
+            return
+
+        blocks = zip(buffer[0::2], buffer[1::2])
+        edges = zip([self._last_block] + blocks[:-1], blocks)
+
+        for edge in set(edges).difference(self._edges):
+            self._edges[edge] = self._encode_edge(*edge)
+
+        data = "".join(map(self._edges.get, edges))
+        if self.sizes:
+            data += "".join(map(self._sizes.get, blocks))
+
+        count = sum(map(self._lengths.get, blocks))
+
+        data = zlib.compress(data)
+        self._file.write(_CHUNK_HEADER.pack(count, len(data)))
+        self._file.write(data)
+
+        self._last_block = blocks[-1]
+        self.instructions += count
+        self.chunks += 1
+        del buffer[:]
+        self._spurious = None
+
+    def _encode_edge(self, previous, block):
+        """Return the encoding of the PCs of a block executed after another
+        one (None if it's the first one).
+        """
+        last_pc = self._block(previous)[1] if previous is not None else 0
+        body = self._block(block)[0]
+        return _varint(_zigzag(block[0] - last_pc)) + body
+
+    def _block(self, block):
+        """Return the encoding of the deltas between the PCs of a block (the
+        one to its first PC excluded) and its last PC.
+        """
+        if block not in self._blocks:
+            address, size = block
+            instructions = self.emu.instructions(address, size) or \
+                    [(address, size)]
+
+            body = "".join([_varint(_zigzag(insn_size))
+                            for insn_address, insn_size in instructions[:-1]])
+
+            self._blocks[block] = (body, instructions[-1][0])
+            self._lengths[block] = len(instructions)
+            self._sizes[block] = "".join([chr(min(insn_size, 0xFF))
+                    for insn_address, insn_size in instructions])
+
+        return self._blocks[block]
+
+
+class TraceReader(object):
+    """Lazy reader of the files written by TraceRecorder.
+
+    Iterating it yields the executed PCs (or (pc, size) tuples when the
+    sizes were recorded and asked for), a chunk is only read and
+    decompressed when the iteration gets to it.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        with open(filename, 'rb') as f:
+            header = f.read(_FILE_HEADER.size)
+
+        if len(header) != _FILE_HEADER.size:
+            raise PimpMyRideException("Truncated trace %s" % filename)
+
+        magic, version, flags = _FILE_HEADER.unpack(header)
+        if magic != _TRACE_MAGIC or version != _TRACE_VERSION:
+            raise PimpMyRideException("Invalid trace %s" % filename)
+
+        self.has_sizes = bool(flags & FLAG_SIZES)
+
+    def __iter__(self):
+        return self.pcs()
+
+    def __len__(self):
+        """Return the number of instructions (only chunk headers are
+        read).
+        """
+        return sum([count for count, data in self._chunks(False)])
+
+    def _chunks(self, read=True):
+        """Yield the (count, compressed data) of every chunk (the data is
+        None unless `read`).
+        """
+        with open(self.filename, 'rb') as f:
+            f.seek(_FILE_HEADER.size)
+            while True:
+                header = f.read(_CHUNK_HEADER.size)
+                if not header:
+                    return
+                if len(header) != _CHUNK_HEADER.size:
+                    raise PimpMyRideException(
+                        "Truncated trace %s" % self.filename)
+
+                count, length = _CHUNK_HEADER.unpack(header)
+                if read:
+                    data = f.read(length)
+                else:
+                    data = None
+                    f.seek(length, 1)
+
+                yield count, data
+
+    def chunks(self):
+        """Yield the PCs (and sizes, None if not recorded) of every chunk as
+        arrays.
+        """
+        pc = 0
+        for count, data in self._chunks():
+            data = zlib.decompress(data)
+            pcs = uint64_array()
+            pos = 0
+
+            for _ in xrange(count):
+                value = shift = 0
+                while True:
+                    byte = ord(data[pos])
+                    pos += 1
+                    value |= (byte & 0x7F) << shift
+                    shift += 7
+                    if byte < 0x80:
+                        break
+
+                pc = (pc + _unzigzag(value)) & _MASK
+                pcs.append(pc)
+
+            sizes = None
+            if self.has_sizes:
+                sizes = array('B', data[pos:pos + count])
+
+            yield pcs, sizes
+
+    def pcs(self, sizes=False):
+        """Yield the executed PCs, as (pc, size) tuples if `sizes`."""
+        if sizes and not self.has_sizes:
+            raise PimpMyRideException(
+                "No instruction sizes in %s" % self.filename)
+
+        for pcs, chunk_sizes in self.chunks():
+            if sizes:
+                for item in zip(pcs, chunk_sizes):
+                    yield item
+            else:
+                for pc in pcs:
+                    yield pc
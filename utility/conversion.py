@@ -15,6 +15,7 @@
  limitations under the License.
 """
 
+from array import array
 import struct
 
 ## @brief Convert a byte array into a word array.
@@ -104,3 +105,23 @@ def hexDecode(cmd):
 def hexEncode(string):
     return ''.join(['%02x' % ord(i) for i in string])
 
+
+def _uint64Typecode():
+    for typecode in ('Q', 'L'):
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    return None
+
+## @brief Array typecode of unsigned 64-bit integers, None if the host has
+# none (Python 2 has no 'Q', and 'L' is 32-bit on Windows and 32-bit hosts).
+UINT64_TYPECODE = _uint64Typecode()
+
+## @brief Create a growable sequence of unsigned 64-bit integers: an array
+# where the host has a 64-bit typecode, a list otherwise.
+def uint64_array(values=()):
+    if UINT64_TYPECODE is None:
+        return list(values)
+    return array(UINT64_TYPECODE, values)
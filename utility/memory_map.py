@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+__author__       = "Sebastian 'topo' Muniz"
+__copyright__   = "Copyright 2017"
+__credits__     = []
+__license__     = "GPL"
+__version__     = "0.1"
+__maintainer__  = "Sebastian Muniz"
+__email__       = "sebastianmuniz@gmail.com"
+__description__ = "Pimped out multi-architecture CPU emulator"
+
+from bisect import bisect_left, bisect_right
+
+__all__ = ["MemoryMap"]
+
+
+class MemoryMap(object):
+    """Sorted index of the mapped memory ranges.
+
+    Ranges are stored as two parallel sorted lists holding the start and the
+    (exclusive) end address of every range. Overlapping or adjacent ranges
+    are merged on insertion, so every query is a single bisect.
+    """
+
+    def __init__(self):
+        self._starts = []
+        self._ends = []
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __iter__(self):
+        return iter(self.regions())
+
+    def __repr__(self):
+        return "<MemoryMap %s>" % ", ".join(
+            ["0x%08X-0x%08X" % (start, end) for start, end in self.regions()])
+
+    def clear(self):
+        """Forget every mapped range."""
+        del self._starts[:]
+        del self._ends[:]
+
+    def add(self, address, size):
+        """Add the range [address, address + size) to the index."""
+        start = address
+        end = address + size
+
+        # Ranges touching the new one are contiguous in both lists: from the
+        # first one ending at or after `start` to the last one starting at or
+        # before `end`.
+        lo = bisect_left(self._ends, start)
+        hi = bisect_right(self._starts, end)
+
+        if lo < hi:
+            start = min(start, self._starts[lo])
+            end = max(end, self._ends[hi - 1])
+
+        self._starts[lo:hi] = [start]
+        self._ends[lo:hi] = [end]
+
+    def remove(self, address, size):
+        """Remove the range [address, address + size) from the index,
+        splitting any range partially covered by it.
+        """
+        start = address
+        end = address + size
+
+        lo = bisect_right(self._ends, start)
+        hi = bisect_left(self._starts, end)
+
+        if lo >= hi:
+            return
+
+        starts = []
+        ends = []
+
+        # Keep whatever lies outside of the removed range.
+        if self._starts[lo] < start:
+            starts.append(self._starts[lo])
+            ends.append(start)
+
+        if self._ends[hi - 1] > end:
+            starts.append(end)
+            ends.append(self._ends[hi - 1])
+
+        self._starts[lo:hi] = starts
+        self._ends[lo:hi] = ends
+
+    def contains(self, start_address, end_address):
+        """Return True if [start_address, end_address) is entirely mapped."""
+        idx = bisect_right(self._starts, start_address) - 1
+        return idx >= 0 and end_address <= self._ends[idx]
+
+    def overlaps(self, start_address, end_address):
+        """Return True if any byte of [start_address, end_address) is
+        mapped.
+        """
+        idx = bisect_right(self._ends, start_address)
+        return idx < len(self._starts) and self._starts[idx] < end_address
+
+    def find(self, address):
+        """Return the (start, end) range containing the address (if any)."""
+        idx = bisect_right(self._starts, address) - 1
+        if idx >= 0 and address < self._ends[idx]:
+            return (self._starts[idx], self._ends[idx])
+        return None
+
+    def intersection(self, start_address, end_address):
+        """Return the mapped (start, end) pieces of the given range."""
+        pieces = []
+        idx = bisect_right(self._ends, start_address)
+        while idx < len(self._starts) and self._starts[idx] < end_address:
+            pieces.append((max(start_address, self._starts[idx]),
+                           min(end_address, self._ends[idx])))
+            idx += 1
+        return pieces
+
+    def gaps(self, start_address, end_address):
+        """Return the unmapped (start, end) pieces of the given range."""
+        pieces = []
+        current = start_address
+        for start, end in self.intersection(start_address, end_address):
+            if start > current:
+                pieces.append((current, start))
+            current = end
+        if current < end_address:
+            pieces.append((current, end_address))
+        return pieces
+
+    def regions(self):
+        """Return the list of mapped (start, end) ranges sorted by address."""
+        return zip(self._starts, self._ends)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+__author__       = "Sebastian 'topo' Muniz"
+__copyright__   = "Copyright 2017"
+__credits__     = []
+__license__     = "GPL"
+__version__     = "0.1"
+__maintainer__  = "Sebastian Muniz"
+__email__       = "sebastianmuniz@gmail.com"
+__description__ = "Pimped out multi-architecture CPU emulator"
+
+import unicorn as uc
+
+from unicorn.arm64_const import *
+from unicorn.arm_const import *
+from unicorn.x86_const import *
+from unicorn.mips_const import *
+
+__all__ = ["Register", "RegisterTable", "get_register_table"]
+
+# Struct format of the registers by size (in bits).
+PACK_FORMATS = {8: 'B', 16: 'H', 32: 'I', 64: 'Q'}
+
+
+class Register(object):
+    """Description of a CPU register."""
+
+    def __init__(self, name, uc_id, bits, reg_type='int', group='general'):
+        self.name = name
+        self.uc_id = uc_id          # None if Unicorn doesn't emulate it.
+        self.bits = bits
+        self.size = bits / 8
+        self.mask = (1 << bits) - 1
+        self.pack_format = PACK_FORMATS[bits]
+        self.type = reg_type
+        self.group = group
+        self.gdb_number = None      # Set by the table holding the register.
+
+    def __repr__(self):
+        return "<Register %s (%d bits)>" % (self.name, self.bits)
+
+
+class RegisterTable(object):
+    """Registers of an architecture (and mode) in GDB order.
+
+    The position of every register in the table is its GDB register number
+    (and its position in 'g' packets). Registers can be found by their name,
+    their aliases or by the generic 'pc', 'sp', 'fp' and 'ra' names.
+
+    `gdb_feature` names the GDB target description feature matching the
+    table. It's None when GDB would reject a description holding only these
+    registers, GDB's built-in layout (which the table follows) is used then.
+    """
+
+    def __init__(self, registers, pc, sp, fp=None, ra=None, aliases=None,
+                 gdb_architecture=None, gdb_feature=None):
+        self.registers = registers
+        self.gdb_architecture = gdb_architecture
+        self.gdb_feature = gdb_feature
+        self.by_name = dict()
+
+        for number, reg in enumerate(registers):
+            reg.gdb_number = number
+            self.by_name[reg.name] = reg
+
+        for alias, name in (aliases or {}).iteritems():
+            self.by_name[alias] = self.by_name[name]
+
+        self.pc = self.by_name[pc]
+        self.sp = self.by_name[sp]
+        self.fp = self.by_name[fp] if fp else None
+        self.ra = self.by_name[ra] if ra else None
+
+        for name, reg in (('pc', self.pc), ('sp', self.sp), ('fp', self.fp),
+                          ('ra', self.ra)):
+            if reg is not None:
+                self.by_name.setdefault(name, reg)
+
+        # Register name (or alias) to Unicorn id.
+        self.ids = dict([(name, reg.uc_id)
+                         for name, reg in self.by_name.iteritems()])
+
+        # Registers sent along with every stop reply.
+        self.expedited = sorted(
+            [reg for reg in set([self.fp, self.ra, self.sp, self.pc]) if reg],
+            key=lambda reg: reg.gdb_number)
+
+    def __len__(self):
+        return len(self.registers)
+
+    def __iter__(self):
+        return iter(self.registers)
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def __getitem__(self, name):
+        return self.by_name[name]
+
+
+def _x86_16_table():
+    regs = [Register(name, uc_id, 16) for name, uc_id in (
+        ('ax', UC_X86_REG_AX), ('cx', UC_X86_REG_CX), ('dx', UC_X86_REG_DX),
+        ('bx', UC_X86_REG_BX), ('sp', UC_X86_REG_SP), ('bp', UC_X86_REG_BP),
+        ('si', UC_X86_REG_SI), ('di', UC_X86_REG_DI), ('ip', UC_X86_REG_IP),
+        ('flags', UC_X86_REG_EFLAGS), ('cs', UC_X86_REG_CS),
+        ('ss', UC_X86_REG_SS), ('ds', UC_X86_REG_DS), ('es', UC_X86_REG_ES),
+        ('fs', UC_X86_REG_FS), ('gs', UC_X86_REG_GS))]
+    return RegisterTable(regs, pc='ip', sp='sp', fp='bp',
+                         gdb_architecture='i8086')
+
+
+def _x86_32_table():
+    regs = [Register(name, uc_id, 32) for name, uc_id in (
+        ('eax', UC_X86_REG_EAX), ('ecx', UC_X86_REG_ECX),
+        ('edx', UC_X86_REG_EDX), ('ebx', UC_X86_REG_EBX),
+        ('esp', UC_X86_REG_ESP), ('ebp', UC_X86_REG_EBP),
+        ('esi', UC_X86_REG_ESI), ('edi', UC_X86_REG_EDI),
+        ('eip', UC_X86_REG_EIP), ('eflags', UC_X86_REG_EFLAGS),
+        ('cs', UC_X86_REG_CS), ('ss', UC_X86_REG_SS), ('ds', UC_X86_REG_DS),
+        ('es', UC_X86_REG_ES), ('fs', UC_X86_REG_FS), ('gs', UC_X86_REG_GS))]
+    regs[4].type = regs[5].type = 'data_ptr'
+    regs[8].type = 'code_ptr'
+    return RegisterTable(regs, pc='eip', sp='esp', fp='ebp',
+                         gdb_architecture='i386')
+
+
+def _x86_64_table():
+    regs = [Register(name, uc_id, 64) for name, uc_id in (
+        ('rax', UC_X86_REG_RAX), ('rbx', UC_X86_REG_RBX),
+        ('rcx', UC_X86_REG_RCX), ('rdx', UC_X86_REG_RDX),
+        ('rsi', UC_X86_REG_RSI), ('rdi', UC_X86_REG_RDI),
+        ('rbp', UC_X86_REG_RBP), ('rsp', UC_X86_REG_RSP),
+        ('r8', UC_X86_REG_R8), ('r9', UC_X86_REG_R9),
+        ('r10', UC_X86_REG_R10), ('r11', UC_X86_REG_R11),
+        ('r12', UC_X86_REG_R12), ('r13', UC_X86_REG_R13),
+        ('r14', UC_X86_REG_R14), ('r15', UC_X86_REG_R15),
+        ('rip', UC_X86_REG_RIP))]
+    # GDB sends the flags and segment registers as 32bits values.
+    regs += [Register(name, uc_id, 32) for name, uc_id in (
+        ('eflags', UC_X86_REG_EFLAGS), ('cs', UC_X86_REG_CS),
+        ('ss', UC_X86_REG_SS), ('ds', UC_X86_REG_DS), ('es', UC_X86_REG_ES),
+        ('fs', UC_X86_REG_FS), ('gs', UC_X86_REG_GS))]
+    regs[6].type = regs[7].type = 'data_ptr'
+    regs[16].type = 'code_ptr'
+    return RegisterTable(regs, pc='rip', sp='rsp', fp='rbp',
+                         gdb_architecture='i386:x86-64')
+
+
+def _arm_table():
+    regs = [Register("r%d" % i, UC_ARM_REG_R0 + i, 32) for i in xrange(13)]
+    regs += [Register('sp', UC_ARM_REG_SP, 32, 'data_ptr'),
+             Register('lr', UC_ARM_REG_LR, 32),
+             Register('pc', UC_ARM_REG_PC, 32, 'code_ptr'),
+             Register('cpsr', UC_ARM_REG_CPSR, 32)]
+    aliases = {'r13': 'sp', 'r14': 'lr', 'r15': 'pc', 'sb': 'r9',
+               'sl': 'r10', 'fp': 'r11', 'ip': 'r12'}
+    return RegisterTable(regs, pc='pc', sp='sp', fp='r11', ra='lr',
+                         aliases=aliases, gdb_architecture='arm',
+                         gdb_feature='org.gnu.gdb.arm.core')
+
+
+def _arm64_table():
+    regs = [Register("x%d" % i, UC_ARM64_REG_X0 + i, 64) for i in xrange(29)]
+    regs += [Register('x29', UC_ARM64_REG_X29, 64, 'data_ptr'),
+             Register('x30', UC_ARM64_REG_X30, 64),
+             Register('sp', UC_ARM64_REG_SP, 64, 'data_ptr'),
+             Register('pc', UC_ARM64_REG_PC, 64, 'code_ptr'),
+             Register('cpsr', UC_ARM64_REG_NZCV, 32)]
+    aliases = dict([("r%d" % i, "x%d" % i) for i in xrange(31)])
+    aliases.update({'r31': 'sp', 'fp': 'x29', 'lr': 'x30'})
+    return RegisterTable(regs, pc='pc', sp='sp', fp='x29', ra='x30',
+                         aliases=aliases, gdb_architecture='aarch64',
+                         gdb_feature='org.gnu.gdb.aarch64.core')
+
+
+def _mips_table(bits):
+    names = ('zero', 'at', 'v0', 'v1', 'a0', 'a1', 'a2', 'a3',
+             't0', 't1', 't2', 't3', 't4', 't5', 't6', 't7',
+             's0', 's1', 's2', 's3', 's4', 's5', 's6', 's7',
+             't8', 't9', 'k0', 'k1', 'gp', 'sp', 'fp', 'ra')
+    regs = [Register(name, UC_MIPS_REG_ZERO + i, bits)
+            for i, name in enumerate(names)]
+    # The coprocessor 0 registers aren't emulated by Unicorn.
+    regs += [Register('sr', None, bits),
+             Register('lo', UC_MIPS_REG_LO, bits),
+             Register('hi', UC_MIPS_REG_HI, bits),
+             Register('bad', None, bits),
+             Register('cause', None, bits),
+             Register('pc', UC_MIPS_REG_PC, bits, 'code_ptr')]
+    regs[29].type = regs[30].type = 'data_ptr'
+    aliases = dict([("r%d" % i, name) for i, name in enumerate(names)])
+    aliases.update({'s8': 'fp', 'status': 'sr', 'badvaddr': 'bad'})
+    return RegisterTable(regs, pc='pc', sp='sp', fp='fp', ra='ra',
+                         aliases=aliases, gdb_architecture='mips')
+
+
+# Register table builders by architecture and mode (endianness aside).
+_TABLE_BUILDERS = {
+    (uc.UC_ARCH_X86, uc.UC_MODE_16) : _x86_16_table,
+    (uc.UC_ARCH_X86, uc.UC_MODE_32) : _x86_32_table,
+    (uc.UC_ARCH_X86, uc.UC_MODE_64) : _x86_64_table,
+    (uc.UC_ARCH_ARM, uc.UC_MODE_ARM) : _arm_table,
+    (uc.UC_ARCH_ARM, uc.UC_MODE_THUMB) : _arm_table,
+    (uc.UC_ARCH_ARM64, uc.UC_MODE_ARM) : _arm64_table,
+    (uc.UC_ARCH_MIPS, uc.UC_MODE_MIPS32) : lambda: _mips_table(32),
+    (uc.UC_ARCH_MIPS, uc.UC_MODE_MIPS64) : lambda: _mips_table(64),
+}
+
+_tables = dict()
+
+
+def get_register_table(architecture, mode):
+    """Return the RegisterTable of a Unicorn architecture and mode.
+
+    Tables are built once and shared by every emulator.
+    """
+    key = (architecture, mode & ~uc.UC_MODE_BIG_ENDIAN)
+
+    table = _tables.get(key)
+    if table is None:
+        if key not in _TABLE_BUILDERS:
+            raise ValueError("No registers defined for architecture %d mode "
+                             "%d" % (architecture, mode))
+        table = _tables[key] = _TABLE_BUILDERS[key]()
+
+    return table